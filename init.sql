@@ -608,7 +608,9 @@ CREATE TABLE public.event (
     weight numeric(6,2),
     canceled_at timestamp with time zone,
     canceled_by character varying,
-    id_membership uuid
+    id_membership uuid,
+    expires_at timestamp with time zone,
+    rollup_location uuid
 );
 
 
@@ -3147,6 +3149,357 @@ ALTER TABLE ONLY public.white_label
     ADD CONSTRAINT white_label_id_org_fkey FOREIGN KEY (id_org) REFERENCES public.org(id);
 
 
+--
+-- Name: commandstatus; Type: TYPE; Schema: public; Owner: koloni
+--
+
+CREATE TYPE public.commandstatus AS ENUM (
+    'queued',
+    'dispatched',
+    'acknowledged',
+    'failed',
+    'timed_out'
+);
+
+
+ALTER TYPE public.commandstatus OWNER TO koloni;
+
+--
+-- Name: unlock_command; Type: TABLE; Schema: public; Owner: koloni
+--
+
+CREATE TABLE public.unlock_command (
+    id uuid DEFAULT gen_random_uuid() NOT NULL,
+    created_at timestamp with time zone DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    dispatched_at timestamp with time zone,
+    acknowledged_at timestamp with time zone,
+    status public.commandstatus DEFAULT 'queued'::public.commandstatus NOT NULL,
+    hardware_type public.hardwaretype NOT NULL,
+    log_owner character varying,
+    vendor_ref character varying,
+    error character varying,
+    id_org uuid NOT NULL,
+    id_device uuid NOT NULL
+);
+
+
+ALTER TABLE public.unlock_command OWNER TO koloni;
+
+--
+-- Name: unlock_command unlock_command_pkey; Type: CONSTRAINT; Schema: public; Owner: koloni
+--
+
+ALTER TABLE ONLY public.unlock_command
+    ADD CONSTRAINT unlock_command_pkey PRIMARY KEY (id);
+
+
+--
+-- Name: ix_unlock_command_id_device_status; Type: INDEX; Schema: public; Owner: koloni
+--
+
+CREATE INDEX ix_unlock_command_id_device_status ON public.unlock_command USING btree (id_device, status);
+
+
+--
+-- Name: unlock_command unlock_command_id_device_fkey; Type: FK CONSTRAINT; Schema: public; Owner: koloni
+--
+
+ALTER TABLE ONLY public.unlock_command
+    ADD CONSTRAINT unlock_command_id_device_fkey FOREIGN KEY (id_device) REFERENCES public.device(id) ON DELETE CASCADE;
+
+
+--
+-- Name: unlock_command unlock_command_id_org_fkey; Type: FK CONSTRAINT; Schema: public; Owner: koloni
+--
+
+ALTER TABLE ONLY public.unlock_command
+    ADD CONSTRAINT unlock_command_id_org_fkey FOREIGN KEY (id_org) REFERENCES public.org(id);
+
+
+--
+-- Name: ix_event_expires_at; Type: INDEX; Schema: public; Owner: koloni
+--
+
+CREATE INDEX ix_event_expires_at ON public.event USING btree (expires_at) WHERE (expires_at IS NOT NULL);
+
+
+--
+-- Name: event_daily_rollup; Type: TABLE; Schema: public; Owner: koloni
+--
+
+CREATE TABLE public.event_daily_rollup (
+    id_org uuid NOT NULL,
+    id_location uuid,
+    day date NOT NULL,
+    transactions integer DEFAULT 0 NOT NULL,
+    finished integer DEFAULT 0 NOT NULL,
+    revenue numeric(12,2) DEFAULT 0 NOT NULL,
+    duration_seconds double precision DEFAULT 0 NOT NULL,
+    timed_transactions integer DEFAULT 0 NOT NULL
+);
+
+
+ALTER TABLE public.event_daily_rollup OWNER TO koloni;
+
+--
+-- Name: user_daily_rollup; Type: TABLE; Schema: public; Owner: koloni
+--
+
+CREATE TABLE public.user_daily_rollup (
+    id_org uuid NOT NULL,
+    day date NOT NULL,
+    new_users integer DEFAULT 0 NOT NULL
+);
+
+
+ALTER TABLE public.user_daily_rollup OWNER TO koloni;
+
+--
+-- Name: user_daily_rollup user_daily_rollup_pkey; Type: CONSTRAINT; Schema: public; Owner: koloni
+--
+
+ALTER TABLE ONLY public.user_daily_rollup
+    ADD CONSTRAINT user_daily_rollup_pkey PRIMARY KEY (id_org, day);
+
+
+--
+-- Name: ux_event_daily_rollup; Type: INDEX; Schema: public; Owner: koloni
+--
+
+CREATE UNIQUE INDEX ux_event_daily_rollup ON public.event_daily_rollup USING btree (id_org, id_location, day) NULLS NOT DISTINCT;
+
+
+--
+-- Name: rollup_lock(uuid, date, boolean); Type: FUNCTION; Schema: public; Owner: koloni
+--
+
+CREATE FUNCTION public.rollup_lock(id_org uuid, day date, exclusive boolean) RETURNS void
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    -- One lock per org and month, must match routes.reports.rollups
+    month integer := EXTRACT(YEAR FROM day)::integer * 12 + EXTRACT(MONTH FROM day)::integer;
+BEGIN
+    IF exclusive THEN
+        PERFORM pg_advisory_xact_lock(hashtext(id_org::text), month);
+    ELSE
+        PERFORM pg_advisory_xact_lock_shared(hashtext(id_org::text), month);
+    END IF;
+END;
+$$;
+
+
+ALTER FUNCTION public.rollup_lock(id_org uuid, day date, exclusive boolean) OWNER TO koloni;
+
+--
+-- Name: event_location_trigger(); Type: FUNCTION; Schema: public; Owner: koloni
+--
+
+CREATE FUNCTION public.event_location_trigger() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    -- Events stay counted at the location of their device when created,
+    -- even if the device is later moved
+    SELECT id_location INTO NEW.rollup_location FROM public.device WHERE id = NEW.id_device;
+
+    RETURN NEW;
+END;
+$$;
+
+
+ALTER FUNCTION public.event_location_trigger() OWNER TO koloni;
+
+--
+-- Name: rollup_event(public.event, integer); Type: FUNCTION; Schema: public; Owner: koloni
+--
+
+CREATE FUNCTION public.rollup_event(ev public.event, direction integer) RETURNS void
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    event_day date := (ev.created_at AT TIME ZONE 'UTC')::date;
+    duration double precision := EXTRACT(EPOCH FROM ev.ended_at - ev.started_at);
+    is_finished boolean := ev.event_status = 'finished';
+BEGIN
+    PERFORM public.rollup_lock(ev.id_org, event_day, false);
+
+    INSERT INTO public.event_daily_rollup AS r (
+        id_org, id_location, day, transactions, finished, revenue,
+        duration_seconds, timed_transactions
+    )
+    VALUES (
+        ev.id_org,
+        ev.rollup_location,
+        event_day,
+        direction,
+        CASE WHEN is_finished THEN direction ELSE 0 END,
+        CASE WHEN is_finished THEN direction * COALESCE(ev.total, 0) ELSE 0 END,
+        direction * COALESCE(duration, 0),
+        CASE WHEN duration IS NOT NULL THEN direction ELSE 0 END
+    )
+    ON CONFLICT (id_org, id_location, day) DO UPDATE SET
+        transactions = r.transactions + EXCLUDED.transactions,
+        finished = r.finished + EXCLUDED.finished,
+        revenue = r.revenue + EXCLUDED.revenue,
+        duration_seconds = r.duration_seconds + EXCLUDED.duration_seconds,
+        timed_transactions = r.timed_transactions + EXCLUDED.timed_transactions;
+END;
+$$;
+
+
+ALTER FUNCTION public.rollup_event(ev public.event, direction integer) OWNER TO koloni;
+
+--
+-- Name: event_rollup_trigger(); Type: FUNCTION; Schema: public; Owner: koloni
+--
+
+CREATE FUNCTION public.event_rollup_trigger() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' AND (
+        OLD.id_org, OLD.rollup_location, OLD.created_at, OLD.event_status,
+        OLD.total, OLD.started_at, OLD.ended_at
+    ) IS NOT DISTINCT FROM (
+        NEW.id_org, NEW.rollup_location, NEW.created_at, NEW.event_status,
+        NEW.total, NEW.started_at, NEW.ended_at
+    ) THEN
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM public.rollup_event(OLD, -1);
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM public.rollup_event(NEW, 1);
+    END IF;
+
+    RETURN NULL;
+END;
+$$;
+
+
+ALTER FUNCTION public.event_rollup_trigger() OWNER TO koloni;
+
+--
+-- Name: user_rollup_trigger(); Type: FUNCTION; Schema: public; Owner: koloni
+--
+
+CREATE FUNCTION public.user_rollup_trigger() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    link public.link_org_user;
+    direction integer;
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        link := NEW;
+        direction := 1;
+    ELSE
+        link := OLD;
+        direction := -1;
+    END IF;
+
+    PERFORM public.rollup_lock(link.id_org, (link.created_at AT TIME ZONE 'UTC')::date, false);
+
+    INSERT INTO public.user_daily_rollup AS r (id_org, day, new_users)
+    VALUES (link.id_org, (link.created_at AT TIME ZONE 'UTC')::date, direction)
+    ON CONFLICT (id_org, day) DO UPDATE SET
+        new_users = r.new_users + EXCLUDED.new_users;
+
+    RETURN NULL;
+END;
+$$;
+
+
+ALTER FUNCTION public.user_rollup_trigger() OWNER TO koloni;
+
+--
+-- Name: event event_rollup; Type: TRIGGER; Schema: public; Owner: koloni
+--
+
+CREATE TRIGGER event_rollup AFTER INSERT OR DELETE OR UPDATE ON public.event FOR EACH ROW EXECUTE FUNCTION public.event_rollup_trigger();
+
+
+--
+-- Name: event event_location; Type: TRIGGER; Schema: public; Owner: koloni
+--
+
+CREATE TRIGGER event_location BEFORE INSERT OR UPDATE OF id_device ON public.event FOR EACH ROW EXECUTE FUNCTION public.event_location_trigger();
+
+
+--
+-- Name: link_org_user user_rollup; Type: TRIGGER; Schema: public; Owner: koloni
+--
+
+CREATE TRIGGER user_rollup AFTER INSERT OR DELETE ON public.link_org_user FOR EACH ROW EXECUTE FUNCTION public.user_rollup_trigger();
+
+
+--
+-- Name: ix_link_groups_devices_id_group; Type: INDEX; Schema: public; Owner: koloni
+--
+
+CREATE INDEX ix_link_groups_devices_id_group ON public.link_groups_devices USING btree (id_group);
+
+
+--
+-- Name: ix_link_groups_locations_id_group; Type: INDEX; Schema: public; Owner: koloni
+--
+
+CREATE INDEX ix_link_groups_locations_id_group ON public.link_groups_locations USING btree (id_group);
+
+
+--
+-- Name: ix_link_groups_user_id_group; Type: INDEX; Schema: public; Owner: koloni
+--
+
+CREATE INDEX ix_link_groups_user_id_group ON public.link_groups_user USING btree (id_group);
+
+
+--
+-- Name: ix_link_groups_devices_id_device; Type: INDEX; Schema: public; Owner: koloni
+--
+
+CREATE INDEX ix_link_groups_devices_id_device ON public.link_groups_devices USING btree (id_device);
+
+
+--
+-- Name: ix_link_groups_locations_id_location; Type: INDEX; Schema: public; Owner: koloni
+--
+
+CREATE INDEX ix_link_groups_locations_id_location ON public.link_groups_locations USING btree (id_location);
+
+
+--
+-- Name: ix_link_groups_user_id_user; Type: INDEX; Schema: public; Owner: koloni
+--
+
+CREATE INDEX ix_link_groups_user_id_user ON public.link_groups_user USING btree (id_user);
+
+
+--
+-- Name: ix_link_user_devices_id_device; Type: INDEX; Schema: public; Owner: koloni
+--
+
+CREATE INDEX ix_link_user_devices_id_device ON public.link_user_devices USING btree (id_device);
+
+
+--
+-- Name: ix_link_user_locations_id_location; Type: INDEX; Schema: public; Owner: koloni
+--
+
+CREATE INDEX ix_link_user_locations_id_location ON public.link_user_locations USING btree (id_location);
+
+
+--
+-- Name: ix_device_id_location; Type: INDEX; Schema: public; Owner: koloni
+--
+
+CREATE INDEX ix_device_id_location ON public.device USING btree (id_location);
+
+
 --
 -- PostgreSQL database dump complete
 --
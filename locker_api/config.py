@@ -43,6 +43,39 @@ class Settings(BaseSettings):
     redis_url: str
     cache_seconds: int = 3600  # 1 hour
 
+    # Realtime feeds
+    realtime_queue_size: int = 100
+    realtime_max_dropped: int = 500
+    realtime_send_timeout: float = 5
+    realtime_heartbeat_seconds: int = 30
+    realtime_state_ttl: int = 60 * 60 * 24
+    realtime_replay_size: int = 200
+    realtime_sse_retry_ms: int = 3000
+
+    # In-memory caches
+    notification_rules_ttl: int = 300
+    notification_context_ttl: int = 300
+    org_hierarchy_ttl: int = 300
+    stripe_account_ttl: int = 60 * 60
+    member_directory_ttl: int = 300
+    device_access_ttl: int = 300
+
+    # Reports
+    report_concurrency: int = 4
+    report_cache_ttl: int = 60 * 60
+    csv_stream_rows: int = 500
+    rollup_backfill_rows: int = 10000
+
+    # Scheduler
+    scheduler_mode: str = "leader"  # leader, all or standby
+    scheduler_lock_key: int = 7210393
+    scheduler_leader_interval: int = 10
+    scheduler_wakeup_delay: float = 0.1  # batches the leader wakeups of added jobs
+    scheduler_lag_warning: float = 30
+    notification_loader_window: float = 0.05
+    event_expiry_interval: int = 5
+    event_expiry_batch_size: int = 100
+
     # AWS
     aws_region: str
 
@@ -89,6 +122,17 @@ class Settings(BaseSettings):
     # Koloni
     frontend_origin: str
 
+    # Vendor integrations
+    vendor_token_default_ttl: int = 600  # used when a vendor omits expires_in
+    vendor_token_refresh_margin: int = 60
+    unlock_command_workers: int = 4
+    unlock_command_timeout: int = 30
+    gantner_send_timeout: float = 5
+    gantner_send_queue_size: int = 100
+    gantner_request_timeout: float = 10
+    gantner_snapshot_interval: int = 300
+    harbor_tower_cache_ttl: int = 15
+
     # FastAPI
     host: str = "0.0.0.0"
     port: int = 5000
@@ -15,35 +15,66 @@ MIICdgIBADANBgkqhkiG9w0BAQEFAASCAmAwggJcAgEAAoGBAJtzpqJHCySAlNSHtltrDPYPPDw8BPu7
 """
 
 
-def sign_dclock_json_data(data):
-    # Deserialize the private key from a string
-    private_key_bytes = PRIVATE_KEY.encode("utf-8")
-    private_key = serialization.load_pem_private_key(private_key_bytes, password=None)
+class DClockSigner:
+    """Signs DClock open platform requests with the app private key
+
+    The PEM key is parsed once, on first use, and reused for every request.
+    """
+
+    def __init__(self, app_id: str, private_key: str):
+        self.app_id = app_id
+        self._private_key_pem = private_key.encode("utf-8")
+        self._private_key = None
+
+    @property
+    def private_key(self):
+        if self._private_key is None:
+            # Deserialize the private key from a string
+            self._private_key = serialization.load_pem_private_key(
+                self._private_key_pem, password=None
+            )
+
+        return self._private_key
+
+    def sign(self, data: str):
+        # Milliseconds
+        timestamp = int(round(time.time() * 1000))
+
+        # Sign the data using the private key
+        signature = self.private_key.sign(
+            (self.app_id + data + str(timestamp)).encode("utf-8"),
+            padding.PKCS1v15(),
+            hashes.SHA256(),
+        )
+
+        return {
+            # Encode the signature in Base64
+            "sign": base64.b64encode(signature).decode("utf-8"),
+            "timestamp": timestamp,
+        }
 
-    # Milliseconds
-    timestamp = int(round(time.time() * 1000))
+    def build_body(self, data: str):
+        signature = self.sign(data)
 
-    # Sign the data using the private key
-    signature = private_key.sign(
-        (APP_ID + data + str(timestamp)).encode("utf-8"),
-        padding.PKCS1v15(),
-        hashes.SHA256(),
-    )
+        return {
+            "sign": signature["sign"],
+            "data": data,
+            "appId": self.app_id,
+            "timestamp": signature["timestamp"],
+        }
 
-    # Encode the signature in Base64
-    signature_base64 = base64.b64encode(signature).decode("utf-8")
 
-    return {
-        "sign": signature_base64,
-        "timestamp": timestamp,
-    }
+dclock_signer = DClockSigner(APP_ID, PRIVATE_KEY)
+
+
+def sign_dclock_json_data(data):
+    return dclock_signer.sign(data)
 
 
 # Gets all locks in one box (locker wall)
 async def query_box(terminal_no: str):
     # Example terminal number: DC21071701247878
     data_to_sign = json.dumps({"terminalNo": terminal_no})
-    signature = sign_dclock_json_data(data_to_sign)
 
     async with httpx.AsyncClient() as client:
         try:
@@ -52,12 +83,7 @@ async def query_box(terminal_no: str):
                 headers={
                     "Content-Type": "application/json",
                 },
-                json={
-                    "sign": signature["sign"],
-                    "data": data_to_sign,
-                    "appId": "df568d3b4616422caa0868b7b8876081",
-                    "timestamp": signature["timestamp"],
-                },
+                json=dclock_signer.build_body(data_to_sign),
             )
         except Exception as e:
             print(e)
@@ -76,14 +102,13 @@ async def query_box(terminal_no: str):
                 detail=f"DClock API failed to query box {terminal_no}. Error code {res.status_code}",
             )
 
-        return res.json()["data"]
+        return res_data["data"]
 
 
 # Unlocks a single box (locker)
 async def remote_open_box(terminal_no: str, box_no: str):
     # Example terminal number: DC21071701247878
     data_to_sign = json.dumps({"terminalNo": terminal_no, "boxNo": box_no})
-    signature = sign_dclock_json_data(data_to_sign)
 
     async with httpx.AsyncClient() as client:
         try:
@@ -92,12 +117,7 @@ async def remote_open_box(terminal_no: str, box_no: str):
                 headers={
                     "Content-Type": "application/json",
                 },
-                json={
-                    "sign": signature["sign"],
-                    "data": data_to_sign,
-                    "appId": "df568d3b4616422caa0868b7b8876081",
-                    "timestamp": signature["timestamp"],
-                },
+                json=dclock_signer.build_body(data_to_sign),
             )
         except Exception as e:
             print(e)
@@ -116,4 +136,4 @@ async def remote_open_box(terminal_no: str, box_no: str):
                 detail=f"DClock API failed to unlock box {box_no} on terminal {terminal_no}. Error code {res_data['errorCode']}",
             )
 
-        return res.json()
+        return res_data
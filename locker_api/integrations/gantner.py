@@ -1,7 +1,11 @@
+import asyncio
 import json
+import time
+from typing import Dict, Optional
 
 import asyncpg
 from config import get_settings
+from fastapi import HTTPException, WebSocket
 from util.connection_manager import connection_manager
 from routes.logger.controller import add_to_logger_gantner
 from routes.logger.model import LogType
@@ -19,28 +23,166 @@ async def connect_to_database():
     return connection
 
 
+class GantnerClient:
+    """Request/response correlation and lock state for the Gantner controllers
+
+    Every request gets a fresh TID and a future in the pending table that is
+    resolved by the matching response. The App.Locks.Get snapshot, which
+    tells which controller owns each lock, is only requested again once it
+    is older than gantner_snapshot_interval.
+    """
+
+    def __init__(self):
+        self.pending: Dict[int, asyncio.Future] = {}
+        self.last_snapshot: float = 0
+
+    async def request(
+        self,
+        cmd: str,
+        data: dict,
+        lock_id: Optional[str] = None,
+        websocket: Optional[WebSocket] = None,
+    ) -> asyncio.Future:
+        """Sends a request and returns the future resolved by its response
+
+        Args:
+            cmd (str): Gantner command, e.g. "App.SetLockState"
+            data (dict): request data
+            lock_id (str, optional): send only to the controller owning the lock
+            websocket (WebSocket, optional): send only to this controller
+
+        Returns:
+            asyncio.Future: resolves with the response message
+        """
+        tid = connection_manager.next_tid()
+        future = asyncio.get_running_loop().create_future()
+        self.pending[tid] = future
+
+        message = json.dumps({"Cmd": cmd, "MT": "Req", "TID": tid, "Data": data})
+
+        if websocket:
+            await connection_manager.send_personal_message(message, websocket)
+        elif lock_id:
+            await connection_manager.send_to_lock(lock_id, message)
+        else:
+            await connection_manager.broadcast(message)
+
+        asyncio.get_running_loop().call_later(
+            get_settings().gantner_request_timeout, self._expire, tid
+        )
+
+        return future
+
+    def _expire(self, tid: int):
+        future = self.pending.pop(tid, None)
+
+        if future and not future.done():
+            future.set_exception(asyncio.TimeoutError())
+            # Nobody may be awaiting it, keep asyncio from logging the error
+            future.exception()
+
+    def resolve(self, message: dict) -> bool:
+        """Resolves the pending request answered by a response message
+
+        Returns:
+            bool: True if the message answered a pending request
+        """
+        if message.get("MT") != "Rsp":
+            return False
+
+        future = self.pending.pop(message.get("TID"), None)
+
+        if not future or future.done():
+            return False
+
+        future.set_result(message)
+        return True
+
+    def snapshot_received(self):
+        # The lock owners of the snapshot are kept by the connection manager
+        self.last_snapshot = time.monotonic()
+
+    async def request_snapshot(self, websocket: Optional[WebSocket] = None):
+        return await self.request("App.Locks.Get", {}, websocket=websocket)
+
+    async def refresh_snapshot_if_stale(self):
+        interval = get_settings().gantner_snapshot_interval
+
+        if time.monotonic() - self.last_snapshot > interval:
+            # Mark it now so concurrent unlocks don't all request a snapshot
+            self.last_snapshot = time.monotonic()
+            await self.request_snapshot()
+
+
+gantner_client = GantnerClient()
+
+
+async def await_response(future: asyncio.Future) -> dict:
+    try:
+        return await future
+    except asyncio.TimeoutError:
+        raise HTTPException(
+            status_code=504,
+            detail="Gantner controller did not answer in time",
+        )
+
+
+def response_error(message: dict) -> Optional[str]:
+    """The error of a response message, None if the request succeeded"""
+    result = message.get("Result") or {}
+
+    if message.get("Error"):
+        return str(message["Error"])
+
+    if result.get("Code", 0) != 0:
+        return str(result.get("Text") or result["Code"])
+
+    return None
+
+
 async def unlock(locker_id: str):
-    await connection_manager.broadcast(
-        json.dumps({"Cmd": "App.Locks.Get", "MT": "Req", "TID": 1336, "Data": {}})
-    )
+    """Unlocks a lock and waits for its controller to accept the request
+
+    Raises:
+        HTTPException: the controller rejected the request or didn't answer
+        within gantner_request_timeout
+    """
+    await gantner_client.refresh_snapshot_if_stale()
+
+    if locker_id not in connection_manager.lock_owners:
+        # Learn the owner first, a broadcast SetLockState would be answered
+        # by every controller, including those that don't have the lock
+        try:
+            await await_response(await gantner_client.request_snapshot())
+        except HTTPException:
+            pass
 
-    await connection_manager.broadcast(
-        json.dumps(
-            {
-                "Cmd": "App.SetLockState",
-                "MT": "Req",
-                "TID": 1337,
-                "Data": {"Id": locker_id, "LockStatus": "Unlock"},
-            }
+    response = await await_response(
+        await gantner_client.request(
+            "App.SetLockState",
+            {"Id": locker_id, "LockStatus": "Unlock"},
+            lock_id=locker_id,
         )
     )
+
+    error = response_error(response)
+
+    if error:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Gantner controller rejected unlock of {locker_id}: {error}",
+        )
+
     connection = await connect_to_database()
 
-    await connection.execute(
-        "UPDATE device SET lock_status = $1 WHERE gantner_id = $2",
-        "open",
-        locker_id,
-    )
+    try:
+        await connection.execute(
+            "UPDATE device SET lock_status = $1 WHERE gantner_id = $2",
+            "open",
+            locker_id,
+        )
+    finally:
+        await connection.close()
 
 
 async def refresh_gantner_lock_states(sql_pool, data):
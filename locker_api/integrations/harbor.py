@@ -39,7 +39,7 @@ class SessionLockerTokenResponse:
     expires: str
 
 
-async def get_harbor_client():
+async def request_harbor_token(scope: str):
     headers = {
         "Content-Type": "application/x-www-form-urlencoded",
     }
@@ -48,7 +48,7 @@ async def get_harbor_client():
         "grant_type": "client_credentials",
         "client_id": get_harbor_config().client_id,
         "client_secret": get_harbor_config().client_secret,
-        "scope": "service_provider",
+        "scope": scope,
     }
 
     async with httpx.AsyncClient() as client:
@@ -58,49 +58,29 @@ async def get_harbor_client():
             content=urlencode(data),
         )
 
-        print("Attempting to create Harbor client")
-
-        print(res.json())
+        print(f"Attempting to create Harbor client ({scope})")
 
         if res.status_code != 200:
             raise HTTPException(
                 status_code=res.status_code,
-                detail="Failed to create Harbor client",
+                detail="Failed to create SDK Harbor client"
+                if scope == "tower_access"
+                else "Failed to create Harbor client",
             )
 
-        return res.json()["access_token"]
-
-
-async def get_harbor_sdk_client():
-    headers = {
-        "Content-Type": "application/x-www-form-urlencoded",
-    }
+        return res.json()
 
-    data = {
-        "grant_type": "client_credentials",
-        "client_id": get_harbor_config().client_id,
-        "client_secret": get_harbor_config().client_secret,
-        "scope": "tower_access",
-    }
 
-    async with httpx.AsyncClient() as client:
-        res = await client.post(
-            url=get_harbor_config().login_api_url,
-            headers=headers,
-            content=urlencode(data),
-        )
+async def get_harbor_client():
+    res = await request_harbor_token("service_provider")
 
-        print("Attempting to create Harbor SDK client")
+    return res["access_token"]
 
-        print(res.json())
 
-        if res.status_code != 200:
-            raise HTTPException(
-                status_code=res.status_code,
-                detail="Failed to create SDK Harbor client",
-            )
+async def get_harbor_sdk_client():
+    res = await request_harbor_token("tower_access")
 
-        return res.json()["access_token"]
+    return res["access_token"]
 
 
 async def cancel_reservation(
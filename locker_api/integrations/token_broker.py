@@ -0,0 +1,162 @@
+import asyncio
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, Tuple
+
+import httpx
+from config import get_settings
+from fastapi import HTTPException
+
+from . import harbor, keynius, linka, spintly
+from .types import LinkaTokenResponse, SpintlyTokenResponse
+
+# Fetchers return the token object handed to the vendor calls and its
+# lifetime in seconds (None when the vendor does not report one)
+TokenFetcher = Callable[[], Awaitable[Tuple[object, float | None]]]
+
+
+@dataclass
+class CachedToken:
+    token: object
+    expires_at: float
+
+
+async def _fetch_keynius_token():
+    result = await keynius.get_client()
+
+    return result["accessToken"], result.get("expiresIn")
+
+
+async def _fetch_linka_token():
+    token: LinkaTokenResponse = await linka.get_token()
+
+    expires_at = token.access_token_expireAt
+    if expires_at.tzinfo is None:
+        expires_at = expires_at.replace(tzinfo=timezone.utc)
+
+    return token, (expires_at - datetime.now(timezone.utc)).total_seconds()
+
+
+async def _fetch_spintly_token():
+    async with httpx.AsyncClient() as client:
+        response = await spintly.get_token(client)
+
+    if response.status_code != 200:
+        raise HTTPException(
+            status_code=response.status_code,
+            detail="Spintly API failed to unlock device. Unable to create"
+            + " Spintly connection.",
+        )
+
+    token = SpintlyTokenResponse.parse_obj(response.json())
+
+    return token, token.expires_in
+
+
+async def _fetch_harbor_api_token():
+    result = await harbor.request_harbor_token("service_provider")
+
+    return result["access_token"], result.get("expires_in")
+
+
+async def _fetch_harbor_sdk_token():
+    result = await harbor.request_harbor_token("tower_access")
+
+    return result["access_token"], result.get("expires_in")
+
+
+class TokenBroker:
+    """Caches vendor access tokens until shortly before they expire
+
+    Refreshes are single-flight: concurrent callers waiting on an expired
+    token share the one login request in flight for that vendor.
+    """
+
+    def __init__(self, fetchers: Dict[str, TokenFetcher]):
+        self._fetchers = fetchers
+        self._tokens: Dict[str, CachedToken] = {}
+        self._locks: Dict[str, asyncio.Lock] = {
+            vendor: asyncio.Lock() for vendor in fetchers
+        }
+
+    def _valid(self, vendor: str) -> CachedToken | None:
+        cached = self._tokens.get(vendor)
+
+        if cached and cached.expires_at > time.monotonic():
+            return cached
+
+        return None
+
+    async def get_token(self, vendor: str):
+        """Returns a cached token for the vendor, logging in if needed
+
+        Args:
+            vendor (str): name of the vendor, e.g. "keynius"
+
+        Returns:
+            object: the token in the shape the vendor integration expects
+        """
+        cached = self._valid(vendor)
+        if cached:
+            return cached.token
+
+        async with self._locks[vendor]:
+            # Another caller may have refreshed while we waited for the lock
+            cached = self._valid(vendor)
+            if cached:
+                return cached.token
+
+            token, expires_in = await self._fetchers[vendor]()
+
+            settings = get_settings()
+            lifetime = (
+                expires_in if expires_in else settings.vendor_token_default_ttl
+            ) - settings.vendor_token_refresh_margin
+
+            self._tokens[vendor] = CachedToken(
+                token=token,
+                expires_at=time.monotonic() + max(lifetime, 0),
+            )
+
+            return token
+
+    def invalidate(self, vendor: str):
+        self._tokens.pop(vendor, None)
+
+    async def call(self, vendor: str, func: Callable[[object], Awaitable]):
+        """Runs a vendor call with a cached token, retrying once on 401
+
+        Args:
+            vendor (str): name of the vendor, e.g. "keynius"
+            func (callable): async function receiving the token
+
+        Returns:
+            the result of func
+        """
+        token = await self.get_token(vendor)
+
+        try:
+            result = await func(token)
+        except HTTPException as e:
+            if e.status_code != 401:
+                raise
+        else:
+            if not (isinstance(result, httpx.Response) and result.status_code == 401):
+                return result
+
+        self.invalidate(vendor)
+        token = await self.get_token(vendor)
+
+        return await func(token)
+
+
+token_broker = TokenBroker(
+    {
+        "keynius": _fetch_keynius_token,
+        "linka": _fetch_linka_token,
+        "spintly": _fetch_spintly_token,
+        "harbor_api": _fetch_harbor_api_token,
+        "harbor_sdk": _fetch_harbor_sdk_token,
+    }
+)
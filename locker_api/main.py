@@ -8,7 +8,8 @@ from gmqtt import Client as MQTTClient
 from async_stripe import stripe
 from botocore.errorfactory import ClientError
 from config import get_settings
-from fastapi import Depends, FastAPI, WebSocket, WebSocketDisconnect
+from auth.cognito import get_permission
+from fastapi import Depends, FastAPI, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse, RedirectResponse
@@ -16,9 +17,19 @@ from fastapi_async_sqlalchemy import SQLAlchemyMiddleware
 from fastapi_cache import FastAPICache
 from fastapi_cache.backends.redis import RedisBackend
 from httpx import Request
-from integrations.gantner import refresh_gantner_lock, refresh_gantner_lock_states
+from integrations.gantner import (
+    gantner_client,
+    refresh_gantner_lock,
+    refresh_gantner_lock_states,
+)
 from pydantic import PostgresDsn
 from redis import asyncio as aioredis
+from routes.commands.controller import acknowledge_unlock, start_command_workers
+from routes.event.expiry import start_expiry_sweeper
+from routes.member.directory import member_directory
+from routes.member.model import RoleType
+from routes.notifications.controller import migrate_notification_jobs
+from routes.reservations.controller import migrate_reservation_jobs
 from routes.router import central_router
 from sentry_sdk.integrations.asgi import SentryAsgiMiddleware
 from sqlalchemy.exc import IntegrityError, NoResultFound, SQLAlchemyError
@@ -26,10 +37,12 @@ from sqlalchemy.pool import NullPool
 from twilio.base.exceptions import TwilioRestException
 from util.connection_manager import connection_manager
 from util.exception import format_error
+from util.invalidation import invalidation_bus
+from util.realtime import realtime_hub
 from routes.logger.controller import add_to_logger_dclock
 from routes.logger.model import LogType
 
-from util.scheduler import start_scheduler
+from util.scheduler import scheduler_stats, start_scheduler
 
 # from rate_limit.rate_limit import RateLimitMiddleware
 
@@ -92,11 +105,17 @@ if get_settings().environment != "local":
 @app.on_event("startup")
 async def startup_event():
     start_scheduler()
+    migrate_notification_jobs()
+    migrate_reservation_jobs()
+    await start_command_workers()
+    start_expiry_sweeper()
     redis = aioredis.from_url(get_settings().redis_url)
     db = await create_pool()
 
     await redis.flushall()
     FastAPICache.init(RedisBackend(redis), prefix="fastapi-cache", expire=600)
+    await realtime_hub.start(get_settings().redis_url)
+    await invalidation_bus.start(get_settings().redis_url)
     client = MQTTClient(str(uuid.uuid4()))
 
     client.set_auth_credentials(get_settings().mqtt_user, get_settings().mqtt_pass)
@@ -109,6 +128,11 @@ async def startup_event():
     await client.connect(get_settings().mqtt_host, get_settings().mqtt_port, True)
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    await member_directory.close()
+
+
 # Redirect to koloni.io
 @app.get("/")
 async def root():
@@ -169,6 +193,13 @@ class DcClient:
                         payload[1],
                         LogType.unlock if payload[2][0] == "1" else LogType.lock,
                     )
+
+                # Only a closed -> open transition confirms a pending unlock,
+                # the periodic repeats of an open box don't
+                if payload[2][0] == "1":
+                    await acknowledge_unlock(
+                        dclock_terminal_no=payload[0], dclock_box_no=payload[1]
+                    )
         else:
             print("Updating DClock (First Time)")
             async with self.db.acquire() as conn:
@@ -186,9 +217,7 @@ class DcClient:
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket, sql_pool=Depends(create_pool)):
     await connection_manager.connect(websocket)
-    await websocket.send_text(
-        json.dumps({"Cmd": "App.Locks.Get", "MT": "Req", "TID": 1336, "Data": {}})
-    )
+    await gantner_client.request_snapshot(websocket)
 
     try:
         while True:
@@ -196,8 +225,12 @@ async def websocket_endpoint(websocket: WebSocket, sql_pool=Depends(create_pool)
 
             json_dat = json.loads(data)
 
+            gantner_client.resolve(json_dat)
+
             match json_dat:
-                case {"Cmd": "App.Locks.Get", "MT": "Rsp", "TID": 1336}:
+                case {"Cmd": "App.Locks.Get", "MT": "Rsp"}:
+                    connection_manager.register_locks(websocket, json_dat["Data"])
+                    gantner_client.snapshot_received()
                     await refresh_gantner_lock_states(sql_pool, json_dat["Data"])
 
                 case {"Cmd": "Heartbeat", "Data": {}, "MT": "Req"}:
@@ -217,7 +250,14 @@ async def websocket_endpoint(websocket: WebSocket, sql_pool=Depends(create_pool)
                         )
 
                 case {"Cmd": "App.LockStateChanged", "MT": "Evt"}:
-                    await refresh_gantner_lock(sql_pool, json_dat["Data"]["Lock"])
+                    lock = json_dat["Data"]["Lock"]
+                    await refresh_gantner_lock(sql_pool, lock)
+
+                    if lock["Status"]["LockStatus"].lower() != "locked":
+                        await acknowledge_unlock(gantner_id=lock["Id"])
+
+                case {"MT": "Rsp"}:
+                    pass
 
                 case _:
                     print("[!] Unknown message received")
@@ -231,6 +271,28 @@ async def websocket_endpoint(websocket: WebSocket, sql_pool=Depends(create_pool)
         connection_manager.disconnect(websocket)
 
 
+@app.get("/v3/partner/gantner/controllers")
+async def gantner_controllers(permission: RoleType = Depends(get_permission)):
+    """Controllers connected to this worker, with their send latency"""
+    if permission != RoleType.admin:
+        raise HTTPException(
+            status_code=403, detail="Not enough permissions, must be admin"
+        )
+
+    return connection_manager.stats()
+
+
+@app.get("/v3/partner/scheduler")
+async def scheduler_status(permission: RoleType = Depends(get_permission)):
+    """Leadership of this worker and lag and run time of the scheduled jobs"""
+    if permission != RoleType.admin:
+        raise HTTPException(
+            status_code=403, detail="Not enough permissions, must be admin"
+        )
+
+    return scheduler_stats()
+
+
 @app.exception_handler(SQLAlchemyError)
 async def sqlalchemy_exception_handler(request: Request, exc: SQLAlchemyError):
     detail = "A database error occurred."
@@ -1,3 +1,6 @@
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Tuple
 from uuid import UUID
 
 from async_stripe import stripe
@@ -6,23 +9,103 @@ from fastapi import HTTPException
 from fastapi_async_sqlalchemy import db
 from routes.organization.model import Org
 from sqlalchemy import select
+from util.invalidation import invalidation_bus
 
 stripe.api_key = get_settings().stripe_api_key
 
 
+@dataclass
+class StripeAccountInfo:
+    """The parts of an org's connected account that charges and reports use"""
+
+    id: str
+    default_currency: Optional[str]
+    capabilities: Dict[str, str] = field(default_factory=dict)
+
+
+class StripeAccountCache:
+    """Caches the Stripe account id and metadata of each org
+
+    Entries last stripe_account_ttl seconds, or until the account is created,
+    deleted or updated on Stripe (see the /stripe/webhook endpoint).
+    """
+
+    def __init__(self):
+        # id_org -> (loaded_at, account id)
+        self.account_ids: Dict[str, Tuple[float, str]] = {}
+        # id_org -> (loaded_at, account)
+        self.accounts: Dict[str, Tuple[float, StripeAccountInfo]] = {}
+
+    def _fresh(self, cached: Optional[tuple]) -> bool:
+        return bool(
+            cached and time.monotonic() - cached[0] < get_settings().stripe_account_ttl
+        )
+
+    async def get_account_id(self, id_org: UUID) -> str:
+        cached = self.account_ids.get(str(id_org))
+
+        if self._fresh(cached):
+            return cached[1]
+
+        query = select(Org.stripe_account_id).where(Org.id == id_org)
+        result = await db.session.execute(query)
+
+        stripe_account = result.scalars().first()
+
+        if not stripe_account:
+            raise HTTPException(status_code=404, detail="Stripe account not found")
+
+        self.account_ids[str(id_org)] = (time.monotonic(), stripe_account)
+
+        return stripe_account
+
+    async def get_account(self, id_org: UUID) -> StripeAccountInfo:
+        cached = self.accounts.get(str(id_org))
+
+        if self._fresh(cached):
+            return cached[1]
+
+        account = await stripe.Account.retrieve(await self.get_account_id(id_org))
+
+        return self.store(id_org, account)
+
+    def store(self, id_org: UUID, account) -> StripeAccountInfo:
+        """Caches an account retrieved from Stripe elsewhere"""
+        info = StripeAccountInfo(
+            id=account["id"],
+            default_currency=account.get("default_currency"),
+            capabilities=dict(account.get("capabilities") or {}),
+        )
+
+        now = time.monotonic()
+        self.account_ids[str(id_org)] = (now, info.id)
+        self.accounts[str(id_org)] = (now, info)
+
+        return info
+
+    def drop(self, id_org: str):
+        self.account_ids.pop(id_org, None)
+        self.accounts.pop(id_org, None)
+
+    async def invalidate(self, id_org: UUID):
+        await invalidation_bus.invalidate("stripe-account", id_org)
+
+
+stripe_accounts = StripeAccountCache()
+
+invalidation_bus.register("stripe-account", stripe_accounts.drop)
+
+
 async def get_stripe_account(
     id_org: UUID,
 ):
-    query = select(Org.stripe_account_id).where(Org.id == id_org)
-
-    result = await db.session.execute(query)
+    return await stripe_accounts.get_account_id(id_org)
 
-    stripe_account = result.scalars().first()
 
-    if not stripe_account:
-        raise HTTPException(status_code=404, detail="Stripe account not found")
+async def get_default_currency(id_org: UUID) -> str:
+    account = await stripe_accounts.get_account(id_org)
 
-    return stripe_account
+    return account.default_currency or "usd"
 
 
 async def create_setup_intent(
@@ -0,0 +1,428 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Set
+from uuid import UUID
+
+import httpx
+from config import get_settings
+from fastapi import HTTPException
+from fastapi_async_sqlalchemy import db
+from integrations import linka
+from integrations.token_broker import token_broker
+from sqlalchemy import insert, select, update
+
+from ..device.bulk_unlock import (
+    send_dclock_unlock,
+    send_gantner_unlock,
+    send_keynius_unlock,
+    send_linka_unlock,
+    send_spintly_unlock,
+)
+from ..device.model import Device, HardwareType, LockStatus
+from ..logger.controller import add_to_logger
+from ..logger.model import LogType
+from .model import FINAL_COMMAND_STATUSES, CommandStatus, UnlockCommand
+
+# Vendors that report back when the lock actually opened. Commands sent to
+# any other vendor are acknowledged as soon as the vendor accepts them.
+CONFIRMED_VENDORS = [HardwareType.dclock, HardwareType.gantner, HardwareType.linka]
+
+LINKA_POLL_SECONDS = 1
+
+# Commands persisted by this process, waiting to be claimed by a worker
+command_queue: asyncio.Queue = asyncio.Queue()
+
+# Local waiters, set when a command of this process reaches a final status
+command_waiters: Dict[UUID, asyncio.Event] = {}
+
+command_workers: List[asyncio.Task] = []
+
+# Linka confirmations polled outside of the command workers
+confirmation_tasks: Set[asyncio.Task] = set()
+
+
+def serialize_command(command: UnlockCommand) -> UnlockCommand.Read:
+    read = UnlockCommand.Read.parse_obj(command)
+
+    if command.acknowledged_at:
+        read.latency_ms = (
+            command.acknowledged_at - command.created_at
+        ).total_seconds() * 1000
+
+    return read
+
+
+def _notify(id_command: UUID):
+    waiter = command_waiters.get(id_command)
+
+    if waiter:
+        waiter.set()
+
+
+async def enqueue_unlock(
+    device: Device,
+    id_org: UUID,
+    log_owner: Optional[str] = None,
+) -> UnlockCommand:
+    """Persists an unlock command and hands it to the command workers
+
+    Args:
+        device (Device): device to unlock
+        id_org (UUID): id of the organization
+        log_owner (str, optional): name written as owner of the unlock log
+
+    Returns:
+        UnlockCommand: the queued command
+    """
+    query = (
+        insert(UnlockCommand)
+        .values(
+            id_org=id_org,
+            id_device=device.id,
+            hardware_type=device.hardware_type,
+            log_owner=log_owner if log_owner else "API",
+        )
+        .returning(UnlockCommand)
+    )
+
+    response = await db.session.execute(query)
+    await db.session.commit()
+
+    command = response.all().pop()
+
+    command_waiters[command.id] = asyncio.Event()
+    await command_queue.put(command.id)
+
+    return command
+
+
+async def _set_status(
+    id_command: UUID,
+    status: CommandStatus,
+    from_status: CommandStatus,
+    **values,
+):
+    query = (
+        update(UnlockCommand)
+        .where(
+            UnlockCommand.id == id_command,
+            UnlockCommand.status == from_status,
+        )
+        .values(status=status, **values)
+        .returning(UnlockCommand.id)
+    )
+
+    response = await db.session.execute(query)
+    await db.session.commit()
+
+    updated = response.scalar_one_or_none()
+
+    if updated and status in FINAL_COMMAND_STATUSES:
+        _notify(id_command)
+
+    return updated
+
+
+async def _await_linka_confirmation(id_command: UUID, command_id: str):
+    """Polls Linka's command_status until the lock reports the command result"""
+    deadline = asyncio.get_running_loop().time() + get_settings().unlock_command_timeout
+
+    while asyncio.get_running_loop().time() < deadline:
+        await asyncio.sleep(LINKA_POLL_SECONDS)
+
+        async def get_status(token):
+            async with httpx.AsyncClient() as client:
+                return await linka.command_status(client, token, command_id)
+
+        response = await token_broker.call("linka", get_status)
+        data = response.json().get("data") or {}
+        status_desc = str(data.get("status_desc", "")).lower()
+
+        if status_desc in ["success", "completed", "complete"]:
+            await _set_status(
+                id_command,
+                CommandStatus.acknowledged,
+                CommandStatus.dispatched,
+                acknowledged_at=datetime.now(timezone.utc),
+            )
+            return
+
+        if status_desc in ["failed", "fail", "error"]:
+            await _set_status(
+                id_command,
+                CommandStatus.failed,
+                CommandStatus.dispatched,
+                error=f"Linka command {command_id} failed",
+            )
+            return
+
+
+async def _poll_linka_confirmation(id_command: UUID, command_id: str):
+    try:
+        async with db():
+            await _await_linka_confirmation(id_command, command_id)
+    except Exception as e:
+        print(f"[!] Failed to confirm Linka command {id_command}: {e}")
+
+
+async def dispatch_command(id_command: UUID):
+    """Claims a queued command and sends it to the lock vendor"""
+    claimed = await _set_status(
+        id_command,
+        CommandStatus.dispatched,
+        CommandStatus.queued,
+        dispatched_at=datetime.now(timezone.utc),
+    )
+
+    # Another worker already claimed it
+    if not claimed:
+        return
+
+    query = select(UnlockCommand, Device).join(
+        Device, Device.id == UnlockCommand.id_device
+    )
+    response = await db.session.execute(query.where(UnlockCommand.id == id_command))
+    command, device = response.unique().one()
+
+    await add_to_logger(command.id_org, device.id, LogType.unlock, command.log_owner)
+
+    vendor_ref = None
+
+    try:
+        match device.hardware_type:
+            case HardwareType.linka:
+                result = await send_linka_unlock(device)
+                vendor_ref = (result.json().get("data") or {}).get("command_id")
+            case HardwareType.spintly:
+                await send_spintly_unlock(device)
+            case HardwareType.keynius:
+                await send_keynius_unlock(device)
+            case HardwareType.gantner:
+                await send_gantner_unlock(device)
+            case HardwareType.dclock:
+                await send_dclock_unlock(device.dclock_terminal_no, [device])
+            case HardwareType.virtual:
+                await db.session.execute(
+                    update(Device)
+                    .where(Device.id == device.id)
+                    .values(lock_status=LockStatus.open)
+                )
+                await db.session.commit()
+            case HardwareType.harbor:
+                pass
+            case _:
+                raise HTTPException(status_code=400, detail="Unsupported command")
+    except HTTPException as e:
+        await _set_status(
+            id_command, CommandStatus.failed, CommandStatus.dispatched, error=e.detail
+        )
+        return
+    except Exception as e:
+        await _set_status(
+            id_command, CommandStatus.failed, CommandStatus.dispatched, error=str(e)
+        )
+        return
+
+    if device.hardware_type not in CONFIRMED_VENDORS or (
+        device.hardware_type == HardwareType.gantner
+        and device.lock_status != LockStatus.locked
+    ):
+        await _set_status(
+            id_command,
+            CommandStatus.acknowledged,
+            CommandStatus.dispatched,
+            acknowledged_at=datetime.now(timezone.utc),
+        )
+        return
+
+    if device.hardware_type == HardwareType.linka:
+        if not vendor_ref:
+            await _set_status(
+                id_command,
+                CommandStatus.acknowledged,
+                CommandStatus.dispatched,
+                acknowledged_at=datetime.now(timezone.utc),
+            )
+            return
+
+        await db.session.execute(
+            update(UnlockCommand)
+            .where(UnlockCommand.id == id_command)
+            .values(vendor_ref=vendor_ref)
+        )
+        await db.session.commit()
+
+        # Polling can take up to unlock_command_timeout, so the worker moves
+        # on to the next command instead of waiting for it
+        task = asyncio.create_task(_poll_linka_confirmation(id_command, vendor_ref))
+        confirmation_tasks.add(task)
+        task.add_done_callback(confirmation_tasks.discard)
+
+    # DClock and Gantner confirmations arrive through MQTT and the Gantner
+    # websocket, see acknowledge_unlock
+
+
+async def acknowledge_unlock(
+    gantner_id: Optional[str] = None,
+    dclock_terminal_no: Optional[str] = None,
+    dclock_box_no: Optional[str] = None,
+):
+    """Marks the dispatched commands of a lock that reported open as acknowledged
+
+    Called from the MQTT (DClock) and websocket (Gantner) handlers, which run
+    outside of a request so a session is opened here.
+    """
+    if gantner_id:
+        devices = select(Device.id).where(Device.gantner_id == gantner_id)
+    else:
+        devices = select(Device.id).where(
+            Device.dclock_terminal_no == dclock_terminal_no,
+            Device.dclock_box_no == dclock_box_no,
+        )
+
+    async with db():
+        query = (
+            update(UnlockCommand)
+            .where(
+                UnlockCommand.id_device.in_(devices.scalar_subquery()),
+                UnlockCommand.status == CommandStatus.dispatched,
+            )
+            .values(
+                status=CommandStatus.acknowledged,
+                acknowledged_at=datetime.now(timezone.utc),
+            )
+            .returning(UnlockCommand.id)
+        )
+
+        response = await db.session.execute(query)
+        await db.session.commit()
+
+        for id_command in response.scalars().all():
+            _notify(id_command)
+
+
+async def expire_commands():
+    """Times out commands whose confirmation never arrived"""
+    timeout = get_settings().unlock_command_timeout
+
+    query = (
+        update(UnlockCommand)
+        .where(
+            UnlockCommand.status.in_([CommandStatus.queued, CommandStatus.dispatched]),
+            UnlockCommand.created_at
+            < datetime.now(timezone.utc) - timedelta(seconds=timeout),
+        )
+        .values(status=CommandStatus.timed_out)
+        .returning(UnlockCommand.id)
+    )
+
+    response = await db.session.execute(query)
+    await db.session.commit()
+
+    for id_command in response.scalars().all():
+        _notify(id_command)
+
+
+async def get_command(id_command: UUID, id_org: UUID) -> UnlockCommand:
+    query = select(UnlockCommand).where(
+        UnlockCommand.id == id_command,
+        UnlockCommand.id_org == id_org,
+    )
+
+    response = await db.session.execute(query)
+
+    return response.unique().scalar_one()  # raises NoResultFound
+
+
+async def wait_for_command(
+    id_command: UUID,
+    id_org: UUID,
+    timeout: float,
+) -> UnlockCommand.Read:
+    """Waits until the command reaches a final status or the timeout elapses
+
+    Commands dispatched by this process wake the waiter directly, commands
+    handled by another worker are picked up by re-reading the row.
+
+    Args:
+        id_command (UUID): id of the command
+        id_org (UUID): id of the organization
+        timeout (float): maximum seconds to wait
+
+    Returns:
+        UnlockCommand.Read: the command in its latest status
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    waiter = command_waiters.get(id_command)
+
+    while True:
+        command = await get_command(id_command, id_org)
+        remaining = deadline - loop.time()
+
+        if command.status in FINAL_COMMAND_STATUSES or remaining <= 0:
+            break
+
+        try:
+            if waiter:
+                await asyncio.wait_for(waiter.wait(), min(remaining, 1))
+            else:
+                await asyncio.sleep(min(remaining, 0.5))
+        except asyncio.TimeoutError:
+            pass
+
+        # The row was updated in another transaction
+        db.session.expire_all()
+
+    return serialize_command(command)
+
+
+async def _command_worker():
+    while True:
+        id_command = await command_queue.get()
+
+        try:
+            async with db():
+                await dispatch_command(id_command)
+        except Exception as e:
+            print(f"[!] Failed to dispatch unlock command {id_command}: {e}")
+        finally:
+            command_queue.task_done()
+
+
+async def _command_janitor():
+    while True:
+        await asyncio.sleep(get_settings().unlock_command_timeout)
+
+        try:
+            async with db():
+                await expire_commands()
+
+            # Forget local waiters of commands that can no longer change
+            for id_command, waiter in list(command_waiters.items()):
+                if waiter.is_set():
+                    del command_waiters[id_command]
+        except Exception as e:
+            print(f"[!] Failed to expire unlock commands: {e}")
+
+
+async def requeue_pending_commands():
+    """Queues commands left unclaimed, e.g. by a worker that restarted"""
+    async with db():
+        query = select(UnlockCommand.id).where(
+            UnlockCommand.status == CommandStatus.queued
+        )
+
+        response = await db.session.execute(query)
+
+        for id_command in response.scalars().all():
+            await command_queue.put(id_command)
+
+
+async def start_command_workers():
+    for _ in range(get_settings().unlock_command_workers):
+        command_workers.append(asyncio.create_task(_command_worker()))
+
+    command_workers.append(asyncio.create_task(_command_janitor()))
+
+    await requeue_pending_commands()
@@ -0,0 +1,81 @@
+from typing import Optional
+from uuid import UUID
+
+from auth.cognito import get_current_org, get_current_username, get_permission
+from auth.user import get_current_user, get_current_user_id_org
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi_async_sqlalchemy import db
+from pydantic import confloat
+from sqlalchemy import select
+
+from ..device.controller import get_mobile_unlock_device
+from ..device.model import Device
+from ..member.model import RoleType
+from . import controller
+from .model import UnlockCommand
+
+router = APIRouter(tags=["commands"])
+
+
+@router.post(
+    "/partner/devices/{id_device}/unlock-command", response_model=UnlockCommand.Read
+)
+async def partner_unlock_device_command(
+    id_device: UUID,
+    wait: confloat(ge=0, le=30) = 0,
+    current_org: UUID = Depends(get_current_org),
+    permission: RoleType = Depends(get_permission),
+    member_name: Optional[str] = Depends(get_current_username),
+):
+    """Queue an unlock, optionally waiting up to `wait` seconds for the lock to confirm"""
+    if permission not in [RoleType.admin, RoleType.member, RoleType.operator]:
+        raise HTTPException(
+            status_code=403,
+            detail="Not enough permissions, must be admin, member or operator",
+        )
+
+    query = select(Device).where(Device.id == id_device, Device.id_org == current_org)
+
+    response = await db.session.execute(query)
+    device = response.unique().scalar_one()  # raises NoResultFound
+
+    command = await controller.enqueue_unlock(device, current_org, member_name)
+
+    return await controller.wait_for_command(command.id, current_org, wait)
+
+
+@router.get("/partner/commands/{id_command}", response_model=UnlockCommand.Read)
+async def partner_get_command(
+    id_command: UUID,
+    timeout: confloat(ge=0, le=30) = 0,
+    current_org: UUID = Depends(get_current_org),
+):
+    """Get an unlock command, long-polling up to `timeout` seconds for a final status"""
+    return await controller.wait_for_command(id_command, current_org, timeout)
+
+
+@router.post(
+    "/mobile/device/unlock-command/{id_event}", response_model=UnlockCommand.Read
+)
+async def mobile_unlock_device_command(
+    id_event: UUID,
+    wait: confloat(ge=0, le=30) = 0,
+    id_org: UUID = Depends(get_current_user_id_org),
+    id_user: UUID = Depends(get_current_user),
+):
+    """Queue an unlock of the device in an event, optionally waiting for the lock to confirm"""
+    device = await get_mobile_unlock_device(id_event, id_org, id_user)
+
+    command = await controller.enqueue_unlock(device, id_org)
+
+    return await controller.wait_for_command(command.id, id_org, wait)
+
+
+@router.get("/mobile/commands/{id_command}", response_model=UnlockCommand.Read)
+async def mobile_get_command(
+    id_command: UUID,
+    timeout: confloat(ge=0, le=30) = 0,
+    id_org: UUID = Depends(get_current_user_id_org),
+):
+    """Get an unlock command, long-polling up to `timeout` seconds for a final status"""
+    return await controller.wait_for_command(id_command, id_org, timeout)
@@ -0,0 +1,79 @@
+from datetime import datetime
+from enum import Enum
+from typing import Optional
+from uuid import UUID
+
+from pydantic import BaseModel
+from sqlalchemy import Column, DateTime, func
+from sqlmodel import Field, SQLModel
+from sqlmodel.sql.sqltypes import GUID
+
+from ..device.model import HardwareType
+
+
+class CommandStatus(Enum):
+    queued = "queued"  # persisted, waiting for a worker
+    dispatched = "dispatched"  # sent to the vendor, waiting for confirmation
+    acknowledged = "acknowledged"  # the lock confirmed it opened
+    failed = "failed"
+    timed_out = "timed_out"
+
+
+FINAL_COMMAND_STATUSES = [
+    CommandStatus.acknowledged,
+    CommandStatus.failed,
+    CommandStatus.timed_out,
+]
+
+
+class UnlockCommand(SQLModel, table=True):
+    __tablename__ = "unlock_command"
+
+    id: UUID = Field(
+        sa_column=Column(
+            "id",
+            GUID(),
+            server_default=func.gen_random_uuid(),
+            unique=True,
+            primary_key=True,
+        )
+    )
+    created_at: datetime = Field(
+        sa_column=Column(
+            "created_at",
+            DateTime(timezone=True),
+            server_default=func.current_timestamp(),
+            nullable=False,
+        )
+    )
+    dispatched_at: Optional[datetime] = Field(
+        sa_column=Column("dispatched_at", DateTime(timezone=True), nullable=True)
+    )
+    acknowledged_at: Optional[datetime] = Field(
+        sa_column=Column("acknowledged_at", DateTime(timezone=True), nullable=True)
+    )
+
+    status: CommandStatus = Field(default=CommandStatus.queued)
+    hardware_type: HardwareType
+    log_owner: Optional[str] = Field(nullable=True)
+    # Vendor side identifier of the command, e.g. the Linka command_id
+    vendor_ref: Optional[str] = Field(nullable=True)
+    error: Optional[str] = Field(nullable=True)
+
+    id_org: UUID = Field(foreign_key="org.id")
+    id_device: UUID = Field(foreign_key="device.id")
+
+    class Read(BaseModel):
+        id: UUID
+        created_at: datetime
+        dispatched_at: Optional[datetime]
+        acknowledged_at: Optional[datetime]
+
+        status: CommandStatus
+        hardware_type: HardwareType
+        error: Optional[str]
+
+        id_device: UUID
+
+        # Time from the request to the lock confirming it opened
+        latency_ms: Optional[float]
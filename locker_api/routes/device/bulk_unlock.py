@@ -0,0 +1,278 @@
+import asyncio
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+from uuid import UUID, uuid4
+
+import httpx
+from config import get_settings
+from fastapi import HTTPException
+from fastapi_async_sqlalchemy import db
+from gmqtt import Client as MQTTClient
+from integrations import gantner, keynius, linka, spintly
+from integrations.token_broker import token_broker
+from sqlalchemy import case, insert, select, update
+
+from ..event.model import Event, EventStatus
+from ..logger.model import Log, LogType
+from ..webhook.controller import send_payload
+from ..webhook.model import EventChange
+from .model import Device, HardwareType, LockStatus, Mode, UnlockResult
+
+# Maximum number of vendor calls in flight at once, per hardware vendor
+VENDOR_CONCURRENCY = {
+    HardwareType.linka: 4,
+    HardwareType.spintly: 4,
+    HardwareType.keynius: 4,
+    HardwareType.gantner: 8,
+    HardwareType.dclock: 4,  # terminals, every box of a terminal shares one call
+}
+
+ACTIVE_EVENT_STATUSES = [
+    EventStatus.awaiting_payment_confirmation,
+    EventStatus.awaiting_service_pickup,
+    EventStatus.awaiting_service_dropoff,
+    EventStatus.awaiting_user_pickup,
+    EventStatus.in_progress,
+]
+
+
+async def send_linka_unlock(device: Device):
+    return await token_broker.call(
+        "linka",
+        lambda token: linka.unlock(token=token, mac_addr=device.mac_address),
+    )
+
+
+async def send_spintly_unlock(device: Device):
+    async def activate(token):
+        async with httpx.AsyncClient() as client:
+            return await spintly.activate(
+                client=client,
+                token=token,
+                access_point_id=device.integration_id,
+            )
+
+    return await token_broker.call("spintly", activate)
+
+
+async def send_keynius_unlock(device: Device):
+    return await token_broker.call(
+        "keynius",
+        lambda token: keynius.unlock(token=token, locker_id=device.keynius_id),
+    )
+
+
+async def send_gantner_unlock(device: Device):
+    if device.lock_status == LockStatus.offline:
+        raise HTTPException(
+            status_code=400,
+            detail="Cannot unlock device, device is offline",
+        )
+
+    if device.lock_status != LockStatus.locked:
+        return
+
+    await gantner.unlock(device.gantner_id)
+
+
+async def send_dclock_unlock(terminal_no: str, devices: List[Device]):
+    settings = get_settings()
+
+    client = MQTTClient(str(uuid4()))
+
+    client.set_auth_credentials(settings.mqtt_user, settings.mqtt_pass)
+    await client.connect(settings.mqtt_host, settings.mqtt_port, True)
+
+    for device in devices:
+        client.publish(f"{terminal_no}/cmd", device.dclock_box_no)
+
+    await client.disconnect()
+
+
+async def _toggle_virtual_devices(devices: List[Device]):
+    if not devices:
+        return
+
+    query = (
+        update(Device)
+        .where(Device.id.in_([device.id for device in devices]))
+        .values(
+            lock_status=case(
+                (Device.lock_status == LockStatus.locked, LockStatus.open),
+                else_=LockStatus.locked,
+            )
+        )
+    )
+
+    await db.session.execute(query)
+    await db.session.commit()
+
+
+async def _release_delivery_events(devices: List[Device], id_org: UUID):
+    """TRAX FP flow: unlocking a delivery device completes its dropoff"""
+    delivery_ids = [device.id for device in devices if device.mode == Mode.delivery]
+
+    if not delivery_ids:
+        return
+
+    query = (
+        update(Event)
+        .where(
+            Event.id_device.in_(delivery_ids),
+            Event.event_status == EventStatus.awaiting_service_dropoff,
+        )
+        .values(event_status=EventStatus.awaiting_user_pickup)
+        .returning(Event)
+    )
+
+    response = await db.session.execute(query)
+    await db.session.commit()
+
+    for event in response.all():
+        await send_payload(
+            id_org,
+            EventChange(
+                id_org=event.id_org,
+                id_event=event.id,
+                event_status=EventStatus.awaiting_user_pickup,
+                event_obj=event,
+            ),
+        )
+
+
+async def _log_unlocks(devices: List[Device], id_org: UUID, log_owner: str):
+    if not devices:
+        return
+
+    query = select(Event.id_device, Event.id).where(
+        Event.id_device.in_([device.id for device in devices]),
+        Event.event_status.in_(ACTIVE_EVENT_STATUSES),
+    )
+
+    response = await db.session.execute(query)
+    active_events = {}
+    for id_device, id_event in response.all():
+        active_events.setdefault(id_device, id_event)
+
+    query = insert(Log).values(
+        [
+            {
+                "id_org": id_org,
+                "id_device": device.id,
+                "log_type": LogType.unlock,
+                "log_owner": log_owner,
+                "id_event": active_events.get(device.id),
+            }
+            for device in devices
+        ]
+    )
+
+    await db.session.execute(query)
+    await db.session.commit()
+
+
+async def bulk_unlock_devices(
+    devices: List[Device],
+    id_org: UUID,
+    member_name: Optional[str] = None,
+) -> List[UnlockResult]:
+    """Unlocks a set of already loaded devices concurrently
+
+    Vendor calls run in parallel, capped per vendor by VENDOR_CONCURRENCY.
+    DClock boxes are grouped by terminal so each terminal gets a single
+    MQTT session, virtual devices are toggled in one UPDATE and the unlock
+    logs are written in one INSERT.
+
+    Args:
+        devices (List[Device]): devices to unlock, all belonging to id_org
+        id_org (UUID): id of the organization
+        member_name (str, optional): name written as owner of the logs
+
+    Returns:
+        List[UnlockResult]: one result per device, with the time it took
+    """
+    await _release_delivery_events(devices, id_org)
+    await _log_unlocks(devices, id_org, member_name if member_name else "API")
+
+    results: Dict[UUID, UnlockResult] = {}
+    by_vendor: Dict[HardwareType, List[Device]] = defaultdict(list)
+
+    for device in devices:
+        by_vendor[device.hardware_type].append(device)
+
+    async def run(semaphore: asyncio.Semaphore, batch: List[Device], unlock):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await unlock()
+                status, error = "unlocked", None
+            except HTTPException as e:
+                status, error = "failed", e.detail
+            except Exception as e:
+                status, error = "failed", str(e)
+            elapsed_ms = (time.perf_counter() - start) * 1000
+
+        for device in batch:
+            results[device.id] = UnlockResult(
+                id=device.id, status=status, error=error, elapsed_ms=elapsed_ms
+            )
+
+    tasks = []
+    semaphores = {
+        vendor: asyncio.Semaphore(limit) for vendor, limit in VENDOR_CONCURRENCY.items()
+    }
+
+    for vendor, vendor_devices in by_vendor.items():
+        match vendor:
+            case HardwareType.linka:
+                unlock = send_linka_unlock
+            case HardwareType.spintly:
+                unlock = send_spintly_unlock
+            case HardwareType.keynius:
+                unlock = send_keynius_unlock
+            case HardwareType.gantner:
+                unlock = send_gantner_unlock
+            case HardwareType.dclock:
+                terminals = defaultdict(list)
+                for device in vendor_devices:
+                    terminals[device.dclock_terminal_no].append(device)
+
+                for terminal_no, boxes in terminals.items():
+                    tasks.append(
+                        run(
+                            semaphores[vendor],
+                            boxes,
+                            lambda t=terminal_no, b=boxes: send_dclock_unlock(t, b),
+                        )
+                    )
+                continue
+            case HardwareType.virtual:
+                tasks.append(
+                    run(
+                        asyncio.Semaphore(1),
+                        vendor_devices,
+                        lambda d=vendor_devices: _toggle_virtual_devices(d),
+                    )
+                )
+                continue
+            case HardwareType.harbor:
+                # Harbor lockers are opened by the mobile SDK
+                for device in vendor_devices:
+                    results[device.id] = UnlockResult(id=device.id, status="unlocked")
+                continue
+            case _:
+                for device in vendor_devices:
+                    results[device.id] = UnlockResult(
+                        id=device.id, status="failed", error="Unsupported command"
+                    )
+                continue
+
+        for device in vendor_devices:
+            tasks.append(
+                run(semaphores[vendor], [device], lambda d=device, u=unlock: u(d))
+            )
+
+    await asyncio.gather(*tasks)
+
+    return [results[device.id] for device in devices]
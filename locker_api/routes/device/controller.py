@@ -1,26 +1,23 @@
-import json
 import random
 from math import ceil
 from typing import List, Optional, Union
 from uuid import UUID, uuid4
 
-import httpx
 from gmqtt import Client as MQTTClient
 from fastapi import HTTPException, UploadFile
 from fastapi_async_sqlalchemy import db
-from integrations import gantner, keynius, linka, spintly
+from integrations import gantner
 from pydantic import conint
 from sqlalchemy import VARCHAR, cast, delete, insert, not_, or_, select, update, and_
 from sqlalchemy.exc import MultipleResultsFound
 from util.images import ImagesService
+from util.realtime import realtime_hub, resource_fields
 
 
 from ..event.model import Event, EventStatus, EventType
 from ..groups.controller import (
     assign_group_to_resource,
     assign_user_to_resource,
-    get_groups_from_resource,
-    get_users_from_resource,
     get_group_by_name,
 )
 from ..groups.model import AssignmentType, ResourceType
@@ -33,48 +30,72 @@ from ..products.controller import track_product, get_products
 from ..organization.controller import get_org
 from ..webhook.controller import send_payload
 from ..webhook.model import EventChange
-from ..groups.controller import (
-    is_device_assigned_to_user,
-    is_resource_in_group,
-    is_resource_in_pseudo_group,
-)
+from ..groups.access import visible_to
+from ..groups.controller import get_accessible_devices, get_restrictions
 from ..logger.controller import add_to_logger
 from ..logger.model import LogType
+from .bulk_unlock import (
+    bulk_unlock_devices,
+    send_keynius_unlock,
+    send_linka_unlock,
+    send_spintly_unlock,
+)
 from .link_device_price import LinkDevicePrice
 from .model import (
+    BulkUnlockResponse,
     Device,
     HardwareType,
     Mode,
     PaginatedDevices,
     Status,
     LockStatus,
-    RestrictionType,
-    Restriction,
 )
-from .connections import active_connections
 from config import get_settings
 
 
-async def broadcast_event(id_device: UUID, action_type: str, id_org: UUID):
-    try:
-        query = select(Device).where(Device.id == id_device, Event.id_org == id_org)
-        data = await db.session.execute(query)
-        device = data.unique().scalar_one_or_none()
-
-        if not device:
-            return
+async def broadcast_event(
+    id_device: UUID,
+    action_type: str,
+    id_org: UUID,
+    device=None,
+):
+    """Publishes the fields of the device that changed since the last message
 
-        device = Device.Read.parse_obj(device)
-        device = device.json(exclude_none=True)
+    Pass the device returned by the transition to skip the database lookup.
+    """
+    try:
+        if device is None:
+            query = select(*Device.__table__.columns).where(
+                Device.id == id_device, Device.id_org == id_org
+            )
+            data = await db.session.execute(query)
+            device = data.one_or_none()
 
-        payload = {"type": action_type, "device": json.loads(device)}
+            if not device:
+                return
 
-        if id_org in active_connections:
-            await active_connections[id_org].send_json(payload)
+        await realtime_hub.publish_delta(
+            "devices",
+            id_org,
+            id_device,
+            action_type,
+            resource_fields(device, Device.__table__),
+        )
     except Exception:
         return
 
 
+async def resync_device(id_device: UUID, id_org: UUID):
+    # Read the version first, a newer device only re-applies later deltas
+    version = await realtime_hub.get_version("devices", id_device)
+
+    query = select(Device).where(Device.id == id_device, Device.id_org == id_org)
+    data = await db.session.execute(query)
+    device = data.unique().scalar_one()  # raises NoResultFound
+
+    return {"version": version, "device": device}
+
+
 async def get_devices(
     page: conint(gt=0),
     size: conint(gt=0),
@@ -169,17 +190,12 @@ async def get_devices(
 
     total_count = len(total.unique().all())
 
-    response = []
-    for entry in data.unique().scalars().all():
-        response.append(await eval_restriction(entry, id_org))
+    response = await eval_restrictions(data.unique().scalars().all(), id_org)
 
     # * Filter devices if user is assigned to them
     if from_user:
-        response = [
-            device
-            for device in response
-            if await is_device_assigned_to_user(device.id, from_user)
-        ]
+        accessible = await get_accessible_devices(response, from_user)
+        response = [device for device in response if device.id in accessible]
 
     return PaginatedDevices(
         items=response,
@@ -292,6 +308,9 @@ async def mobile_get_devices(
     if id_location:
         query = query.where(Device.id_location == id_location)
 
+    # * Filter devices if user is assigned to them
+    query = query.where(visible_to(id_user))
+
     count = query
     query = (
         query.limit(size).offset((page - 1) * size).order_by(Device.created_at.desc())
@@ -300,20 +319,8 @@ async def mobile_get_devices(
     data = await db.session.execute(query)
     total = await db.session.execute(count)
 
-    total_count = len(
-        [
-            entry
-            for entry in total.unique().scalars().all()
-            if await is_device_assigned_to_user(entry.id, id_user)
-        ]
-    )
-
-    # * Filter devices if user is assigned to them
-    items = [
-        device
-        for device in data.unique().scalars().all()
-        if await is_device_assigned_to_user(device.id, id_user)
-    ]
+    total_count = len(total.unique().scalars().all())
+    items = data.unique().scalars().all()
 
     return PaginatedDevices(
         items=items,
@@ -1048,34 +1055,19 @@ async def validate_device_hardware(
 
 
 async def linka_unlock(device: Device):
-    token = await linka.get_token()
-
-    await linka.test_token(token)
-    await linka.unlock(token=token, mac_addr=device.mac_address)
+    await send_linka_unlock(device)
 
     return {"detail": "Unlock message sent to Linka device"}
 
 
 async def spintly_unlock(device: Device):
-    async with httpx.AsyncClient() as client:
-        token = await spintly.get_token(client)
-
-        await spintly.activate(
-            client=client,
-            token=token,
-            access_point_id=device.integration_id,
-        )
+    await send_spintly_unlock(device)
 
     return {"detail": "Unlock message sent to Spintly device"}
 
 
 async def keynius_unlock(device: Device):
-    client = await keynius.get_client()
-
-    await keynius.unlock(
-        token=client["accessToken"],
-        locker_id=device.keynius_id,
-    )
+    await send_keynius_unlock(device)
 
     return {"detail": "Unlock message sent to Keynius device"}
 
@@ -1215,20 +1207,12 @@ async def partner_unlock_devices(
     response = await db.session.execute(query)
     devices = response.unique().scalars().all()
 
-    unlock_results = []
-    for device_record in devices:
-        try:
-            await partner_unlock_device(device_record.id, id_org, False, member_name)
-            unlock_results.append({"id": device_record.id, "status": "unlocked"})
-        except Exception as e:
-            unlock_results.append(
-                {"id": device_record.id, "status": "failed", "error": str(e)}
-            )
+    results = await bulk_unlock_devices(devices, id_org, member_name)
 
-    return {
-        "detail": "Unlock message sent to selected devices",
-        "results": unlock_results,
-    }
+    return BulkUnlockResponse(
+        detail="Unlock message sent to selected devices",
+        results=results,
+    )
 
 
 async def partner_unlock_device(
@@ -1320,11 +1304,11 @@ async def partner_unlock_device(
             )
 
 
-async def mobile_unlock_device(
+async def get_mobile_unlock_device(
     id_event: UUID,
     id_org: UUID,
     id_user: UUID,
-):
+) -> Device:
     query = (
         select(Event, Device)
         .where(
@@ -1367,19 +1351,29 @@ async def mobile_unlock_device(
             detail=f"Cannot unlock device with event status {event.Event.event_status}",
         )
 
-    await add_to_logger(id_org, event.Device.id, LogType.unlock, "API")
+    return event.Device
+
 
-    match event.Device.hardware_type:
+async def mobile_unlock_device(
+    id_event: UUID,
+    id_org: UUID,
+    id_user: UUID,
+):
+    device = await get_mobile_unlock_device(id_event, id_org, id_user)
+
+    await add_to_logger(id_org, device.id, LogType.unlock, "API")
+
+    match device.hardware_type:
         case HardwareType.linka:
-            return await linka_unlock(event.Device)
+            return await linka_unlock(device)
         case HardwareType.spintly:
-            return await spintly_unlock(event.Device)
+            return await spintly_unlock(device)
         case HardwareType.gantner:
-            return await gantner_unlock(event.Device)
+            return await gantner_unlock(device)
         case HardwareType.keynius:
-            return await keynius_unlock(event.Device)
+            return await keynius_unlock(device)
         case HardwareType.dclock:
-            return await dclock_unlock(event.Device)
+            return await dclock_unlock(device)
         case HardwareType.virtual:
             return {"detail": "Virtual device unlocked"}
         case _:
@@ -1601,25 +1595,19 @@ async def check_device_unique(
             )
 
 
-async def eval_restriction(entry, id_org: UUID):
-    device = Device.Read.parse_obj(entry)
+async def eval_restrictions(entries, id_org: UUID) -> List[Device.Read]:
+    """Devices with their restriction, resolved for the whole page at once"""
+    devices = [Device.Read.parse_obj(entry) for entry in entries]
 
-    in_group = await is_resource_in_group(device.id, ResourceType.device)
-    in_users = await is_resource_in_pseudo_group(device.id, ResourceType.device)
+    restrictions = await get_restrictions(
+        [device.id for device in devices], ResourceType.device, id_org
+    )
 
-    if in_users:
-        device.restriction = Restriction(
-            restriction_type=RestrictionType.users,
-            items=await get_users_from_resource(device.id, ResourceType.device, id_org),
-        )
-    elif in_group:
-        device.restriction = Restriction(
-            restriction_type=RestrictionType.groups,
-            items=await get_groups_from_resource(
-                device.id, ResourceType.device, id_org
-            ),
-        )
-    else:
-        device.restriction = None
+    for device in devices:
+        device.restriction = restrictions.get(device.id)
 
-    return device
+    return devices
+
+
+async def eval_restriction(entry, id_org: UUID):
+    return (await eval_restrictions([entry], id_org))[0]
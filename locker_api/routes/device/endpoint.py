@@ -13,14 +13,16 @@ from fastapi import (
     Depends,
     File,
     Form,
+    Header,
     HTTPException,
+    Request,
     UploadFile,
     WebSocket,
-    WebSocketDisconnect,
 )
 from pydantic import conint
 from util.csv import process_csv_upload
 from util.images import ImagesService
+from util.realtime import realtime_hub
 
 from util.response import BasicResponse
 
@@ -30,27 +32,43 @@ from ..organization.controller import is_sub_org
 from . import controller
 from ..logger.controller import get_device_logs
 from ..logger.model import Log
-from .model import Device, HardwareType, Mode, PaginatedDevices, Status, LockStatus
-from .connections import active_connections
+from .model import (
+    BulkUnlockResponse,
+    Device,
+    DeviceResync,
+    HardwareType,
+    Mode,
+    PaginatedDevices,
+    Status,
+    LockStatus,
+)
 
 router = APIRouter(tags=["devices"])
 
 
 @router.websocket("/devices/listener/{orgId}")
 async def websocket_endpoint(websocket: WebSocket, orgId: UUID):
-    await websocket.accept()
+    # Every tab of the org gets its own subscription
+    await realtime_hub.serve(websocket, "devices", orgId)
+
 
-    # Simply register the websocket connection.
-    active_connections[orgId] = websocket
+@router.get("/partner/devices/stream")
+async def stream_endpoint(
+    request: Request,
+    last_event_id: Optional[str] = Header(default=None),
+    current_org: UUID = Depends(get_current_org),
+):
+    """Server-Sent Events feed of the org, reconnecting clients replay from Last-Event-ID"""
+    return realtime_hub.sse_response(request, "devices", current_org, last_event_id)
 
-    try:
-        while True:
-            # Waiting for the data from the connected WebSocket.
-            await websocket.receive_text()
 
-    except WebSocketDisconnect:
-        # If the connection is closed, remove it from the active connections.
-        del active_connections[orgId]
+@router.get("/partner/devices/{id_device}/resync", response_model=DeviceResync)
+async def partner_resync_device(
+    id_device: UUID,
+    current_org: UUID = Depends(get_current_org),
+):
+    """Get the full device and its realtime version, for listeners that missed a delta"""
+    return await controller.resync_device(id_device, current_org)
 
 
 @router.get("/mobile/devices", response_model=PaginatedDevices | Device.Read)
@@ -210,7 +228,7 @@ async def create_device(
         id_prices,
     )
 
-    await controller.broadcast_event(device.id, "create", current_org)
+    await controller.broadcast_event(device.id, "create", current_org, device)
 
     return device
 
@@ -265,7 +283,7 @@ async def update_device(
         id_device, current_org, device, image, images_service, id_prices, member_name
     )
 
-    await controller.broadcast_event(device.id, "update", current_org)
+    await controller.broadcast_event(device.id, "update", current_org, device)
 
     return device
 
@@ -292,7 +310,7 @@ async def patch_device(
         id_device, current_org, device, False, member_name
     )
 
-    await controller.broadcast_event(device.id, "update", current_org)
+    await controller.broadcast_event(device.id, "update", current_org, device)
 
     return device
 
@@ -332,7 +350,7 @@ async def delete_devices(
     return result
 
 
-@router.patch("/partner/devices/unlock", response_model=BasicResponse)
+@router.patch("/partner/devices/unlock", response_model=BulkUnlockResponse)
 async def unlock_devices(
     device_list: List[UUID],
     current_org: UUID = Depends(get_current_org),
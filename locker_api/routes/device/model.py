@@ -1,6 +1,6 @@
 from datetime import datetime
 from enum import Enum
-from typing import Optional
+from typing import List, Optional
 from uuid import UUID
 
 from pydantic import BaseModel, condecimal, constr
@@ -493,6 +493,24 @@ class PaginatedDevices(BaseModel):
     pages: int
 
 
+class DeviceResync(BaseModel):
+    # Realtime version the device is current with
+    version: int
+    device: Device.Read
+
+
+class UnlockResult(BaseModel):
+    id: UUID
+    status: str  # unlocked, failed
+    error: Optional[str]
+    elapsed_ms: Optional[float]
+
+
+class BulkUnlockResponse(BaseModel):
+    detail: str
+    results: List[UnlockResult]
+
+
 class PublicDevice(BaseModel):
     name: str
     custom_identifier: Optional[str]
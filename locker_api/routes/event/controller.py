@@ -1,4 +1,3 @@
-import json
 import threading
 import re
 from apscheduler.jobstores.base import JobLookupError
@@ -18,6 +17,7 @@ from fastapi_async_sqlalchemy import db
 from payments.stripe import (
     create_ephemeral_key,
     create_setup_intent,
+    get_default_currency,
     get_stripe_account,
 )
 from pydantic import conint, constr
@@ -26,6 +26,7 @@ from sqlalchemy.exc import NoResultFound
 from twilio.rest import Client
 from util import email
 from util.images import ImagesService
+from util.realtime import realtime_hub, resource_fields
 
 from util.response import Message
 from util.scheduler import scheduler
@@ -46,6 +47,7 @@ from ..location.controller import get_location_by_external_id
 from ..memberships.controller import cancel_subscription, get_user_membership
 from ..memberships.model import Membership, MembershipType
 from ..notifications.controller import create_notify_job_on_event
+from ..notifications.digest import notification_digest
 from ..notifications.model import NotificationType
 from ..organization.controller import (
     get_org_name,
@@ -74,7 +76,6 @@ from ..user.controller import (
 from ..user.model import Channel, User
 from ..webhook.controller import send_payload
 from ..webhook.model import EventChange
-from .connections import active_connections
 from .model import (
     Event,
     EventStatus,
@@ -98,22 +99,34 @@ class ServiceStep(Enum):
     dropoff = "dropoff"
 
 
-async def broadcast_event(id_event: UUID, action_type: str, id_org: UUID):
-    try:
-        query = select(Event).where(Event.id == id_event, Event.id_org == id_org)
-        data = await db.session.execute(query)
-        event = data.unique().scalar_one_or_none()
-
-        if not event:
-            return
+async def broadcast_event(
+    id_event: UUID,
+    action_type: str,
+    id_org: UUID,
+    event=None,
+):
+    """Publishes the fields of the event that changed since the last message
 
-        event = Event.Read.parse_obj(event)
-        event = event.json(exclude_none=True)
+    Pass the event returned by the transition to skip the database lookup.
+    """
+    try:
+        if event is None:
+            query = select(*Event.__table__.columns).where(
+                Event.id == id_event, Event.id_org == id_org
+            )
+            data = await db.session.execute(query)
+            event = data.one_or_none()
 
-        payload = {"type": action_type, "event": json.loads(event)}
+            if not event:
+                return
 
-        if id_org in active_connections:
-            await active_connections[id_org].send_json(payload)
+        await realtime_hub.publish_delta(
+            "events",
+            id_org,
+            id_event,
+            action_type,
+            resource_fields(event, Event.__table__),
+        )
     except Exception:
         return
 
@@ -125,6 +138,14 @@ async def get_event(id_event: UUID, id_org: UUID) -> Event.Read:
     return data.unique().scalar_one()  # raises NoResultFound
 
 
+async def resync_event(id_event: UUID, id_org: UUID):
+    # Read the version first, a newer event only re-applies later deltas
+    version = await realtime_hub.get_version("events", id_event)
+    event = await get_event(id_event, id_org)
+
+    return {"version": version, "event": event}
+
+
 async def get_event_by_device(id_device: UUID, id_org: UUID):
     query = select(Event).where(
         Event.id_device == id_device,
@@ -330,15 +351,14 @@ async def mobile_confirm_event(
 
     if event.event_type == EventType.vending:
         if event.device.product.price:
-            account = await stripe.Account.retrieve(stripe_account_id)
             payment = await stripe.PaymentIntent.create(
                 amount=int(event.device.product.price * 100),
-                currency=account.default_currency or "usd",
+                currency=await get_default_currency(id_org),
                 customer=customer,
                 payment_method=setup.payment_method,
                 confirm=True,
                 off_session=True,
-                stripe_account=stripe_account_id,
+                stripe_account=await get_stripe_account(id_org),
             )
 
             if payment.status != "succeeded":
@@ -383,6 +403,8 @@ async def mobile_confirm_event(
             started_at=datetime.utcnow(),
             event_status=event_status,
             total=payment.amount / 100 if payment else None,
+            # Confirmed events are no longer canceled by the expiry sweeper
+            expires_at=None,
         )
         .returning(Event)
     )
@@ -419,12 +441,6 @@ async def mobile_confirm_event(
         ),
     )
 
-    try:
-        # remove scheduled job for event
-        scheduler.remove_job(str(id_event))
-    except Exception:
-        pass
-
     # Track product usage
     if event.device.product:
         await track_product(
@@ -531,11 +547,11 @@ async def partner_penalize_event(
     customer = await stripe.Customer.retrieve(
         customer_id, stripe_account=stripe_account_id
     )
-    account = await stripe.Account.retrieve(stripe_account_id)
+    currency = await get_default_currency(id_org)
     try:
         await stripe.PaymentIntent.create(
             amount=int(amount * 100),
-            currency=account.default_currency or "usd",
+            currency=currency,
             customer=customer.id,
             payment_method=customer.invoice_settings.default_payment_method,
             confirm=True,
@@ -552,7 +568,7 @@ async def partner_penalize_event(
         client.messages.create(
             to=event.user.phone_number,
             from_=get_settings().twilio_messaging_service_sid,
-            body=f"You have been charged {amount} {account.default_currency.upper() or 'USD'} for a misuse of our service, reason: {reason.value.replace('_', ' ')}. Please contact support for more information",
+            body=f"You have been charged {amount} {currency.upper()} for a misuse of our service, reason: {reason.value.replace('_', ' ')}. Please contact support for more information",
         )
     if event.user.email:
         email_sender = await get_org_sendgrid_auth_sender(event.id_org)
@@ -561,7 +577,7 @@ async def partner_penalize_event(
             email_sender,
             event.user.email,
             "Service Misuse",
-            f"You have been charged {amount} {account.default_currency.upper() or 'USD'} for a misuse of our service, reason: {reason.value.replace('_', ' ')}. Please contact support for more information",
+            f"You have been charged {amount} {currency.upper()} for a misuse of our service, reason: {reason.value.replace('_', ' ')}. Please contact support for more information",
             is_ups_org=await is_ups_org(event.id_org),
         )
 
@@ -820,6 +836,12 @@ async def mobile_start_event(
         id_promo=promo.id if promo else None,
         order_id=order_id,
         refunded_amount=0,
+        # cancel the event after 5 minutes unless confirmed, except deliveries
+        expires_at=(
+            datetime.utcnow() + timedelta(minutes=5)
+            if device.mode != Mode.delivery
+            else None
+        ),
     )
 
     query = insert(Event).values(new_event.dict()).returning(Event)
@@ -865,17 +887,6 @@ async def mobile_start_event(
         ),
     )
 
-    # start event timer to cancel event after 5 minutes, unless it's a delivery
-    if device.mode != Mode.delivery:
-        scheduler.add_job(
-            partner_cancel_event,
-            "date",
-            run_date=datetime.utcnow() + timedelta(minutes=5),
-            args=[event.id_org, event.id],
-            id=str(event.id),
-            replace_existing=True,
-        )
-
     if device.mode == Mode.delivery:
         await create_notify_job_on_event(event.id, NotificationType.on_start)
 
@@ -2153,6 +2164,15 @@ async def partner_start_storage(
 
     invoice_id = await generate_invoice_id(id_org)
 
+    # the event is canceled once the duration elapses
+    end_date = None
+    if duration:
+        end_date = datetime.utcnow() + timedelta(
+            hours=duration.hours or 0,
+            days=duration.days or 0,
+            weeks=duration.weeks or 0,
+        )
+
     new_event = Event(
         payment_intent_id=None,
         invoice_id=invoice_id,
@@ -2166,6 +2186,7 @@ async def partner_start_storage(
         id_user=user.id if user else None,
         id_device=device.id,
         passcode=passcode if passcode else None,
+        expires_at=end_date,
     )
 
     query = insert(Event).values(new_event.dict()).returning(Event)
@@ -2190,22 +2211,6 @@ async def partner_start_storage(
     response = await db.session.execute(query)
     data = response.unique().scalar_one()
 
-    if duration:
-        end_date = datetime.utcnow()
-        end_date = end_date + timedelta(
-            hours=duration.hours or 0,
-            days=duration.days or 0,
-            weeks=duration.weeks or 0,
-        )
-        scheduler.add_job(
-            func=partner_cancel_event,
-            trigger="date",
-            run_date=end_date,
-            args=[id_org, data.id],
-            id=str(data.id),
-            replace_existing=True,
-        )
-
     await create_notify_job_on_event(data.id, NotificationType.on_start)
 
     return data
@@ -2223,28 +2228,30 @@ async def partner_start_storage_batch(
     responses = []
     errors = []
 
-    for id_size in id_sizes:
-        try:
-            data = await partner_start_storage(
-                id_size,
-                None,
-                id_location,
-                None,
-                id_org,
-                id_user,
-                None,
-                from_user,
-                duration,
-                None,
-            )
-            responses.append(data)
-        except Exception as e:
-            errors.append(e)
+    async with notification_digest() as digest:
+        for id_size in id_sizes:
+            try:
+                data = await partner_start_storage(
+                    id_size,
+                    None,
+                    id_location,
+                    None,
+                    id_org,
+                    id_user,
+                    None,
+                    from_user,
+                    duration,
+                    None,
+                )
+                responses.append(data)
+            except Exception as e:
+                errors.append(e)
 
     return {
         "detail": f"{len(responses)}/{sizes} transactions were created",
         "items": responses,
         "err": errors,
+        "notifications": digest.outcomes,
     }
 
 
@@ -2494,31 +2501,41 @@ async def partner_complete_delivery_batch(
     id_org: UUID,
 ):
     resp = []
-    for code in codes:
-        try:
-            resp.append(
-                {
-                    "status_code": 200,
-                    "event_code": code,
-                    "response": await complete_delivery(code, None, None, id_org),
-                }
-            )
-        except HTTPException as e:
-            resp.append(
-                {
-                    "status_code": e.status_code,
-                    "event_code": code,
-                    "response": e.detail,
-                }
-            )
-        except Exception as e:
-            resp.append(
-                {
-                    "status_code": 500,
-                    "event_code": code,
-                    "response": e,
-                }
-            )
+    async with notification_digest() as digest:
+        for code in codes:
+            try:
+                resp.append(
+                    {
+                        "status_code": 200,
+                        "event_code": code,
+                        "response": await complete_delivery(code, None, None, id_org),
+                    }
+                )
+            except HTTPException as e:
+                resp.append(
+                    {
+                        "status_code": e.status_code,
+                        "event_code": code,
+                        "response": e.detail,
+                    }
+                )
+            except Exception as e:
+                resp.append(
+                    {
+                        "status_code": 500,
+                        "event_code": code,
+                        "response": e,
+                    }
+                )
+
+    # Attach the notifications sent for each completed delivery
+    for item in resp:
+        if item["status_code"] == 200:
+            item["notifications"] = [
+                outcome
+                for outcome in digest.outcomes
+                if item["response"].id in outcome.id_events
+            ]
 
     return resp
 
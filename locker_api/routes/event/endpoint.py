@@ -10,14 +10,15 @@ from fastapi import (
     Body,
     Depends,
     File,
+    Header,
     HTTPException,
     Request,
     UploadFile,
     WebSocket,
 )
 from pydantic import AnyHttpUrl, condecimal, conint, constr
-from starlette.websockets import WebSocketDisconnect
 from util.images import ImagesService
+from util.realtime import realtime_hub
 
 from util.response import BasicResponse, Message
 
@@ -33,7 +34,6 @@ from ..price.model import Currency
 from . import controller
 from ..logger.controller import get_event_logs
 from ..logger.model import Log
-from .connections import active_connections
 from .controller import ServiceStep
 from .model import (
     CompleteReservationResponse,
@@ -45,6 +45,7 @@ from .model import (
     StartEvent,
     Duration,
     EventBatch,
+    EventResync,
     PenalizeReason,
     BatchResponse,
 )
@@ -153,7 +154,7 @@ async def mobile_start_event(
             pass
         raise e
 
-    await controller.broadcast_event(event.id, "create", current_org)
+    await controller.broadcast_event(event.id, "create", current_org, event)
 
     return event
 
@@ -176,7 +177,7 @@ async def mobile_confirm_event(
     event = await controller.mobile_confirm_event(
         id_event, id_org, id_user, payment_method, user_code
     )
-    await controller.broadcast_event(event.id, "update", id_org)
+    await controller.broadcast_event(event.id, "update", id_org, event)
 
     return event
 
@@ -211,7 +212,7 @@ async def mobile_complete_event(
         user_code,
         payment_method,
     )
-    await controller.broadcast_event(event["id"], "update", id_org)
+    await controller.broadcast_event(event["id"], "update", id_org, event)
 
     try:
         await controller.unreserve_device(event["id_device"], id_org)
@@ -234,7 +235,7 @@ async def mobile_cancel_event(
     """Mobile user cancels an event"""
 
     event = await controller.mobile_cancel_event(id_event, id_user, id_org)
-    await controller.broadcast_event(event.id, "update", id_org)
+    await controller.broadcast_event(event.id, "update", id_org, event)
 
     return event
 
@@ -446,7 +447,7 @@ async def partner_start_event(
         payload, current_org, request
     )
 
-    await controller.broadcast_event(event.id, "create", current_org)
+    await controller.broadcast_event(event.id, "create", current_org, event)
 
     return event
 
@@ -506,7 +507,7 @@ async def partner_start_vending(
         current_org,
     )
 
-    await controller.broadcast_event(event.id, "create", current_org)
+    await controller.broadcast_event(event.id, "create", current_org, event)
 
     return event
 
@@ -550,7 +551,7 @@ async def partner_start_storage(
         passcode,
     )
 
-    await controller.broadcast_event(event.id, "create", current_org)
+    await controller.broadcast_event(event.id, "create", current_org, event)
 
     return event
 
@@ -579,7 +580,7 @@ async def partner_complete_storage(
         id_event, passcode, locker_number, current_org
     )
 
-    await controller.broadcast_event(event.id, "update", current_org)
+    await controller.broadcast_event(event.id, "update", current_org, event)
 
     return event
 
@@ -644,7 +645,7 @@ async def partner_start_delivery(
         request,
     )
 
-    await controller.broadcast_event(event.id, "create", current_org)
+    await controller.broadcast_event(event.id, "create", current_org, event)
 
     return event
 
@@ -703,7 +704,7 @@ async def partner_start_delivery_parcel(
 
     await delete_reservation(reservation.id, current_org)
 
-    await controller.broadcast_event(event.id, "create", current_org)
+    await controller.broadcast_event(event.id, "create", current_org, event)
 
     return event
 
@@ -733,7 +734,7 @@ async def partner_start_rental(
         current_org, from_user, id_user, None, id_device, id_condition
     )
 
-    await controller.broadcast_event(event.id, "create", current_org)
+    await controller.broadcast_event(event.id, "create", current_org, event)
 
     return event
 
@@ -761,7 +762,7 @@ async def partner_complete_rental(
         current_org, id_user, id_device, id_condition
     )
 
-    await controller.broadcast_event(event.id, "create", current_org)
+    await controller.broadcast_event(event.id, "create", current_org, event)
 
     return event
 
@@ -791,7 +792,7 @@ async def partner_service_step(
         step, weight, id_device, id_event, current_org
     )
 
-    await controller.broadcast_event(event.id, "update", current_org)
+    await controller.broadcast_event(event.id, "update", current_org, event)
 
     return event
 
@@ -820,7 +821,7 @@ async def partner_penalize_event(
         id_event, amount, reason, current_org
     )
 
-    await controller.broadcast_event(event.id, "update", current_org)
+    await controller.broadcast_event(event.id, "update", current_org, event)
 
     return event
 
@@ -846,7 +847,7 @@ async def partner_unlock_event(
     event: Event.Read = await controller.partner_unlock_event(
         id_event, code, current_org
     )
-    await controller.broadcast_event(event.id, "update", current_org)
+    await controller.broadcast_event(event.id, "update", current_org, event)
 
     return event
 
@@ -972,7 +973,7 @@ async def partner_unreserve_device(
             detail="Not enough permissions, must be admin, member or operator",
         )
     event: Event.Read = await controller.partner_unreserve_device(id_event, current_org)
-    await controller.broadcast_event(event.id, "update", current_org)
+    await controller.broadcast_event(event.id, "update", current_org, event)
 
     return event
 
@@ -999,7 +1000,7 @@ async def partner_refund_event(
     event: Event.Read = await controller.partner_refund_event(
         id_event, current_org, amount, currency
     )
-    await controller.broadcast_event(event.id, "update", current_org)
+    await controller.broadcast_event(event.id, "update", current_org, event)
 
     return event
 
@@ -1052,7 +1053,7 @@ async def mobile_delivery_complete_event(
         id_org=None,
     )
     id_org = event.id_org
-    await controller.broadcast_event(event.id, "update", id_org)
+    await controller.broadcast_event(event.id, "update", id_org, event)
 
     return event
 
@@ -1076,7 +1077,7 @@ async def public_complete_service(
     await controller.complete_service(event)
     await controller.partner_unlock_device(event.id_device, event.id_org)
 
-    await controller.broadcast_event(event.id, "update", event.id_org)
+    await controller.broadcast_event(event.id, "update", event.id_org, event)
 
     return event
 
@@ -1103,7 +1104,7 @@ async def delivery_complete_event(
     event: Event.Read = await controller.complete_delivery(
         code, order_id, user_code, current_org
     )
-    await controller.broadcast_event(event.id, "update", current_org)
+    await controller.broadcast_event(event.id, "update", current_org, event)
 
     return event
 
@@ -1130,18 +1131,26 @@ async def delivery_complete_event_batch(
     return event
 
 
+@router.get("/partner/events/{id_event}/resync", response_model=EventResync)
+async def partner_resync_event(
+    id_event: UUID,
+    current_org: UUID = Depends(get_current_org),
+):
+    """Get the full event and its realtime version, for listeners that missed a delta"""
+    return await controller.resync_event(id_event, current_org)
+
+
 @router.websocket("/events/listener/{orgId}")
 async def websocket_endpoint(websocket: WebSocket, orgId: UUID):
-    await websocket.accept()
+    # Every tab of the org gets its own subscription
+    await realtime_hub.serve(websocket, "events", orgId)
 
-    # Simply register the websocket connection.
-    active_connections[orgId] = websocket
 
-    try:
-        while True:
-            # Waiting for the data from the connected WebSocket.
-            await websocket.receive_text()
-
-    except WebSocketDisconnect:
-        # If the connection is closed, remove it from the active connections.
-        del active_connections[orgId]
+@router.get("/partner/events/stream")
+async def stream_endpoint(
+    request: Request,
+    last_event_id: Optional[str] = Header(default=None),
+    current_org: UUID = Depends(get_current_org),
+):
+    """Server-Sent Events feed of the org, reconnecting clients replay from Last-Event-ID"""
+    return realtime_hub.sse_response(request, "events", current_org, last_event_id)
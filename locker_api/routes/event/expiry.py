@@ -0,0 +1,111 @@
+import asyncio
+from datetime import datetime, timedelta
+from typing import Optional
+from uuid import UUID
+
+from config import get_settings
+from fastapi_async_sqlalchemy import db
+from sqlalchemy import func, select, update
+
+from .controller import partner_cancel_event
+from .model import Event, EventStatus
+
+# Events in these statuses are not canceled once they expire
+FINAL_EVENT_STATUSES = [
+    EventStatus.finished,
+    EventStatus.canceled,
+    EventStatus.refunded,
+    EventStatus.expired,
+]
+
+expiry_sweeper: Optional[asyncio.Task] = None
+
+
+async def claim_expired_events() -> list:
+    """Claims a batch of due events, clearing their deadline
+
+    Rows locked by another worker's sweep are skipped, so every expired
+    event is claimed by exactly one worker.
+
+    Returns:
+        list: (id, id_org, event_status) of the claimed events
+    """
+    due = (
+        select(Event.id)
+        .where(Event.expires_at <= func.now())
+        .order_by(Event.expires_at)
+        .limit(get_settings().event_expiry_batch_size)
+        .with_for_update(skip_locked=True)
+    )
+
+    query = (
+        update(Event)
+        .where(Event.id.in_(due.scalar_subquery()))
+        .values(expires_at=None)
+        .returning(Event.id, Event.id_org, Event.event_status)
+        .execution_options(synchronize_session=False)
+    )
+
+    response = await db.session.execute(query)
+    await db.session.commit()
+
+    return response.all()
+
+
+async def expire_event(id_event: UUID, id_org: UUID):
+    try:
+        async with db():
+            await partner_cancel_event(id_org, id_event)
+    except Exception as e:
+        print(f"[!] Failed to cancel expired event {id_event}: {e}")
+
+        # Try again on a later sweep
+        async with db():
+            await db.session.execute(
+                update(Event)
+                .where(Event.id == id_event)
+                .values(
+                    expires_at=datetime.utcnow()
+                    + timedelta(seconds=get_settings().event_expiry_interval)
+                )
+            )
+            await db.session.commit()
+
+
+async def sweep_expired_events() -> int:
+    """Cancels every active event past its expires_at, returns how many were claimed"""
+    claimed = 0
+
+    while True:
+        async with db():
+            events = await claim_expired_events()
+
+        claimed += len(events)
+
+        await asyncio.gather(
+            *[
+                expire_event(id_event, id_org)
+                for id_event, id_org, event_status in events
+                if event_status not in FINAL_EVENT_STATUSES
+            ]
+        )
+
+        # A partial batch means nothing else is due
+        if len(events) < get_settings().event_expiry_batch_size:
+            return claimed
+
+
+async def _expiry_sweeper():
+    while True:
+        try:
+            await sweep_expired_events()
+        except Exception as e:
+            print(f"[!] Failed to sweep expired events: {e}")
+
+        await asyncio.sleep(get_settings().event_expiry_interval)
+
+
+def start_expiry_sweeper():
+    global expiry_sweeper
+
+    expiry_sweeper = asyncio.create_task(_expiry_sweeper())
@@ -68,10 +68,19 @@ class PublicEvent(BaseModel):
     user_name: Optional[str]
 
 
+class NotificationOutcome(BaseModel):
+    channel: str  # sms or email
+    recipient: str
+    id_events: list[UUID]
+    status: str  # sent or failed
+    error: Optional[str]
+
+
 class BatchResponse(BaseModel):
     status_code: int
     event_code: int
     response: dict | str
+    notifications: Optional[list[NotificationOutcome]]
 
 
 class Event(SQLModel, table=True):
@@ -104,6 +113,13 @@ class Event(SQLModel, table=True):
     canceled_at: Optional[datetime] = Field(
         sa_column=Column("canceled_at", DateTime(timezone=True))
     )
+    # Active events still unconfirmed or unfinished at this time are canceled
+    expires_at: Optional[datetime] = Field(
+        sa_column=Column("expires_at", DateTime(timezone=True))
+    )
+    # Location of the device when the event was created, set by the database
+    # so that moving a device doesn't move its events in the report rollups
+    rollup_location: Optional[UUID] = Field(sa_column=Column("rollup_location", GUID()))
 
     invoice_id: str = Field(nullable=True)
     order_id: Optional[str] = Field(nullable=True)
@@ -232,6 +248,7 @@ class EventBatch(BaseModel):
     detail: str
     items: list[Event.Read]
     err: Optional[list]
+    notifications: Optional[list[NotificationOutcome]]
 
 
 class PaginatedEvents(BaseModel):
@@ -241,6 +258,12 @@ class PaginatedEvents(BaseModel):
     pages: int
 
 
+class EventResync(BaseModel):
+    # Realtime version the event is current with
+    version: int
+    event: Event.Read
+
+
 class StripeCustomerData(BaseModel):
     ephemeral_key: Optional[dict]
     customer_id: Optional[str]
@@ -5,6 +5,7 @@ from async_stripe import stripe
 from config import get_settings
 from fastapi import HTTPException
 from fastapi_async_sqlalchemy import db
+from payments.stripe import stripe_accounts
 from sqlalchemy import select, update
 from sqlalchemy.exc import IntegrityError, NoResultFound
 
@@ -14,6 +15,13 @@ from .model import StripeCountry
 
 stripe.api_key = get_settings().stripe_api_key
 
+# Stripe events that change the account data cached per org
+ACCOUNT_EVENTS = [
+    "account.updated",
+    "account.application.deauthorized",
+    "capability.updated",
+]
+
 
 async def get_stripe_account(id_org: UUID):
     data = await db.session.execute(
@@ -30,6 +38,7 @@ async def get_stripe_account(id_org: UUID):
         )
 
     account = await stripe.Account.retrieve(stripe_account)
+    stripe_accounts.store(id_org, account)
 
     return account
 
@@ -53,6 +62,7 @@ async def delete_stripe_account(id_org: UUID):
     query = update(Org).where(Org.id == id_org).values(stripe_account_id=None)
     await db.session.execute(query)
     await db.session.commit()
+    await stripe_accounts.invalidate(id_org)
 
     query = (
         update(LinkOrgUser)
@@ -126,6 +136,8 @@ async def create_stripe_account(
 
         raise HTTPException(status_code=400, detail=error_detail)
 
+    await stripe_accounts.invalidate(id_org)
+
     return response.scalar_one()
 
 
@@ -163,3 +175,29 @@ async def create_stripe_link(
         error_detail = e.user_message
 
         raise HTTPException(status_code=400, detail=error_detail)
+
+
+async def handle_stripe_webhook(payload: bytes, signature: str):
+    """Drops the cached account of an org when Stripe reports a change to it"""
+    try:
+        event = stripe.Webhook.construct_event(
+            payload, signature, get_settings().stripe_webhook_secret
+        )
+    except (ValueError, stripe.error.SignatureVerificationError):
+        raise HTTPException(status_code=400, detail="Invalid Stripe webhook")
+
+    if event["type"] not in ACCOUNT_EVENTS:
+        return {"detail": "Ignored"}
+
+    # Connect events carry the connected account, account.updated the
+    # account itself
+    stripe_account = event.get("account") or event["data"]["object"]["id"]
+
+    data = await db.session.execute(
+        select(Org.id).where(Org.stripe_account_id == stripe_account)
+    )
+
+    for id_org in data.scalars().all():
+        await stripe_accounts.invalidate(id_org)
+
+    return {"detail": "Stripe account cache invalidated"}
@@ -2,7 +2,7 @@ from typing import Optional
 from uuid import UUID
 
 from auth.cognito import get_current_email, get_current_org, get_permission
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, Header, HTTPException, Request
 
 
 from ..member.model import RoleType
@@ -100,3 +100,17 @@ async def delete_stripe_account(
     # Logging at the end
 
     return delete_result
+
+
+@router.post("/stripe/webhook", response_model=DetailModel)
+async def stripe_webhook(
+    request: Request,
+    stripe_signature: str = Header(default=...),
+):
+    """
+    Receives Stripe Connect account events, verified with the webhook secret
+    """
+
+    return await controller.handle_stripe_webhook(
+        await request.body(), stripe_signature
+    )
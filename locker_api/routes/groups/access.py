@@ -0,0 +1,253 @@
+import asyncio
+import time
+from typing import Dict, Iterable, Optional, Set, Tuple
+from uuid import UUID
+
+from config import get_settings
+from fastapi_async_sqlalchemy import db
+from sqlalchemy import exists, not_, or_, select
+from util.invalidation import invalidation_bus
+
+from ..device.model import Device
+from ..location.model import Location
+from .model import (
+    Groups,
+    LinkGroupsDevices,
+    LinkGroupsLocations,
+    LinkGroupsUser,
+    LinkUserDevices,
+    LinkUserLocations,
+)
+
+Index = Dict[UUID, Set[UUID]]
+
+
+def _index(rows: Iterable[Tuple[UUID, UUID]]) -> Index:
+    """Link table rows as key -> values"""
+    index: Index = {}
+
+    for key, value in rows:
+        index.setdefault(key, set()).add(value)
+
+    return index
+
+
+def visible_to(id_user: UUID):
+    """Filter on Device matching the devices the user may use
+
+    Correlated EXISTS on the link tables, so the filter does not grow with
+    the number of assignments.
+    """
+    member_of = select(LinkGroupsUser.id_group).where(LinkGroupsUser.id_user == id_user)
+
+    restricted = or_(
+        exists().where(LinkUserDevices.id_device == Device.id),
+        exists().where(LinkGroupsDevices.id_device == Device.id),
+        exists().where(LinkUserLocations.id_location == Device.id_location),
+        exists().where(LinkGroupsLocations.id_location == Device.id_location),
+    )
+
+    granted = or_(
+        exists().where(
+            LinkUserDevices.id_device == Device.id,
+            LinkUserDevices.id_user == id_user,
+        ),
+        exists().where(
+            LinkUserLocations.id_location == Device.id_location,
+            LinkUserLocations.id_user == id_user,
+        ),
+        exists().where(
+            LinkGroupsDevices.id_device == Device.id,
+            LinkGroupsDevices.id_group.in_(member_of),
+        ),
+        exists().where(
+            LinkGroupsLocations.id_location == Device.id_location,
+            LinkGroupsLocations.id_group.in_(member_of),
+        ),
+    )
+
+    return or_(not_(restricted), granted)
+
+
+class OrgAccess:
+    """Assignments of the devices and locations of one org"""
+
+    def __init__(self, built_at: float):
+        self.built_at = built_at
+        # resource -> users / groups assigned to it
+        self.device_users: Index = {}
+        self.device_groups: Index = {}
+        self.location_users: Index = {}
+        self.location_groups: Index = {}
+        # user -> groups of the org the user belongs to
+        self.user_groups: Index = {}
+
+    def can_use(
+        self, id_device: UUID, id_location: Optional[UUID], id_user: UUID
+    ) -> bool:
+        restricted = (
+            id_device in self.device_users
+            or id_device in self.device_groups
+            or id_location in self.location_users
+            or id_location in self.location_groups
+        )
+
+        # Devices nobody is assigned to are open to every user
+        if not restricted:
+            return True
+
+        groups = self.user_groups.get(id_user, set())
+
+        return bool(
+            id_user in self.device_users.get(id_device, ())
+            or id_user in self.location_users.get(id_location, ())
+            or groups & self.device_groups.get(id_device, set())
+            or groups & self.location_groups.get(id_location, set())
+        )
+
+
+class AccessIndex:
+    """Who may use each restricted device or location, kept in memory per org
+
+    A device is restricted when users or groups are assigned to it or to its
+    location. Groups and resources are always of the same org, so the
+    assignments of an org are loaded together, with one query per link
+    table, and kept until they change or device_access_ttl elapses. A change
+    in one org only reloads that org.
+    """
+
+    def __init__(self):
+        # id_org -> assignments of the org
+        self.orgs: Dict[str, OrgAccess] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    async def _load(self, query) -> Index:
+        response = await db.session.execute(query)
+
+        return _index(response.all())
+
+    async def _build(self, id_org: UUID) -> OrgAccess:
+        access = OrgAccess(time.monotonic())
+
+        access.device_users = await self._load(
+            select(LinkUserDevices.id_device, LinkUserDevices.id_user)
+            .join(Device, Device.id == LinkUserDevices.id_device)
+            .where(Device.id_org == id_org)
+        )
+        access.location_users = await self._load(
+            select(LinkUserLocations.id_location, LinkUserLocations.id_user)
+            .join(Location, Location.id == LinkUserLocations.id_location)
+            .where(Location.id_org == id_org)
+        )
+        access.device_groups = await self._load(
+            select(LinkGroupsDevices.id_device, LinkGroupsDevices.id_group)
+            .join(Groups, Groups.id == LinkGroupsDevices.id_group)
+            .where(Groups.id_org == id_org)
+        )
+        access.location_groups = await self._load(
+            select(LinkGroupsLocations.id_location, LinkGroupsLocations.id_group)
+            .join(Groups, Groups.id == LinkGroupsLocations.id_group)
+            .where(Groups.id_org == id_org)
+        )
+        access.user_groups = await self._load(
+            select(LinkGroupsUser.id_user, LinkGroupsUser.id_group)
+            .join(Groups, Groups.id == LinkGroupsUser.id_group)
+            .where(Groups.id_org == id_org)
+        )
+
+        return access
+
+    async def _get(self, id_org: UUID) -> OrgAccess:
+        key = str(id_org)
+
+        def fresh() -> Optional[OrgAccess]:
+            access = self.orgs.get(key)
+
+            if (
+                access is not None
+                and time.monotonic() - access.built_at
+                < get_settings().device_access_ttl
+            ):
+                return access
+
+            return None
+
+        access = fresh()
+
+        if not access:
+            async with self._locks.setdefault(key, asyncio.Lock()):
+                access = fresh()
+
+                if not access:
+                    access = await self._build(id_org)
+                    self.orgs[key] = access
+
+        return access
+
+    async def can_use(self, id_device: UUID, id_user: UUID) -> bool:
+        """Whether the user may use the device
+
+        The org and location of the device are looked up by primary key.
+        """
+        id_device = UUID(str(id_device))
+
+        response = await db.session.execute(
+            select(Device.id_org, Device.id_location).where(Device.id == id_device)
+        )
+        device = response.one_or_none()
+
+        if not device:
+            return True
+
+        access = await self._get(device.id_org)
+
+        return access.can_use(id_device, device.id_location, UUID(str(id_user)))
+
+    async def accessible(self, devices: Iterable, id_user: UUID) -> Set[UUID]:
+        """Ids of the devices the user may use, out of devices with an id_location
+
+        The devices of a page may come from several orgs, a tenant sharing
+        its devices with a sub-org, so their orgs are looked up in one query.
+        """
+        devices = list(devices)
+        id_user = UUID(str(id_user))
+
+        if not devices:
+            return set()
+
+        response = await db.session.execute(
+            select(Device.id, Device.id_org).where(
+                Device.id.in_([device.id for device in devices])
+            )
+        )
+        orgs = {UUID(str(id_device)): id_org for id_device, id_org in response.all()}
+
+        accessible = set()
+        for device in devices:
+            id_device = UUID(str(device.id))
+            id_org = orgs.get(id_device)
+
+            if id_org is None:
+                continue
+
+            access = await self._get(id_org)
+
+            if access.can_use(id_device, device.id_location, id_user):
+                accessible.add(id_device)
+
+        return accessible
+
+    def drop(self, id_org: str):
+        if id_org == "*":
+            self.orgs.clear()
+        else:
+            self.orgs.pop(id_org, None)
+
+    async def invalidate(self, id_org: Optional[UUID] = None):
+        """Reloads the assignments of the org, or of every org when None"""
+        await invalidation_bus.invalidate("device-access", id_org or "*")
+
+
+access_index = AccessIndex()
+
+invalidation_bus.register("device-access", access_index.drop)
@@ -0,0 +1,245 @@
+"""Benchmark of the group listing
+
+Seeds an org with groups, devices, locations and users, times get_groups
+over every page of the org and rolls the seed back, so it can run against
+any database with the schema of init.sql:
+
+    python -m routes.groups.benchmark [--groups 1000] [--devices 10000]
+
+The seed is generated from --seed, so runs are comparable across changes.
+"""
+
+import argparse
+import asyncio
+import random
+import time
+from datetime import datetime, timedelta, timezone
+from math import ceil
+from statistics import mean, median
+from typing import List
+from uuid import UUID
+
+from config import get_settings
+from fastapi_async_sqlalchemy import SQLAlchemyMiddleware, db
+from pydantic import PostgresDsn
+from sqlalchemy import insert
+from sqlalchemy.pool import NullPool
+
+from ..device.model import Device, HardwareType, LockStatus, Mode, Status
+from ..location.model import Location
+from ..organization.model import Org
+from ..user.model import User
+from .controller import get_groups
+from .model import Groups, LinkGroupsDevices, LinkGroupsLocations, LinkGroupsUser
+
+# Rows per INSERT, below the bind parameter limit of asyncpg
+CHUNK = 1000
+
+
+async def insert_rows(model, rows: List[dict]):
+    for start in range(0, len(rows), CHUNK):
+        await db.session.execute(insert(model), rows[start : start + CHUNK])
+
+
+async def seed(
+    rng: random.Random,
+    groups: int,
+    devices: int,
+    locations: int,
+    users: int,
+    links: int,
+) -> UUID:
+    """Inserts an org and its resources, returns the id of the org"""
+
+    def new_id() -> UUID:
+        return UUID(int=rng.getrandbits(128), version=4)
+
+    id_org = new_id()
+    await insert_rows(
+        Org,
+        [
+            {
+                "id": id_org,
+                "name": "Group listing benchmark",
+                "rental_mode": True,
+                "storage_mode": True,
+                "delivery_mode": True,
+                "service_mode": True,
+                "super_tenant": False,
+            }
+        ],
+    )
+
+    location_ids = [new_id() for _ in range(locations)]
+    await insert_rows(
+        Location,
+        [
+            {
+                "id": id_location,
+                "name": f"Location {i}",
+                "address": f"{i} Benchmark St",
+                "latitude": 0,
+                "longitude": 0,
+                "restrict_by_user_code": False,
+                "verify_pin_code": False,
+                "verify_qr_code": False,
+                "verify_url": False,
+                "verify_signature": False,
+                "email": False,
+                "phone": False,
+                "id_org": id_org,
+            }
+            for i, id_location in enumerate(location_ids)
+        ],
+    )
+
+    device_ids = [new_id() for _ in range(devices)]
+    await insert_rows(
+        Device,
+        [
+            {
+                "id": id_device,
+                "name": f"Device {i}",
+                "locker_number": i,
+                "mode": Mode.storage,
+                "status": Status.available,
+                "hardware_type": HardwareType.linka,
+                "lock_status": LockStatus.locked,
+                "price_required": False,
+                "transaction_count": 0,
+                "id_location": location_ids[i % locations],
+                "id_org": id_org,
+            }
+            for i, id_device in enumerate(device_ids)
+        ],
+    )
+
+    user_ids = [new_id() for _ in range(users)]
+    await insert_rows(
+        User,
+        [
+            {"id": id_user, "name": f"User {i}", "require_auth": False}
+            for i, id_user in enumerate(user_ids)
+        ],
+    )
+
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    group_ids = [new_id() for _ in range(groups)]
+    await insert_rows(
+        Groups,
+        [
+            {
+                "id": id_group,
+                "name": f"Group {i}",
+                "created_at": now - timedelta(seconds=i),
+                "id_org": id_org,
+            }
+            for i, id_group in enumerate(group_ids)
+        ],
+    )
+
+    # Each group gets devices, users and one location, drawn from the seed
+    await insert_rows(
+        LinkGroupsDevices,
+        [
+            {"id": new_id(), "id_group": id_group, "id_device": id_device}
+            for id_group in group_ids
+            for id_device in rng.sample(device_ids, links)
+        ],
+    )
+    await insert_rows(
+        LinkGroupsUser,
+        [
+            {"id": new_id(), "id_group": id_group, "id_user": id_user}
+            for id_group in group_ids
+            for id_user in rng.sample(user_ids, min(links, users))
+        ],
+    )
+    await insert_rows(
+        LinkGroupsLocations,
+        [
+            {
+                "id": new_id(),
+                "id_group": id_group,
+                "id_location": rng.choice(location_ids),
+            }
+            for id_group in group_ids
+        ],
+    )
+
+    return id_org
+
+
+async def benchmark(args: argparse.Namespace):
+    async with db():
+        started = time.perf_counter()
+        id_org = await seed(
+            random.Random(args.seed),
+            args.groups,
+            args.devices,
+            args.locations,
+            args.users,
+            args.links,
+        )
+        await db.session.flush()
+        print(f"[*] Seeded in {time.perf_counter() - started:.2f}s")
+
+        pages = ceil(args.groups / args.size)
+        timings = []
+
+        try:
+            for _ in range(args.runs):
+                for page in range(1, pages + 1):
+                    started = time.perf_counter()
+                    await get_groups(page, args.size, None, "", id_org)
+                    timings.append(time.perf_counter() - started)
+        finally:
+            # Nothing of the seed is kept
+            await db.session.rollback()
+
+    timings.sort()
+    print(
+        f"[*] get_groups, {args.groups} groups x {args.devices} devices, "
+        f"{len(timings)} pages of {args.size}: "
+        f"mean {mean(timings) * 1000:.1f}ms, "
+        f"median {median(timings) * 1000:.1f}ms, "
+        f"p95 {timings[int(len(timings) * 0.95)] * 1000:.1f}ms, "
+        f"max {timings[-1] * 1000:.1f}ms"
+    )
+
+
+def main(args: argparse.Namespace):
+    # Outside of the app, the middleware only provides the session factory
+    SQLAlchemyMiddleware(
+        None,
+        db_url=PostgresDsn.build(
+            scheme="postgresql+asyncpg",
+            user=get_settings().database_user,
+            password=get_settings().database_password,
+            host=get_settings().database_host,
+            port=str(get_settings().database_port),
+            path=f"/{get_settings().database_name}",
+        ),
+        engine_args={"poolclass": NullPool},
+    )
+
+    asyncio.run(benchmark(args))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the group listing")
+    parser.add_argument("--groups", type=int, default=1000)
+    parser.add_argument("--devices", type=int, default=10000)
+    parser.add_argument("--locations", type=int, default=100)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument(
+        "--links",
+        type=int,
+        default=10,
+        help="devices and users linked to each group",
+    )
+    parser.add_argument("--size", type=int, default=50, help="groups per page")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+
+    main(parser.parse_args())
@@ -1,18 +1,19 @@
 import uuid
 import datetime
 from math import ceil
-from typing import Optional
+from typing import Dict, List, Optional, Set
 from uuid import UUID, uuid4
 
 from fastapi import HTTPException
 from fastapi_async_sqlalchemy import db
-from sqlalchemy import delete, insert, or_, select, update
+from sqlalchemy import and_, delete, func, insert, select, update
 
 
-from ..device.model import Device
+from ..device.model import Device, Restriction, RestrictionType
 from ..location.model import Location
 from ..organization.model import LinkOrgUser
 from ..user.model import User
+from .access import access_index
 from .model import (
     Groups,
     LinkGroupsDevices,
@@ -25,6 +26,68 @@ from .model import (
 )
 
 
+async def summarize_groups(groups: List[Groups], id_org: UUID) -> List[dict]:
+    """Users, device count and locations of a page of groups
+
+    Three set-based queries cover the whole page: one for the users, one for
+    the locations and one counting the devices linked directly or through a
+    location, without loading the device rows.
+    """
+    ids = [group.id for group in groups]
+
+    if not ids:
+        return []
+
+    users: Dict[UUID, list] = {}
+    response = await db.session.execute(
+        select(LinkGroupsUser.id_group, User)
+        .join(User, User.id == LinkGroupsUser.id_user)
+        .where(LinkGroupsUser.id_group.in_(ids))
+    )
+    for id_group, user in response.unique().all():
+        users.setdefault(id_group, []).append(user)
+
+    locations: Dict[UUID, list] = {}
+    response = await db.session.execute(
+        select(LinkGroupsLocations.id_group, Location)
+        .join(Location, Location.id == LinkGroupsLocations.id_location)
+        .where(LinkGroupsLocations.id_group.in_(ids), Location.id_org == id_org)
+    )
+    for id_group, location in response.unique().all():
+        locations.setdefault(id_group, []).append(location)
+
+    # UNION drops devices linked both directly and through their location
+    group_devices = (
+        select(LinkGroupsDevices.id_group, Device.id)
+        .join(Device, Device.id == LinkGroupsDevices.id_device)
+        .where(LinkGroupsDevices.id_group.in_(ids), Device.id_org == id_org)
+        .union(
+            select(LinkGroupsLocations.id_group, Device.id)
+            .join(Device, Device.id_location == LinkGroupsLocations.id_location)
+            .where(LinkGroupsLocations.id_group.in_(ids))
+        )
+        .subquery()
+    )
+    response = await db.session.execute(
+        select(group_devices.c.id_group, func.count()).group_by(
+            group_devices.c.id_group
+        )
+    )
+    devices = dict(response.all())
+
+    return [
+        {
+            "id": group.id,
+            "name": group.name,
+            "created_at": group.created_at,
+            "users": users.get(group.id, []),
+            "devices": devices.get(group.id, 0),
+            "locations": locations.get(group.id, []),
+        }
+        for group in groups
+    ]
+
+
 async def get_groups(
     page: int, size: int, id_group: Optional[UUID], search: str, id_org: UUID
 ):
@@ -38,14 +101,7 @@ async def get_groups(
         result = await db.session.execute(query)
         group = result.scalar_one()
 
-        return {
-            "id": group.id,
-            "name": group.name,
-            "created_at": group.created_at,
-            "users": await get_group_users(group.id),
-            "devices": len(await get_group_devices(group.id, id_org)),
-            "locations": await get_group_locations(group.id, id_org),
-        }
+        return (await summarize_groups([group], id_org))[0]
 
     count = query
 
@@ -57,25 +113,13 @@ async def get_groups(
     )
 
     response = await db.session.execute(query)
-    total = await db.session.execute(count)
+    total_count = await db.session.scalar(
+        select(func.count()).select_from(count.subquery())
+    )
 
     groups = response.scalars().all()
 
-    cureated_groups = []
-
-    for group in groups:
-        cureated_groups.append(
-            {
-                "id": group.id,
-                "name": group.name,
-                "created_at": group.created_at,
-                "users": await get_group_users(group.id),
-                "devices": len(await get_group_devices(group.id, id_org)),
-                "locations": await get_group_locations(group.id, id_org),
-            }
-        )
-
-    total_count = len(total.all())
+    cureated_groups = await summarize_groups(groups, id_org)
 
     return PaginatedGroups(
         items=cureated_groups,
@@ -90,14 +134,7 @@ async def get_group(id_group: UUID, id_org: UUID):
 
     group = response.scalar_one()
 
-    return {
-        "id": group.id,
-        "name": group.name,
-        "created_at": group.created_at,
-        "users": await get_group_users(group.id),
-        "devices": len(await get_group_devices(group.id, id_org)),
-        "locations": await get_group_locations(group.id, id_org),
-    }
+    return (await summarize_groups([group], id_org))[0]
 
 
 async def get_group_by_name(name: str, id_org: UUID):
@@ -106,14 +143,7 @@ async def get_group_by_name(name: str, id_org: UUID):
 
     group = response.scalar_one()
 
-    return {
-        "id": group.id,
-        "name": group.name,
-        "created_at": group.created_at,
-        "users": await get_group_users(group.id),
-        "devices": len(await get_group_devices(group.id, id_org)),
-        "locations": await get_group_locations(group.id, id_org),
-    }
+    return (await summarize_groups([group], id_org))[0]
 
 
 async def get_devices_from_group(id_group: UUID, id_org: UUID):
@@ -269,6 +299,7 @@ async def delete_group(id_group: UUID, id_org: UUID):
     await db.session.execute(query_groups)
 
     await db.session.commit()  # raise IntegrityError
+    await access_index.invalidate(id_org)
 
     return {"detail": "Group deleted"}
 
@@ -298,6 +329,7 @@ async def delete_groups(id_org: UUID, id_groups: list[UUID]):
     await db.session.execute(query_groups)
 
     await db.session.commit()  # raise IntegrityError
+    await access_index.invalidate(id_org)
 
     return {"detail": "Groups deleted"}
 
@@ -343,6 +375,7 @@ async def assign_user_to_group(id_group: UUID, id_user: UUID, id_org: UUID):
     response = await db.session.execute(query)
 
     await db.session.commit()  # raise IntegrityError
+    await access_index.invalidate(id_org)
 
     return {"detail": "User assigned to group"}
 
@@ -368,6 +401,7 @@ async def remove_user_from_group(id_group: UUID, id_user: UUID, id_org: UUID):
     response = await db.session.execute(query)
 
     await db.session.commit()
+    await access_index.invalidate(id_org)
 
     return {"detail": "User removed from group"}
 
@@ -492,6 +526,7 @@ async def assign_group_to_resource(
 
     response = await db.session.execute(query)
     await db.session.commit()  # This line may raise IntegrityError
+    await access_index.invalidate(id_org)
 
     return {"detail": "Group assigned to resource"}
 
@@ -538,6 +573,7 @@ async def remove_group_from_resource(
     response = await db.session.execute(query)
 
     await db.session.commit()  # raise IntegrityError
+    await access_index.invalidate(id_org)
 
     return {"detail": "Group removed from resource"}
 
@@ -662,6 +698,7 @@ async def assign_user_to_resource(
     response = await db.session.execute(query)
 
     await db.session.commit()
+    await access_index.invalidate(id_org)
 
     return {"detail": "User assigned to resource"}
 
@@ -712,6 +749,7 @@ async def remove_user_from_resource(
     response = await db.session.execute(query)
 
     await db.session.commit()
+    await access_index.invalidate(id_org)
 
     return {"detail": "User removed from resource"}
 
@@ -881,6 +919,7 @@ async def dissolve_user_access(
     response = await db.session.execute(query)
 
     await db.session.commit()
+    await access_index.invalidate(id_org)
 
     return {"detail": "User access dissolved"}
 
@@ -1014,83 +1053,97 @@ async def is_resource_in_group(
     return True if len(response.all()) > 0 else False
 
 
-async def is_device_assigned_to_user(
-    id_device: UUID,
-    id_user: UUID,
-) -> bool:
-    # is device assigned to group or users?
-    query = (
-        select(
-            Device.id,
-            LinkUserDevices.id,
-            LinkGroupsDevices.id,
-            LinkUserLocations.id,
-            LinkGroupsLocations.id,
-        )
-        .where(Device.id == id_device)
-        .outerjoin(
-            LinkUserDevices,
-            LinkUserDevices.id_device == Device.id,
-        )
-        .outerjoin(
-            LinkUserLocations,
-            LinkUserLocations.id_location == Device.id_location,
-        )
-        .outerjoin(
-            LinkGroupsDevices,
-            LinkGroupsDevices.id_device == Device.id,
-        )
-        .outerjoin(
-            LinkGroupsLocations,
-            LinkGroupsLocations.id_location == Device.id_location,
-        )
-        .where(
-            or_(
-                LinkUserDevices.id_device == Device.id,
-                LinkUserLocations.id_location == Device.id_location,
-                LinkGroupsDevices.id_device == Device.id,
-                LinkGroupsLocations.id_location == Device.id_location,
+async def get_restrictions(
+    ids: List[UUID],
+    resource_type: ResourceType,
+    id_org: UUID,
+) -> Dict[UUID, Optional[Restriction]]:
+    """Restrictions of a page of devices or locations in two queries
+
+    Like a resource by resource check, users assigned to a resource take
+    precedence over groups, and only users and groups of the org are listed.
+    """
+    match resource_type:
+        case ResourceType.device:
+            user_link, id_user_resource = LinkUserDevices, LinkUserDevices.id_device
+            group_link, id_group_resource = (
+                LinkGroupsDevices,
+                LinkGroupsDevices.id_device,
             )
-        )
-    )
+        case ResourceType.location:
+            user_link, id_user_resource = (
+                LinkUserLocations,
+                LinkUserLocations.id_location,
+            )
+            group_link, id_group_resource = (
+                LinkGroupsLocations,
+                LinkGroupsLocations.id_location,
+            )
+        case _:
+            raise HTTPException(status_code=400, detail="Invalid resource type")
 
-    response = await db.session.execute(query)
+    ids = list(set(ids))
 
-    # device is not assigned to user or group, so all users have access
-    if len(response.all()) == 0:
-        return True
+    if not ids:
+        return {}
 
-    # does user have access to device?
-    query = (
-        select(Device)
-        .where(Device.id == id_device)
-        .outerjoin(
-            LinkGroupsUser,
-            LinkGroupsUser.id_user == id_user,
-        )
-        .outerjoin(LinkGroupsDevices, LinkGroupsDevices.id_device == Device.id)
-        .outerjoin(
-            LinkGroupsLocations,
-            LinkGroupsLocations.id_location == Device.id_location,
-        )
-        .outerjoin(
-            LinkUserDevices,
-            LinkUserDevices.id_device == Device.id,
-        )
+    members = select(LinkOrgUser.id_user).where(LinkOrgUser.id_org == id_org)
+
+    # Outer joins keep links to users of other orgs: the resource is still
+    # restricted to users, even if none of them is listed
+    response = await db.session.execute(
+        select(id_user_resource, User)
+        .outerjoin(User, and_(User.id == user_link.id_user, User.id.in_(members)))
+        .where(id_user_resource.in_(ids))
+    )
+
+    users: Dict[UUID, list] = {}
+    for id_resource, user in response.all():
+        items = users.setdefault(id_resource, [])
+        if user:
+            items.append(user)
+
+    response = await db.session.execute(
+        select(id_group_resource, Groups)
         .outerjoin(
-            LinkUserLocations,
-            LinkUserLocations.id_location == Device.id_location,
-        )
-        .where(
-            or_(
-                LinkGroupsUser.id_group == LinkGroupsDevices.id_group,
-                LinkGroupsUser.id_group == LinkGroupsLocations.id_group,
-                LinkUserDevices.id_user == id_user,
-                LinkUserLocations.id_user == id_user,
-            ),
+            Groups, and_(Groups.id == group_link.id_group, Groups.id_org == id_org)
         )
+        .where(id_group_resource.in_(ids))
     )
 
-    response = await db.session.execute(query)
+    groups: Dict[UUID, list] = {}
+    for id_resource, group in response.all():
+        items = groups.setdefault(id_resource, [])
+        if group:
+            items.append(group)
+
+    restrictions = {}
+    for id_resource in ids:
+        if id_resource in users:
+            restrictions[id_resource] = Restriction(
+                restriction_type=RestrictionType.users, items=users[id_resource]
+            )
+        elif id_resource in groups:
+            restrictions[id_resource] = Restriction(
+                restriction_type=RestrictionType.groups, items=groups[id_resource]
+            )
+        else:
+            restrictions[id_resource] = None
+
+    return restrictions
+
+
+async def get_accessible_devices(devices, id_user: UUID) -> Set[UUID]:
+    """Ids of the devices of a page the user can use
 
-    return True if len(response.unique().all()) > 0 else False
+    A device is open to everyone unless users or groups are assigned to it or
+    to its location, then only to those users and the members of those groups.
+    """
+    return await access_index.accessible(devices, id_user)
+
+
+async def is_device_assigned_to_user(
+    id_device: UUID,
+    id_user: UUID,
+) -> bool:
+    return await access_index.can_use(id_device, id_user)
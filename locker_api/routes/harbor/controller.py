@@ -1,14 +1,105 @@
+import asyncio
+import time
+from typing import Dict, Optional, Set, Tuple
+
+from config import get_settings
 from integrations.harbor import (
     create_locker_token,
-    get_harbor_client,
-    get_harbor_sdk_client,
     get_tower_lockers,
 )
+from integrations.token_broker import token_broker
+
+# Lockers are fetched with the token of the caller, or the broker's when it
+# gives none, and may differ between the two
+TowerKey = Tuple[str, Optional[str]]
+
+# (tower_id, svc_token) -> (fetched_at, lockers)
+_tower_cache: Dict[TowerKey, Tuple[float, list]] = {}
+_tower_refreshes: Dict[TowerKey, asyncio.Task] = {}
+
+# Background refreshes, referenced until they finish
+_background_tasks: Set[asyncio.Task] = set()
+
+
+def _spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+    return task
+
+
+async def _fetch_tower_lockers(tower_id: str, svc_token: Optional[str] = None):
+    if svc_token:
+        lockers = await get_tower_lockers(tower_id=tower_id, svc_token=svc_token)
+    else:
+        lockers = await token_broker.call(
+            "harbor_api",
+            lambda token: get_tower_lockers(tower_id=tower_id, svc_token=token),
+        )
+
+    now = time.monotonic()
+
+    # Service tokens rotate, entries of expired ones are never read again
+    expired = now - get_settings().harbor_tower_cache_ttl * 2
+    for key in [key for key, cached in _tower_cache.items() if cached[0] < expired]:
+        _tower_cache.pop(key, None)
+
+    _tower_cache[(tower_id, svc_token)] = (now, lockers)
+
+    return lockers
+
+
+def _refresh_tower_in_background(tower_id: str, svc_token: Optional[str] = None):
+    key = (tower_id, svc_token)
+    task = _tower_refreshes.get(key)
+
+    # Only one refresh in flight per tower and token
+    if task and not task.done():
+        return
+
+    async def refresh():
+        try:
+            await _fetch_tower_lockers(tower_id, svc_token)
+        except Exception as e:
+            print(f"Failed to refresh Harbor tower {tower_id}: {e}")
+        finally:
+            _tower_refreshes.pop(key, None)
+
+    _tower_refreshes[key] = _spawn(refresh())
+
+
+def invalidate_tower(tower_id: str):
+    for key in [key for key in _tower_cache if key[0] == tower_id]:
+        _tower_cache.pop(key, None)
+
+
+async def get_tower_lockers_cached(tower_id: str, svc_token: Optional[str] = None):
+    """Returns the lockers of a tower from memory when possible
+
+    Fresh entries are served as is. Entries older than harbor_tower_cache_ttl
+    are still served while a background refresh updates them, up to twice the
+    TTL, after which the tower is queried again before answering.
+    """
+    ttl = get_settings().harbor_tower_cache_ttl
+    cached = _tower_cache.get((tower_id, svc_token))
+
+    if cached:
+        age = time.monotonic() - cached[0]
+
+        if age < ttl:
+            return cached[1]
+
+        if age < ttl * 2:
+            _refresh_tower_in_background(tower_id, svc_token)
+            return cached[1]
+
+    return await _fetch_tower_lockers(tower_id, svc_token)
 
 
 async def get_available_lockers(
     tower_id: str,
-    svc_token: str,
+    svc_token: Optional[str] = None,
 ):
     # {
     #     "id": 363,
@@ -19,7 +110,7 @@ async def get_available_lockers(
     #     "type": {"name": "small", "description": null, "id": 1},
     # }
 
-    lockers = await get_tower_lockers(
+    lockers = await get_tower_lockers_cached(
         tower_id=tower_id,
         svc_token=svc_token,
     )
@@ -34,9 +125,9 @@ async def get_available_lockers(
 
 
 async def generate_access_tokens():
-    api_access_token = await get_harbor_client()
+    api_access_token = await token_broker.get_token("harbor_api")
 
-    sdk_access_token = await get_harbor_sdk_client()
+    sdk_access_token = await token_broker.get_token("harbor_sdk")
 
     return {
         "api_access_token": api_access_token,
@@ -44,18 +135,43 @@ async def generate_access_tokens():
     }
 
 
-async def generate_locker_token(
+async def _create_locker_token(
     tower_id: str,
     locker_id: str,
     step: str,
-    svc_token: str,  # Service Provider token used to generate Dropoff/Pickup token
+    svc_token: Optional[str] = None,
 ):
-    token = await create_locker_token(
-        tower_id=tower_id,
-        locker_id=locker_id,
-        step=step,
-        svc_token=svc_token,
-        device_uuid=tower_id,
+    if svc_token:
+        return await create_locker_token(
+            tower_id=tower_id,
+            locker_id=locker_id,
+            step=step,
+            svc_token=svc_token,
+            device_uuid=tower_id,
+        )
+
+    return await token_broker.call(
+        "harbor_api",
+        lambda token: create_locker_token(
+            tower_id=tower_id,
+            locker_id=locker_id,
+            step=step,
+            svc_token=token,
+            device_uuid=tower_id,
+        ),
     )
 
+
+async def generate_locker_token(
+    tower_id: str,
+    locker_id: str,
+    step: str,
+    # Service Provider token used to generate Dropoff/Pickup token
+    svc_token: Optional[str] = None,
+):
+    token = await _create_locker_token(tower_id, locker_id, step, svc_token)
+
+    # The locker is about to change state
+    invalidate_tower(tower_id)
+
     return token
@@ -157,6 +157,7 @@ async def harbor_access_verify(
         )
 
     event = events.pop()
+
     # Logging the found event
     # Logging at the end
 
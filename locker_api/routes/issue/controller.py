@@ -14,6 +14,7 @@ from util.images import ImagesService
 from ..webhook.controller import send_payload
 from ..webhook.model import EventChange
 from ..event.model import Event, EventStatus
+from ..member.controller import get_members as get_cognito_members
 from ..member.controller import get_user as get_cognito_member
 from ..settings.controller import get_settings_org
 from .helpers.email import email_issue_to_support, email_notify_team_member
@@ -111,23 +112,22 @@ async def get_partner_issues(
 
     # Mutate issues to include team member details from Cognito user pool, only
     # if the issue is assigned to a team member:
-    mutated_issues: list[Issue.Read] = []
+    mutated_issues: list[Issue.Read] = [Issue.Read.parse_obj(i) for i in issues]
 
-    for issue in issues:
-        issue = Issue.Read.parse_obj(issue)
+    try:
+        members = await get_cognito_members(
+            current_user_pool,
+            [str(i.team_member_id) for i in mutated_issues if i.team_member_id],
+        )
+    except Exception:
+        members = {}
 
+    for issue in mutated_issues:
         if issue.team_member_id:
-            try:
-                cognito_member = await get_cognito_member(
-                    current_user_pool, str(issue.team_member_id)
-                )
-
-                if cognito_member:
-                    issue.team_member = cognito_member
-            except Exception:
-                pass
+            cognito_member = members.get(str(issue.team_member_id))
 
-        mutated_issues.append(issue)
+            if cognito_member:
+                issue.team_member = cognito_member
 
     return PaginatedIssues(
         items=mutated_issues,
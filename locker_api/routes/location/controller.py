@@ -11,17 +11,15 @@ from sqlalchemy import VARCHAR, cast, delete, desc, insert, or_, select, update,
 from util.images import ImagesService
 from util.validator import lookup_phone
 
-from ..device.controller import partner_unlock_device, set_devices_shared
-from ..device.model import Device, Mode, Status, Restriction, RestrictionType
+from ..device.bulk_unlock import bulk_unlock_devices
+from ..device.controller import set_devices_shared
+from ..device.model import Device, Mode, Status
 from ..event.model import Event
 from ..groups.controller import (
     assign_group_to_resource,
     assign_user_to_resource,
-    is_resource_in_group,
-    is_resource_in_pseudo_group,
-    is_device_assigned_to_user,
-    get_groups_from_resource,
-    get_users_from_resource,
+    get_accessible_devices,
+    get_restrictions,
 )
 from ..groups.model import AssignmentType, ResourceType
 from ..organization.model import LinkOrgUser
@@ -222,8 +220,7 @@ async def partner_get_locations(
     locations = data.unique().scalars().all()
 
     response = []
-    for entry in locations:
-        location = await eval_restriction(entry, id_org)
+    for location in await eval_restrictions(locations, id_org):
         location.devices = await partner_get_devices_in_location(
             location.id, None, None, None, None
         )
@@ -309,7 +306,7 @@ async def mobile_get_locations(
 
     response = []
 
-    for location in locations_data:
+    for location in await eval_restrictions(locations_data, id_org):
         devices = await mobile_get_devices_in_location(
             location.id, device_mode, None, None
         )
@@ -326,7 +323,6 @@ async def mobile_get_locations(
             elif device.status == Status.maintenance:
                 maintenance += 1
 
-        location = await eval_restriction(location, id_org)
         response.append(location)
 
         response.append(
@@ -510,11 +506,8 @@ async def partner_get_devices_in_location(
 
     # * Filter devices if user is assigned to them
     if from_user:
-        response = [
-            device
-            for device in response
-            if await is_device_assigned_to_user(device.id, from_user)
-        ]
+        accessible = await get_accessible_devices(response, from_user)
+        response = [device for device in response if device.id in accessible]
 
     return response
 
@@ -906,35 +899,29 @@ async def unlock_device_by_location(id_location: UUID, id_org: UUID):
         elif device.status == Status.reserved:
             reserved_devices.append(device)
 
-    for device in available_devices:
-        await partner_unlock_device(device.id, device.id_org)
+    results = await bulk_unlock_devices(available_devices, id_org)
+
+    unlocked = [result for result in results if result.status == "unlocked"]
 
     return {
-        "detail": f"Unlocked {len(available_devices)}/{len(devices)} devices in this location."
+        "detail": f"Unlocked {len(unlocked)}/{len(devices)} devices in this location.",
+        "results": results,
     }
 
 
-async def eval_restriction(entry, id_org: UUID):
-    location = Location.Read.parse_obj(entry)
+async def eval_restrictions(entries, id_org: UUID) -> List[Location.Read]:
+    """Locations with their restriction, resolved for the whole page at once"""
+    locations = [Location.Read.parse_obj(entry) for entry in entries]
 
-    in_group = await is_resource_in_group(location.id, ResourceType.location)
-    in_users = await is_resource_in_pseudo_group(location.id, ResourceType.location)
+    restrictions = await get_restrictions(
+        [location.id for location in locations], ResourceType.location, id_org
+    )
 
-    if in_users:
-        location.restriction = Restriction(
-            restriction_type=RestrictionType.users,
-            items=await get_users_from_resource(
-                location.id, ResourceType.location, id_org
-            ),
-        )
-    elif in_group:
-        location.restriction = Restriction(
-            restriction_type=RestrictionType.groups,
-            items=await get_groups_from_resource(
-                location.id, ResourceType.location, id_org
-            ),
-        )
-    else:
-        location.restriction = None
+    for location in locations:
+        location.restriction = restrictions.get(location.id)
 
-    return location
+    return locations
+
+
+async def eval_restriction(entry, id_org: UUID):
+    return (await eval_restrictions([entry], id_org))[0]
@@ -1,15 +1,14 @@
 from math import ceil
-from typing import List, Optional
+from typing import Dict, List, Optional
 from uuid import UUID
 
-import aioboto3
-from config import get_settings
 from fastapi import HTTPException
 from fastapi_async_sqlalchemy import db
 from sqlalchemy import delete, insert, select, update
 
 
 from ..organization.model import Org
+from .directory import member_directory
 from .model import (
     CognitoMembersRoleLink,
     LinkMemberLocation,
@@ -25,36 +24,12 @@ from .model import (
 
 
 async def get_self(user_pool_id: str, user_id: str):
-    session = aioboto3.Session()
-    async with session.client(
-        "cognito-idp",
-        aws_access_key_id=get_settings().aws_access_key_id,
-        aws_secret_access_key=get_settings().aws_secret_access_key,
-        region_name=get_settings().aws_region,
-    ) as client:
-        try:
-            response = await client.admin_get_user(
-                UserPoolId=user_pool_id, Username=user_id
-            )
+    member = await member_directory.get_member(user_pool_id, user_id)
 
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=str(e))
-
-        return Member(
-            user_id=user_id,
-            name=await get_attribute(response["UserAttributes"], "name"),
-            email=await get_attribute(response["UserAttributes"], "email"),
-            first_name=await get_attribute(response["UserAttributes"], "given_name"),
-            last_name=await get_attribute(response["UserAttributes"], "family_name"),
-            phone_number=await get_attribute(
-                response["UserAttributes"], "phone_number"
-            ),
-            enabled=response["Enabled"],
-            user_status=response["UserStatus"],
-            role=await get_role(user_id, user_pool_id),
-            id_locations=await get_member_locations(user_id),
-            created_at=response["UserCreateDate"],
-        )
+    member.user_id = user_id
+    member.pin_code = None
+
+    return member
 
 
 async def get_users(
@@ -67,90 +42,45 @@ async def get_users(
     if user_id:
         return await get_user(user_pool_id, user_id)
 
-    session = aioboto3.Session()
-    async with session.client(
-        "cognito-idp",
-        aws_access_key_id=get_settings().aws_access_key_id,
-        aws_secret_access_key=get_settings().aws_secret_access_key,
-        region_name=get_settings().aws_region,
-    ) as client:
-        try:
-            response = await client.list_users(UserPoolId=user_pool_id)
-
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=str(e))
+    items = await member_directory.get_members(user_pool_id)
 
+    if search:
         items = [
-            Member(
-                user_id=user["Username"],
-                name=await get_attribute(user["Attributes"], "name"),
-                email=await get_attribute(user["Attributes"], "email"),
-                first_name=await get_attribute(user["Attributes"], "given_name"),
-                last_name=await get_attribute(user["Attributes"], "family_name"),
-                phone_number=await get_attribute(user["Attributes"], "phone_number"),
-                enabled=user["Enabled"],
-                user_status=user["UserStatus"],
-                role=await get_role(user["Username"], user_pool_id),
-                pin_code=await get_pin_code(user["Username"], user_pool_id),
-                id_locations=await get_member_locations(user["Username"]),
-                created_at=user["UserCreateDate"],
-            )
-            for user in response["Users"]
+            item
+            for item in items
+            if search.lower() in str(item.name).lower()
+            or search in item.email
+            or search.lower() in str(item.first_name).lower()
+            or search.lower() in str(item.last_name).lower()
         ]
 
-        if search:
-            items = [
-                item
-                for item in items
-                if search.lower() in str(item.name).lower()
-                or search in item.email
-                or search.lower() in str(item.first_name).lower()
-                or search.lower() in str(item.last_name).lower()
-            ]
-
-        page = items[(page - 1) * size : page * size]
-
-        total = len(items)
-        pages = ceil(total / size)
-
-        return PaginatedMembers(
-            items=page,
-            total=total,
-            pages=pages,
-        )
+    page = items[(page - 1) * size : page * size]
+
+    total = len(items)
+    pages = ceil(total / size)
+
+    return PaginatedMembers(
+        items=page,
+        total=total,
+        pages=pages,
+    )
 
 
 async def get_user(user_pool_id: str, user_id: str):
-    session = aioboto3.Session()
-    async with session.client(
-        "cognito-idp",
-        aws_access_key_id=get_settings().aws_access_key_id,
-        aws_secret_access_key=get_settings().aws_secret_access_key,
-        region_name=get_settings().aws_region,
-    ) as client:
-        try:
-            response = await client.admin_get_user(
-                UserPoolId=user_pool_id, Username=user_id
-            )
+    member = await member_directory.get_member(user_pool_id, user_id)
+    member.pin_code = None
+
+    return member
 
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=str(e))
-
-        return Member(
-            user_id=response["Username"],
-            name=await get_attribute(response["UserAttributes"], "name"),
-            email=await get_attribute(response["UserAttributes"], "email"),
-            first_name=await get_attribute(response["UserAttributes"], "given_name"),
-            last_name=await get_attribute(response["UserAttributes"], "family_name"),
-            phone_number=await get_attribute(
-                response["UserAttributes"], "phone_number"
-            ),
-            enabled=response["Enabled"],
-            user_status=response["UserStatus"],
-            role=await get_role(response["Username"], user_pool_id),
-            id_locations=await get_member_locations(response["Username"]),
-            created_at=response["UserCreateDate"],
-        )
+
+async def get_members(user_pool_id: str, user_ids: List[str]) -> Dict[str, Member]:
+    """Members of the pool by user id, ids not in the pool are left out"""
+    members = await member_directory.get_many(user_pool_id, user_ids)
+
+    for member in members.values():
+        member.pin_code = None
+
+    return members
 
 
 async def get_email(response: list):
@@ -263,79 +193,72 @@ async def create_user(
     if member.pin_code:
         await check_pincode_unique(member.pin_code, id_org)
 
-    session = aioboto3.Session()
-    async with session.client(
-        "cognito-idp",
-        aws_access_key_id=get_settings().aws_access_key_id,
-        aws_secret_access_key=get_settings().aws_secret_access_key,
-        region_name=get_settings().aws_region,
-    ) as client:
-        user_attr = [
-            {"Name": "email", "Value": email},
-            {"Name": "name", "Value": member.name},
-            {"Name": "given_name", "Value": member.first_name},
-            {
-                "Name": "family_name",
-                "Value": member.last_name if member.last_name else "",
-            },
-            {"Name": "email_verified", "Value": "true"},
-        ]
+    client = await member_directory.client()
 
-        if member.phone_number:
-            user_attr.append(
-                {"Name": "phone_number", "Value": str(member.phone_number)},
-            )
+    user_attr = [
+        {"Name": "email", "Value": email},
+        {"Name": "name", "Value": member.name},
+        {"Name": "given_name", "Value": member.first_name},
+        {
+            "Name": "family_name",
+            "Value": member.last_name if member.last_name else "",
+        },
+        {"Name": "email_verified", "Value": "true"},
+    ]
 
-        response = await client.admin_create_user(
-            UserPoolId=user_pool_id,
-            Username=email,
-            UserAttributes=user_attr,
+    if member.phone_number:
+        user_attr.append(
+            {"Name": "phone_number", "Value": str(member.phone_number)},
         )
 
-        query = (
-            insert(Role)
-            .values(
-                user_id=response["User"]["Username"],
-                role=member.role,
-                pin_code=member.pin_code,
-                id_org=id_org,
-            )
-            .returning(Role)
-        )
+    response = await client.admin_create_user(
+        UserPoolId=user_pool_id,
+        Username=email,
+        UserAttributes=user_attr,
+    )
 
-        res = await db.session.execute(query)
-        await db.session.commit()
-        data = res.all().pop()
-
-        if member.id_locations:
-            for id_location in member.id_locations:
-                query = insert(LinkMemberLocation).values(
-                    user_id=response["User"]["Username"],
-                    id_location=id_location,
-                )
-                await db.session.execute(query)
-                await db.session.commit()
-
-        return Member(
+    query = (
+        insert(Role)
+        .values(
             user_id=response["User"]["Username"],
-            name=await get_attribute(response["User"]["Attributes"], "name"),
-            email=await get_attribute(response["User"]["Attributes"], "email"),
-            first_name=await get_attribute(
-                response["User"]["Attributes"], "given_name"
-            ),
-            last_name=await get_attribute(
-                response["User"]["Attributes"], "family_name"
-            ),
-            enabled=response["User"]["Enabled"],
-            phone_number=await get_attribute(
-                response["User"]["Attributes"], "phone_number"
-            ),
-            user_status=response["User"]["UserStatus"],
-            role=data.role,
-            pin_code=data.pin_code,
-            id_locations=await get_member_locations(response["User"]["Username"]),
-            created_at=response["User"]["UserCreateDate"],
+            role=member.role,
+            pin_code=member.pin_code,
+            id_org=id_org,
         )
+        .returning(Role)
+    )
+
+    res = await db.session.execute(query)
+    await db.session.commit()
+    data = res.all().pop()
+
+    if member.id_locations:
+        for id_location in member.id_locations:
+            query = insert(LinkMemberLocation).values(
+                user_id=response["User"]["Username"],
+                id_location=id_location,
+            )
+            await db.session.execute(query)
+            await db.session.commit()
+
+    await member_directory.invalidate(user_pool_id, response["User"]["Username"])
+
+    return Member(
+        user_id=response["User"]["Username"],
+        name=await get_attribute(response["User"]["Attributes"], "name"),
+        email=await get_attribute(response["User"]["Attributes"], "email"),
+        first_name=await get_attribute(response["User"]["Attributes"], "given_name"),
+        last_name=await get_attribute(response["User"]["Attributes"], "family_name"),
+        enabled=response["User"]["Enabled"],
+        phone_number=await get_attribute(
+            response["User"]["Attributes"], "phone_number"
+        ),
+        user_status=response["User"]["UserStatus"],
+        role=data.role,
+        pin_code=data.pin_code,
+        id_locations=await get_member_locations(response["User"]["Username"]),
+        created_at=response["User"]["UserCreateDate"],
+    )
 
 
 async def update_user(
@@ -343,87 +266,84 @@ async def update_user(
 ):
     if member.pin_code:
         await check_pincode_unique(member.pin_code, id_org, user_id)
-    session = aioboto3.Session()
-    async with session.client(
-        "cognito-idp",
-        aws_access_key_id=get_settings().aws_access_key_id,
-        aws_secret_access_key=get_settings().aws_secret_access_key,
-        region_name=get_settings().aws_region,
-    ) as client:
-        user_attr = [
-            {"Name": "name", "Value": member.name},
-            {"Name": "given_name", "Value": member.first_name},
-            {
-                "Name": "family_name",
-                "Value": member.last_name if member.last_name else "",
-            },
-            {"Name": "email_verified", "Value": "true"},
-        ]
+    client = await member_directory.client()
+
+    user_attr = [
+        {"Name": "name", "Value": member.name},
+        {"Name": "given_name", "Value": member.first_name},
+        {
+            "Name": "family_name",
+            "Value": member.last_name if member.last_name else "",
+        },
+        {"Name": "email_verified", "Value": "true"},
+    ]
 
-        if member.phone_number:
-            user_attr.append(
-                {"Name": "phone_number", "Value": str(member.phone_number)},
-            )
+    if member.phone_number:
+        user_attr.append(
+            {"Name": "phone_number", "Value": str(member.phone_number)},
+        )
 
-        await client.admin_update_user_attributes(
-            UserPoolId=user_pool_id,
-            Username=user_id,
-            UserAttributes=user_attr,
+    await client.admin_update_user_attributes(
+        UserPoolId=user_pool_id,
+        Username=user_id,
+        UserAttributes=user_attr,
+    )
+
+    query = (
+        update(Role)
+        .where(
+            Role.user_id == user_id,
+            Role.id_org == id_org,
         )
+        .values(role=member.role, pin_code=member.pin_code)
+        .returning(Role)
+    )
 
-        query = (
-            update(Role)
-            .where(
-                Role.user_id == user_id,
-                Role.id_org == id_org,
-            )
-            .values(role=member.role, pin_code=member.pin_code)
-            .returning(Role)
+    if member.id_locations:
+        del_query = delete(LinkMemberLocation).where(
+            LinkMemberLocation.user_id == user_id
         )
+        await db.session.execute(del_query)
+        await db.session.commit()
 
-        if member.id_locations:
-            del_query = delete(LinkMemberLocation).where(
-                LinkMemberLocation.user_id == user_id
+        for id_location in member.id_locations:
+            ins_query = insert(LinkMemberLocation).values(
+                user_id=user_id,
+                id_location=id_location,
             )
-            await db.session.execute(del_query)
+            await db.session.execute(ins_query)
             await db.session.commit()
 
-            for id_location in member.id_locations:
-                ins_query = insert(LinkMemberLocation).values(
-                    user_id=user_id,
-                    id_location=id_location,
-                )
-                await db.session.execute(ins_query)
-                await db.session.commit()
-
-        else:
-            del_query = delete(LinkMemberLocation).where(
-                LinkMemberLocation.user_id == user_id
+    else:
+        del_query = delete(LinkMemberLocation).where(
+            LinkMemberLocation.user_id == user_id
+        )
+        await db.session.execute(del_query)
+        await db.session.commit()
+
+    response = await db.session.execute(query)
+    await db.session.commit()
+
+    data = response.all()
+
+    if len(data) == 0:
+        query = (
+            insert(Role)
+            .values(
+                user_id=user_id,
+                role=member.role,
+                pin_code=member.pin_code,
+                id_org=id_org,
             )
-            await db.session.execute(del_query)
-            await db.session.commit()
+            .returning(Role)
+        )
 
         response = await db.session.execute(query)
         await db.session.commit()
 
-        data = response.all()
-
-        if len(data) == 0:
-            query = (
-                insert(Role)
-                .values(
-                    user_id=user_id,
-                    role=member.role,
-                    pin_code=member.pin_code,
-                    id_org=id_org,
-                )
-                .returning(Role)
-            )
-
-            response = await db.session.execute(query)
-            await db.session.commit()
+    await member_directory.invalidate(user_pool_id, user_id)
 
-        return {"detail": "User updated"}
+    return {"detail": "User updated"}
 
 
 async def patch_user(
@@ -447,86 +367,83 @@ async def patch_user(
         await check_pincode_unique(member.pin_code, id_org, user_id)
         selected_member.pin_code = member.pin_code
 
-    session = aioboto3.Session()
-    async with session.client(
-        "cognito-idp",
-        aws_access_key_id=get_settings().aws_access_key_id,
-        aws_secret_access_key=get_settings().aws_secret_access_key,
-        region_name=get_settings().aws_region,
-    ) as client:
-        user_attr = [
-            {"Name": "name", "Value": selected_member.name},
-            {"Name": "given_name", "Value": selected_member.first_name},
-            {
-                "Name": "family_name",
-                "Value": selected_member.last_name if selected_member.last_name else "",
-            },
-        ]
+    client = await member_directory.client()
 
-        if selected_member.phone_number:
-            user_attr.append(
-                {"Name": "phone_number", "Value": str(selected_member.phone_number)},
-            )
+    user_attr = [
+        {"Name": "name", "Value": selected_member.name},
+        {"Name": "given_name", "Value": selected_member.first_name},
+        {
+            "Name": "family_name",
+            "Value": selected_member.last_name if selected_member.last_name else "",
+        },
+    ]
 
-        await client.admin_update_user_attributes(
-            UserPoolId=user_pool_id,
-            Username=user_id,
-            UserAttributes=user_attr,
+    if selected_member.phone_number:
+        user_attr.append(
+            {"Name": "phone_number", "Value": str(selected_member.phone_number)},
         )
 
-        query = (
-            update(Role)
-            .where(
-                Role.user_id == user_id,
-                Role.id_org == id_org,
-            )
-            .values(role=selected_member.role, pin_code=selected_member.pin_code)
-            .returning(Role)
+    await client.admin_update_user_attributes(
+        UserPoolId=user_pool_id,
+        Username=user_id,
+        UserAttributes=user_attr,
+    )
+
+    query = (
+        update(Role)
+        .where(
+            Role.user_id == user_id,
+            Role.id_org == id_org,
         )
+        .values(role=selected_member.role, pin_code=selected_member.pin_code)
+        .returning(Role)
+    )
 
-        if member.id_locations:
-            del_query = delete(LinkMemberLocation).where(
-                LinkMemberLocation.user_id == user_id
-            )
-            await db.session.execute(del_query)
-            await db.session.commit()
+    if member.id_locations:
+        del_query = delete(LinkMemberLocation).where(
+            LinkMemberLocation.user_id == user_id
+        )
+        await db.session.execute(del_query)
+        await db.session.commit()
 
-            for id_location in member.id_locations:
-                ins_query = insert(LinkMemberLocation).values(
-                    user_id=user_id,
-                    id_location=id_location,
-                )
-                await db.session.execute(ins_query)
-                await db.session.commit()
-
-        else:
-            del_query = delete(LinkMemberLocation).where(
-                LinkMemberLocation.user_id == user_id
+        for id_location in member.id_locations:
+            ins_query = insert(LinkMemberLocation).values(
+                user_id=user_id,
+                id_location=id_location,
             )
-            await db.session.execute(del_query)
+            await db.session.execute(ins_query)
             await db.session.commit()
 
-        response = await db.session.execute(query)
+    else:
+        del_query = delete(LinkMemberLocation).where(
+            LinkMemberLocation.user_id == user_id
+        )
+        await db.session.execute(del_query)
         await db.session.commit()
 
-        data = response.all()
-
-        if len(data) == 0:
-            query = (
-                insert(Role)
-                .values(
-                    user_id=user_id,
-                    role=selected_member.role,
-                    pin_code=selected_member.pin_code,
-                    id_org=id_org,
-                )
-                .returning(Role)
+    response = await db.session.execute(query)
+    await db.session.commit()
+
+    data = response.all()
+
+    if len(data) == 0:
+        query = (
+            insert(Role)
+            .values(
+                user_id=user_id,
+                role=selected_member.role,
+                pin_code=selected_member.pin_code,
+                id_org=id_org,
             )
+            .returning(Role)
+        )
 
-            response = await db.session.execute(query)
-            await db.session.commit()
+        response = await db.session.execute(query)
+        await db.session.commit()
 
-        return {"detail": "User patched"}
+    await member_directory.invalidate(user_pool_id, user_id)
+
+    return {"detail": "User patched"}
 
 
 async def patch_users(
@@ -567,93 +484,77 @@ async def update_members_csv(id_org: UUID, member: Member, id_user: str):
 
 
 async def delete_user(user_pool_id: str, user_id: str):
-    session = aioboto3.Session()
-    async with session.client(
-        "cognito-idp",
-        aws_access_key_id=get_settings().aws_access_key_id,
-        aws_secret_access_key=get_settings().aws_secret_access_key,
-        region_name=get_settings().aws_region,
-    ) as client:
+    client = await member_directory.client()
+
+    try:
+        await client.admin_delete_user(UserPoolId=user_pool_id, Username=user_id)
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    query = delete(Role).where(Role.user_id == user_id)
+    await db.session.execute(query)
+    await db.session.commit()
+
+    await member_directory.invalidate(user_pool_id, user_id)
+
+    return {"detail": "User deleted"}
+
+
+async def delete_users(user_pool_id: str, user_ids: List[str]):
+    client = await member_directory.client()
+
+    for user_id in user_ids:
         try:
             await client.admin_delete_user(UserPoolId=user_pool_id, Username=user_id)
 
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=str(e))
+        except Exception:
+            # Continue with the next user instead of stopping the whole process
+            continue
 
         query = delete(Role).where(Role.user_id == user_id)
         await db.session.execute(query)
         await db.session.commit()
 
-        return {"detail": "User deleted"}
+    await member_directory.invalidate(user_pool_id)
 
-
-async def delete_users(user_pool_id: str, user_ids: List[str]):
-    session = aioboto3.Session()
-    async with session.client(
-        "cognito-idp",
-        aws_access_key_id=get_settings().aws_access_key_id,
-        aws_secret_access_key=get_settings().aws_secret_access_key,
-        region_name=get_settings().aws_region,
-    ) as client:
-        for user_id in user_ids:
-            try:
-                await client.admin_delete_user(
-                    UserPoolId=user_pool_id, Username=user_id
-                )
-
-            except Exception:
-                # Continue with the next user instead of stopping the whole process
-                continue
-
-            query = delete(Role).where(Role.user_id == user_id)
-            await db.session.execute(query)
-            await db.session.commit()
-
-        return {"detail": "Users deleted"}
+    return {"detail": "Users deleted"}
 
 
 async def verify_email(user_pool_id: str, user_id: str):
-    session = aioboto3.Session()
-    async with session.client(
-        "cognito-idp",
-        aws_access_key_id=get_settings().aws_access_key_id,
-        aws_secret_access_key=get_settings().aws_secret_access_key,
-        region_name=get_settings().aws_region,
-    ) as client:
-        try:
-            await client.admin_update_user_attributes(
-                UserPoolId=user_pool_id,
-                Username=user_id,
-                UserAttributes=[{"Name": "email_verified", "Value": "True"}],
-            )
+    client = await member_directory.client()
+
+    try:
+        await client.admin_update_user_attributes(
+            UserPoolId=user_pool_id,
+            Username=user_id,
+            UserAttributes=[{"Name": "email_verified", "Value": "True"}],
+        )
 
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
     return {"detail": "Email verified"}
 
 
 async def switch_member_status(user_pool_id: str, user_id: str, enabled: bool):
-    session = aioboto3.Session()
-    async with session.client(
-        "cognito-idp",
-        aws_access_key_id=get_settings().aws_access_key_id,
-        aws_secret_access_key=get_settings().aws_secret_access_key,
-        region_name=get_settings().aws_region,
-    ) as client:
-        match enabled:
-            case True:
-                await client.admin_enable_user(
-                    UserPoolId=user_pool_id,
-                    Username=user_id,
-                )
-            case False:
-                await client.admin_disable_user(
-                    UserPoolId=user_pool_id,
-                    Username=user_id,
-                )
-
-        return {"detail": "User activated" if enabled else "User deactivated"}
+    client = await member_directory.client()
+
+    match enabled:
+        case True:
+            await client.admin_enable_user(
+                UserPoolId=user_pool_id,
+                Username=user_id,
+            )
+        case False:
+            await client.admin_disable_user(
+                UserPoolId=user_pool_id,
+                Username=user_id,
+            )
+
+    await member_directory.invalidate(user_pool_id, user_id)
+
+    return {"detail": "User activated" if enabled else "User deactivated"}
 
 
 async def check_pincode_unique(
@@ -0,0 +1,254 @@
+import asyncio
+import time
+from contextlib import AsyncExitStack
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import aioboto3
+from config import get_settings
+from fastapi import HTTPException
+from fastapi_async_sqlalchemy import db
+from sqlalchemy import insert, select
+from util.invalidation import invalidation_bus
+
+from ..organization.model import Org
+from .model import LinkMemberLocation, Member, Role, RoleType
+
+
+def parse_member(user: dict) -> Member:
+    """Builds a member from a list_users or admin_get_user entry, without its role"""
+    attributes = {
+        attr["Name"]: attr["Value"]
+        for attr in user.get("Attributes", user.get("UserAttributes", []))
+    }
+
+    return Member(
+        user_id=user["Username"],
+        name=attributes.get("name"),
+        email=attributes.get("email"),
+        first_name=attributes.get("given_name"),
+        last_name=attributes.get("family_name"),
+        phone_number=attributes.get("phone_number"),
+        enabled=user["Enabled"],
+        user_status=user["UserStatus"],
+        created_at=user["UserCreateDate"],
+    )
+
+
+class MemberDirectory:
+    """Members of each Cognito user pool, with their roles and locations
+
+    A pool is listed with paginated list_users calls and its members are
+    hydrated with one query for roles and one for locations, then kept for
+    member_directory_ttl seconds or until a member of the pool changes.
+    Every Cognito call goes through a single long-lived client.
+    """
+
+    def __init__(self):
+        # user_pool -> (synced_at, user ids in Cognito order)
+        self.pools: Dict[str, Tuple[float, List[str]]] = {}
+        # (user_pool, user_id) -> (loaded_at, member)
+        self.members: Dict[Tuple[str, str], Tuple[float, Member]] = {}
+        self._client = None
+        self._stack: Optional[AsyncExitStack] = None
+        self._client_lock = asyncio.Lock()
+        self._sync_locks: Dict[str, asyncio.Lock] = {}
+
+    async def client(self):
+        """The shared cognito-idp client, opened on first use"""
+        if self._client:
+            return self._client
+
+        async with self._client_lock:
+            if not self._client:
+                self._stack = AsyncExitStack()
+                self._client = await self._stack.enter_async_context(
+                    aioboto3.Session().client(
+                        "cognito-idp",
+                        aws_access_key_id=get_settings().aws_access_key_id,
+                        aws_secret_access_key=get_settings().aws_secret_access_key,
+                        region_name=get_settings().aws_region,
+                    )
+                )
+
+        return self._client
+
+    async def close(self):
+        if self._stack:
+            await self._stack.aclose()
+
+        self._client = None
+        self._stack = None
+
+    def _fresh(self, cached: Optional[tuple]) -> bool:
+        return bool(
+            cached
+            and time.monotonic() - cached[0] < get_settings().member_directory_ttl
+        )
+
+    async def _hydrate(self, user_pool: str, members: List[Member]):
+        """Sets role, pin code and locations of the members in two queries
+
+        Members without a role get an admin one, like get_role does.
+        """
+        user_ids = [member.user_id for member in members]
+
+        response = await db.session.execute(
+            select(Role.user_id, Role.role, Role.pin_code).where(
+                Role.user_id.in_(user_ids)
+            )
+        )
+
+        roles = {}
+        for user_id, role, pin_code in response.all():
+            roles.setdefault(user_id, (role, pin_code))
+
+        missing = [user_id for user_id in user_ids if user_id not in roles]
+
+        if missing:
+            response = await db.session.execute(
+                select(Org.id).where(Org.user_pool == user_pool)
+            )
+            id_org = response.scalar_one_or_none()
+
+            if id_org:
+                await db.session.execute(
+                    insert(Role).values(
+                        [
+                            dict(user_id=user_id, role=RoleType.admin, id_org=id_org)
+                            for user_id in missing
+                        ]
+                    )
+                )
+                await db.session.commit()
+
+                roles.update({user_id: (RoleType.admin, None) for user_id in missing})
+
+        response = await db.session.execute(
+            select(LinkMemberLocation.user_id, LinkMemberLocation.id_location).where(
+                LinkMemberLocation.user_id.in_(user_ids)
+            )
+        )
+
+        locations: Dict[str, list] = {}
+        for user_id, id_location in response.all():
+            locations.setdefault(user_id, []).append(id_location)
+
+        now = time.monotonic()
+
+        for member in members:
+            member.role, member.pin_code = roles.get(member.user_id, (None, None))
+            member.id_locations = locations.get(member.user_id, [])
+
+            self.members[(user_pool, member.user_id)] = (now, member)
+
+    async def _sync(self, user_pool: str):
+        client = await self.client()
+        members = []
+        kwargs = {}
+
+        try:
+            while True:
+                response = await client.list_users(UserPoolId=user_pool, **kwargs)
+                members.extend(parse_member(user) for user in response["Users"])
+
+                if not response.get("PaginationToken"):
+                    break
+
+                kwargs["PaginationToken"] = response["PaginationToken"]
+
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+
+        if members:
+            await self._hydrate(user_pool, members)
+
+        self.pools[user_pool] = (
+            time.monotonic(),
+            [member.user_id for member in members],
+        )
+
+    async def get_members(self, user_pool: str) -> List[Member]:
+        """Every member of a user pool, with role, pin code and locations"""
+        lock = self._sync_locks.setdefault(user_pool, asyncio.Lock())
+
+        async with lock:
+            if not self._fresh(self.pools.get(user_pool)):
+                await self._sync(user_pool)
+
+            user_ids = self.pools[user_pool][1]
+
+        return [
+            self.members[(user_pool, user_id)][1].copy()
+            for user_id in user_ids
+            if (user_pool, user_id) in self.members
+        ]
+
+    async def get_member(self, user_pool: str, user_id: str) -> Member:
+        """A single member, raises an HTTPException if Cognito can't find it"""
+        cached = self.members.get((user_pool, user_id))
+
+        if self._fresh(cached):
+            return cached[1].copy()
+
+        client = await self.client()
+
+        try:
+            response = await client.admin_get_user(
+                UserPoolId=user_pool, Username=user_id
+            )
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+
+        member = parse_member(response)
+        await self._hydrate(user_pool, [member])
+
+        return member.copy()
+
+    async def get_many(
+        self, user_pool: str, user_ids: Iterable[str]
+    ) -> Dict[str, Member]:
+        """Members by user id, lists the pool once instead of a call per member
+
+        Ids that are not members of the pool are left out.
+        """
+        user_ids = set(str(user_id) for user_id in user_ids)
+
+        if not user_ids:
+            return {}
+
+        members = {
+            user_id: self.members[(user_pool, user_id)][1].copy()
+            for user_id in user_ids
+            if self._fresh(self.members.get((user_pool, user_id)))
+        }
+
+        if len(members) < len(user_ids):
+            members = {
+                member.user_id: member
+                for member in await self.get_members(user_pool)
+                if member.user_id in user_ids
+            }
+
+        return members
+
+    def drop(self, key: str):
+        user_pool, _, user_id = key.partition(":")
+
+        # Any change to a member also changes the pool listing
+        self.pools.pop(user_pool, None)
+
+        if user_id:
+            self.members.pop((user_pool, user_id), None)
+        else:
+            for cached in [k for k in self.members if k[0] == user_pool]:
+                self.members.pop(cached, None)
+
+    async def invalidate(self, user_pool: str, user_id: Optional[str] = None):
+        key = f"{user_pool}:{user_id}" if user_id else user_pool
+
+        await invalidation_bus.invalidate("member-directory", key)
+
+
+member_directory = MemberDirectory()
+
+invalidation_bus.register("member-directory", member_directory.drop)
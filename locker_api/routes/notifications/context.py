@@ -0,0 +1,58 @@
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+from uuid import UUID
+
+from config import get_settings
+from util.invalidation import invalidation_bus
+
+
+@dataclass
+class OrgContext:
+    """White-label, settings and sender data shared by every message of an org"""
+
+    org_name: str
+    app_logo: Optional[str]
+    selected_duration: str
+    default_support_phone: Optional[str]
+    default_support_email: Optional[str]
+    messaging_service_sid: str
+    email_sender: str
+    is_ups_org: bool
+
+
+class OrgContextCache:
+    """Caches OrgContext per org until its white label, settings or place in
+    the org tree change
+
+    Contexts are built by the loader set in templates, so the org, settings
+    and white label controllers can invalidate them without importing it.
+    """
+
+    def __init__(self):
+        self.loader: Optional[Callable[[UUID], Awaitable[OrgContext]]] = None
+        # id_org -> (loaded_at, context)
+        self.contexts: Dict[str, Tuple[float, OrgContext]] = {}
+
+    async def get(self, id_org: UUID) -> OrgContext:
+        cached = self.contexts.get(str(id_org))
+        ttl = get_settings().notification_context_ttl
+
+        if cached and time.monotonic() - cached[0] < ttl:
+            return cached[1]
+
+        context = await self.loader(id_org)
+        self.contexts[str(id_org)] = (time.monotonic(), context)
+
+        return context
+
+    def drop(self, id_org: str):
+        self.contexts.pop(id_org, None)
+
+    async def invalidate(self, id_org: UUID):
+        await invalidation_bus.invalidate("notification-context", id_org)
+
+
+org_contexts = OrgContextCache()
+
+invalidation_bus.register("notification-context", org_contexts.drop)
@@ -1,7 +1,7 @@
+import asyncio
 from datetime import datetime, timedelta
 from math import ceil
-from pathlib import Path
-from typing import Optional
+from typing import Dict, List, Optional, Tuple
 from uuid import UUID
 from uuid import uuid4
 
@@ -13,17 +13,11 @@ from sqlalchemy import VARCHAR, cast, delete, insert, or_, select, update
 from twilio.rest import Client
 from util import email
 
-from util.scheduler import scheduler
+from util.scheduler import migrate_jobs, scheduler
 
 from ..event.model import Event
 from ..organization.model import Org
-from ..organization.controller import (
-    get_org_messaging_service_sid,
-    get_org_sendgrid_auth_sender,
-    is_ups_org,
-)
-from ..settings.controller import get_settings_org
-from ..white_label.controller import partner_get_white_label
+from ..member.controller import get_members as get_cognito_members
 from ..member.controller import get_user as get_cognito_member
 from .default_notifications import DEFAULT_NOTIFICATIONS
 from .model import (
@@ -34,6 +28,9 @@ from .model import (
     TimeUnit,
     RecipientType,
 )
+from .digest import current_digest
+from .rules import notification_rules
+from .templates import org_contexts, render_email, render_message
 
 
 async def partner_get_notification(id_notification: UUID, id_org: UUID):
@@ -136,22 +133,23 @@ async def partner_get_notifications(
 
     notifcations = data.unique().scalars().all()
 
+    notifcations = [Notification.Read.parse_obj(n) for n in notifcations]
+
+    # Members are resolved together from the cached member directory
+    try:
+        members = await get_cognito_members(
+            user_pool, [str(n.id_member) for n in notifcations if n.id_member]
+        )
+    except Exception:
+        members = {}
+
     result = []
-    # add a cache to avoid multiple requests to cognito
-    members = {}
     for notification in notifcations:
-        notification = Notification.Read.parse_obj(notification)
         if notification.id_member:
-            if notification.id_member not in members:
-                try:
-                    member = await get_cognito_member(
-                        user_pool, str(notification.id_member)
-                    )
-                    notification.member = member
-                    result.append(notification)
-                    members[notification.id_member] = member
-                except Exception:
-                    pass
+            member = members.get(str(notification.id_member))
+            if member:
+                notification.member = member
+                result.append(notification)
         else:
             result.append(notification)
 
@@ -270,6 +268,8 @@ async def partner_create_notification(
     else:
         await db.session.commit()
 
+    await notification_rules.invalidate(id_org)
+
     return inserted_notification
 
 
@@ -332,6 +332,8 @@ async def partner_update_notification(
         await db.session.execute(query)
         await db.session.commit()
 
+    await notification_rules.invalidate(id_org)
+
     updated_notification = response.all().pop()
 
     return updated_notification
@@ -403,6 +405,8 @@ async def partner_patch_notification(
         await db.session.execute(query)
         await db.session.commit()
 
+    await notification_rules.invalidate(id_org)
+
     updated_notification = response.all().pop()
 
     return updated_notification
@@ -438,6 +442,8 @@ async def partner_delete_notification(id_notification: UUID, id_org: UUID):
     await db.session.execute(query)
     await db.session.commit()
 
+    await notification_rules.invalidate(id_org)
+
     try:
         deleted_notification = response.all().pop()
 
@@ -466,179 +472,180 @@ async def partner_delete_notifications(id_notifications: list[UUID], id_org: UUI
     await db.session.execute(query)
     await db.session.commit()
 
+    await notification_rules.invalidate(id_org)
+
     return {"detail": "Notifications deleted"}
 
 
 async def replace_tags(event: Event.Read, notification: Notification.Read) -> str:
-    wl = await partner_get_white_label(event.id_org)
-    message = notification.message
-
-    org_settings = await get_settings_org(event.id_org)
-
-    # build web app URL
-    settings = get_settings()
-    base_map = {
-        "local": "web",
-        "dev": "web-dev",
-        "qa": "web-qa",
-        "staging": "web-staging",
-        "production": "web",
-    }
-
-    pickup_url = (
-        f"http://{base_map[settings.environment]}.koloni.io/ready-pickup/?id={event.id}"
-    )
-    status_url = (
-        f"http://{base_map[settings.environment]}.koloni.io/active-transactions"
-    )
-
-    message = (
-        message.replace("((order_id))", event.invoice_id if event.invoice_id else "")
-        .replace(
-            "((unit))",
-            (
-                event.device.price.unit.value
-                if event.device and event.device.price
-                else ""
-            ),
-        )
-        .replace("((pickup_url))", pickup_url)
-        .replace("((status_url))", status_url)
-        .replace("((URL))", status_url)
-        .replace(
-            "((currency))",
-            (
-                event.device.price.currency.value.upper()
-                if event.device and event.device.price
-                else "USD"
-            ),
-        )
-        .replace(
-            "((weight))",
-            str(event.weight) if event.weight else "0",
-        )
-        .replace("((user_name))", event.user.name if event.user else "")
-        .replace(
-            "((location_name))",
-            (
-                event.device.location.name
-                if event.device and event.device.location
-                else ""
-            ),
-        )
-        .replace(
-            "((location_address))",
-            (
-                event.device.location.address
-                if event.device and event.device.location
-                else ""
-            ),
-        )
-        .replace(
-            "((locker_number))", str(event.device.locker_number if event.device else "")
-        )
-        .replace("((charged_amount))", str(event.total))
-        .replace("((amount))", str(event.total))
-        .replace("((org_name))", wl.app_name if wl else "")
-        .replace(
-            "((selected_duration))",
-            f"{org_settings.parcel_expiration} {org_settings.parcel_expiration_unit}",
-        )
-    )
+    context = await org_contexts.get(event.id_org)
 
-    return message
+    return render_message(event, notification, context)
 
 
 async def format_email(event: Event.Read, notification: Notification.Read) -> str:
-    wl = await partner_get_white_label(event.id_org)
-
-    ROOT_DIR = Path(__file__).parent
-    psub_file = ROOT_DIR / "notification_template.html"
-    with open(psub_file) as f:
-        contents = f.read()
-        return (
-            contents.replace("{{org_name}}", wl.app_name if wl else "")
-            .replace(
-                "{{org_logo}}",
-                (
-                    event.device.location.image
-                    if event.device.location.image
-                    else wl.app_logo
-                ),
-            )
-            .replace("{{order_id}}", event.invoice_id)
-            .replace("{{location_address}}", event.device.location.address)
-            .replace("{{message}}", await replace_tags(event, notification))
-        )
+    context = await org_contexts.get(event.id_org)
+
+    return render_email(event, render_message(event, notification, context), context)
 
 
 async def send_notification(event: Event, notification: Notification.Read):
     """Send a notification to the user."""
+    # Bulk operations send their notifications together, see digest.py
+    digest = current_digest.get()
+    if digest:
+        digest.add(event, notification)
+        return
+
     print("SENDING NOTIFICATION")
     try:
+        context = await org_contexts.get(event.id_org)
+        message = render_message(event, notification, context)
+
         match notification.recipient_type:
             case RecipientType.user:
                 if notification.sms and event.user.phone_number:
-                    # Variable used to handle custom Twilio Messaging Service SIDs depending
-                    # on the org given:
-                    messaging_service_sid = await get_org_messaging_service_sid(
-                        event.id_org
-                    )
-
                     client = Client(
                         get_settings().twilio_sid, get_settings().twilio_secret
                     )
                     client.messages.create(
                         to=event.user.phone_number,
-                        from_=messaging_service_sid,
-                        body=await replace_tags(event, notification),
+                        # custom Twilio Messaging Service SIDs depending on the org
+                        from_=context.messaging_service_sid,
+                        body=message,
                     )  # raise TwilioRestException
 
                 if notification.email and event.user.email:
-                    email_sender = await get_org_sendgrid_auth_sender(event.id_org)
-
                     email.send(
-                        email_sender,
+                        context.email_sender,
                         event.user.email,
                         "notification",
-                        await format_email(event, notification),
-                        is_ups_org=await is_ups_org(event.id_org),
+                        render_email(event, message, context),
+                        is_ups_org=context.is_ups_org,
                     )
             case RecipientType.admin:
-                settings = await get_settings_org(event.id_org)
                 if notification.sms:
-                    # Variable used to handle custom Twilio Messaging Service SIDs depending
-                    # on the org given:
-                    messaging_service_sid = await get_org_messaging_service_sid(
-                        event.id_org
-                    )
-
                     client = Client(
                         get_settings().twilio_sid, get_settings().twilio_secret
                     )
                     client.messages.create(
                         to=event.device.location.contact_phone
-                        or settings.default_support_phone,
-                        from_=messaging_service_sid,
-                        body=await replace_tags(event, notification),
+                        or context.default_support_phone,
+                        from_=context.messaging_service_sid,
+                        body=message,
                     )  # raise TwilioRestException
 
                 if notification.email:
-                    email_sender = await get_org_sendgrid_auth_sender(event.id_org)
-
                     email.send(
-                        email_sender,
+                        context.email_sender,
                         event.device.location.contact_email
-                        or settings.default_support_email,
+                        or context.default_support_email,
                         "notification",
-                        await format_email(event, notification),
-                        is_ups_org=await is_ups_org(event.id_org),
+                        render_email(event, message, context),
+                        is_ups_org=context.is_ups_org,
                     )
     except Exception as e:
         print("EXCEPTION::", e)
         pass
 
 
+class ScheduledNotificationLoader:
+    """Loads the events and notifications of jobs firing together in bulk
+
+    Jobs scheduled for the same moment (e.g. the user and admin notifications
+    of an event) fire within a few milliseconds of each other; their lookups
+    are collected for notification_loader_window seconds and answered with
+    one query for the events and one for the notifications.
+    """
+
+    def __init__(self):
+        self.pending: Dict[Tuple[UUID, UUID], List[asyncio.Future]] = {}
+        self.flush: Optional[asyncio.Task] = None
+
+    async def load(
+        self, id_event: UUID, id_notification: UUID
+    ) -> Tuple[Optional[Event], Optional[Notification]]:
+        future = asyncio.get_running_loop().create_future()
+        self.pending.setdefault((id_event, id_notification), []).append(future)
+
+        if not self.flush or self.flush.done():
+            self.flush = asyncio.create_task(self._flush())
+
+        return await future
+
+    async def _flush(self):
+        await asyncio.sleep(get_settings().notification_loader_window)
+
+        batch, self.pending = self.pending, {}
+
+        try:
+            async with db():
+                response = await db.session.execute(
+                    select(Event).where(Event.id.in_({key[0] for key in batch}))
+                )
+                events = {event.id: event for event in response.unique().scalars()}
+
+                response = await db.session.execute(
+                    select(Notification).where(
+                        Notification.id.in_({key[1] for key in batch})
+                    )
+                )
+                notifications = {
+                    notification.id: notification
+                    for notification in response.unique().scalars()
+                }
+        except Exception as e:
+            for futures in batch.values():
+                for future in futures:
+                    future.set_exception(e)
+            return
+
+        for (id_event, id_notification), futures in batch.items():
+            for future in futures:
+                future.set_result(
+                    (events.get(id_event), notifications.get(id_notification))
+                )
+
+
+notification_loader = ScheduledNotificationLoader()
+
+
+async def send_scheduled_notification(
+    id_event: str,
+    id_notification: str,
+    notify_type: str,
+):
+    """Scheduler entry point, sends a notification with the current event data"""
+    event, notification = await notification_loader.load(
+        UUID(id_event), UUID(id_notification)
+    )
+
+    # The event or notification was deleted, or the notification was changed
+    # to another type since the job was scheduled
+    if not event or not notification:
+        return
+
+    if notification.notification_type != NotificationType(notify_type):
+        return
+
+    # Scheduler jobs run outside of a request
+    async with db():
+        await send_notification(event, notification)
+
+
+def migrate_notification_jobs():
+    """Rewrites notification jobs stored with pickled events to the id format"""
+    migrate_jobs(
+        send_notification,
+        send_scheduled_notification,
+        lambda event, notification: [
+            str(event.id),
+            str(notification.id),
+            notification.notification_type.value,
+        ],
+    )
+
+
 async def create_notify_job_on_event(
     id_event: UUID,
     notify_type: NotificationType,
@@ -654,22 +661,13 @@ async def create_notify_job_on_event(
         print("No event")
         return
 
-    query = select(Notification).where(
-        Notification.notification_type == notify_type,
-        Notification.mode == event.event_type,
-        Notification.id_org == event.id_org,
+    notifications = await notification_rules.get_rules(
+        event.id_org, notify_type, event.event_type, event.device.id_location
     )
-    data = await db.session.execute(query)
-
-    notifications = data.unique().scalars().all()
 
     for notification in notifications:
         trigger_date = None
 
-        id_locations = [location.id for location in notification.locations]
-        if id_locations and event.device.id_location not in id_locations:
-            continue
-
         match notification.time_unit:
             case TimeUnit.minute:
                 trigger_date = datetime.utcnow() + timedelta(
@@ -691,11 +689,12 @@ async def create_notify_job_on_event(
                 await send_notification(event, notification)
                 continue
 
+        # Only ids are stored, the job loads fresh data when it fires
         scheduler.add_job(
-            func=send_notification,
+            func=send_scheduled_notification,
             trigger="date",
             run_date=trigger_date,
             id=str(uuid4()),
-            args=[event, notification],
+            args=[str(event.id), str(notification.id), notify_type.value],
             replace_existing=True,
         )
@@ -0,0 +1,263 @@
+import asyncio
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+from uuid import UUID
+
+from config import get_settings
+from twilio.rest import Client
+from util import email
+
+from ..event.model import Event, NotificationOutcome
+from .model import Notification, RecipientType
+from .templates import (
+    OrgContext,
+    bulk_email_shell,
+    email_values,
+    org_contexts,
+    render_message,
+)
+
+# Twilio rejects bodies over 1600 characters
+SMS_MAX_LENGTH = 1600
+
+# SendGrid accepts up to 1000 personalizations per request, each with at
+# most 10000 bytes of substitutions
+SENDGRID_MAX_PERSONALIZATIONS = 1000
+SENDGRID_MAX_SUBSTITUTIONS = 10000
+
+SMS_CONCURRENCY = 10
+
+# (channel, recipient, id_notification) -> [(event, message, context)]
+DigestGroups = Dict[Tuple[str, str, UUID], List[Tuple[Event, str, OrgContext]]]
+
+current_digest: ContextVar[Optional["NotificationDigest"]] = ContextVar(
+    "notification_digest", default=None
+)
+
+
+class NotificationDigest:
+    """Collects the immediate notifications of a bulk operation
+
+    While a digest is active, send_notification queues notifications here
+    instead of sending them. On flush, the messages of the same notification
+    going to the same recipient are merged into one SMS and one email;
+    emails of a notification are then sent in a single SendGrid request
+    using personalizations.
+    """
+
+    def __init__(self):
+        self.pending: List[Tuple[Event, Notification.Read]] = []
+        self.outcomes: List[NotificationOutcome] = []
+
+    def add(self, event: Event, notification: Notification.Read):
+        self.pending.append((event, notification))
+
+    def _recipients(
+        self, event: Event, notification: Notification.Read, context: OrgContext
+    ) -> List[Tuple[str, Optional[str]]]:
+        recipients = []
+
+        match notification.recipient_type:
+            case RecipientType.user:
+                if notification.sms and event.user and event.user.phone_number:
+                    recipients.append(("sms", event.user.phone_number))
+                if notification.email and event.user and event.user.email:
+                    recipients.append(("email", event.user.email))
+            case RecipientType.admin:
+                # Devices without a location go to the org support contacts
+                location = event.device.location if event.device else None
+                if notification.sms:
+                    recipients.append(
+                        (
+                            "sms",
+                            (location and location.contact_phone)
+                            or context.default_support_phone,
+                        )
+                    )
+                if notification.email:
+                    recipients.append(
+                        (
+                            "email",
+                            (location and location.contact_email)
+                            or context.default_support_email,
+                        )
+                    )
+
+        return recipients
+
+    async def _group(self) -> DigestGroups:
+        """Groups the pending notifications by recipient
+
+        A notification that can't be rendered or addressed is recorded as
+        failed, so it doesn't keep the rest of the batch from being sent.
+        """
+        groups: DigestGroups = {}
+
+        for event, notification in self.pending:
+            try:
+                context = await org_contexts.get(event.id_org)
+                message = render_message(event, notification, context)
+                recipients = self._recipients(event, notification, context)
+            except Exception as e:
+                print(f"[!] Failed to prepare notification {notification.id}: {e}")
+
+                channels = [
+                    channel
+                    for channel, enabled in (
+                        ("sms", notification.sms),
+                        ("email", notification.email),
+                    )
+                    if enabled
+                ]
+                for channel in channels:
+                    self._outcome(channel, "", [(event, "", None)], str(e))
+                continue
+
+            for channel, recipient in recipients:
+                if not recipient:
+                    continue
+
+                groups.setdefault((channel, recipient, notification.id), []).append(
+                    (event, message, context)
+                )
+
+        return groups
+
+    def _outcome(self, channel, recipient, entries, error=None):
+        self.outcomes.append(
+            NotificationOutcome(
+                channel=channel,
+                recipient=recipient,
+                id_events=[event.id for event, _, _ in entries],
+                status="failed" if error else "sent",
+                error=error,
+            )
+        )
+
+    async def _send_sms(
+        self,
+        client: Client,
+        semaphore: asyncio.Semaphore,
+        recipient: str,
+        entries: List[Tuple[Event, str, OrgContext]],
+    ):
+        # Split the digest at message boundaries to stay under the limit
+        bodies = [""]
+        for _, message, _ in entries:
+            if bodies[-1] and len(bodies[-1]) + len(message) + 2 > SMS_MAX_LENGTH:
+                bodies.append("")
+            bodies[-1] = f"{bodies[-1]}\n\n{message}" if bodies[-1] else message
+
+        context = entries[0][2]
+
+        try:
+            async with semaphore:
+                for body in bodies:
+                    await asyncio.to_thread(
+                        client.messages.create,
+                        to=recipient,
+                        from_=context.messaging_service_sid,
+                        body=body,
+                    )
+        except Exception as e:
+            self._outcome("sms", recipient, entries, str(e))
+            return
+
+        self._outcome("sms", recipient, entries)
+
+    async def _send_emails(
+        self,
+        recipients: List[Tuple[str, List[Tuple[Event, str, OrgContext]]]],
+    ):
+        """Sends the email digests of one notification and org sender"""
+        context = recipients[0][1][0][2]
+        personalizations = []
+        oversized = []
+
+        for recipient, entries in recipients:
+            values = email_values(
+                [event for event, _, _ in entries],
+                [message for _, message, _ in entries],
+                context,
+            )
+            substitutions = {f"-{tag}-": value for tag, value in values.items()}
+
+            if sum(len(value) for value in substitutions.values()) > (
+                SENDGRID_MAX_SUBSTITUTIONS
+            ):
+                oversized.append((recipient, entries, substitutions))
+            else:
+                personalizations.append((recipient, entries, substitutions))
+
+        # Digests too large for a personalization are sent on their own
+        requests = [
+            personalizations[i : i + SENDGRID_MAX_PERSONALIZATIONS]
+            for i in range(0, len(personalizations), SENDGRID_MAX_PERSONALIZATIONS)
+        ] + [[item] for item in oversized]
+
+        for batch in requests:
+            try:
+                await asyncio.to_thread(
+                    email.send_bulk,
+                    context.email_sender,
+                    "notification",
+                    bulk_email_shell(),
+                    [(recipient, subs) for recipient, _, subs in batch],
+                    is_ups_org=context.is_ups_org,
+                )
+                error = None
+            except Exception as e:
+                error = str(e)
+
+            for recipient, entries, _ in batch:
+                self._outcome("email", recipient, entries, error)
+
+    async def flush(self) -> List[NotificationOutcome]:
+        """Sends every queued notification, returns the outcome per recipient"""
+        if not self.pending:
+            return self.outcomes
+
+        groups = await self._group()
+        self.pending = []
+
+        client = Client(get_settings().twilio_sid, get_settings().twilio_secret)
+        semaphore = asyncio.Semaphore(SMS_CONCURRENCY)
+        sends = []
+
+        # (id_notification, email sender) -> [(recipient, entries)]
+        emails: Dict[Tuple[UUID, str], list] = {}
+
+        for (channel, recipient, id_notification), entries in groups.items():
+            if channel == "sms":
+                sends.append(self._send_sms(client, semaphore, recipient, entries))
+            else:
+                sender = entries[0][2].email_sender
+                emails.setdefault((id_notification, sender), []).append(
+                    (recipient, entries)
+                )
+
+        sends.extend(self._send_emails(recipients) for recipients in emails.values())
+
+        await asyncio.gather(*sends)
+
+        return self.outcomes
+
+
+@asynccontextmanager
+async def notification_digest():
+    """Batches the immediate notifications sent inside the block
+
+    Usage:
+        async with notification_digest() as digest:
+            ...
+        digest.outcomes  # per recipient results
+    """
+    digest = NotificationDigest()
+    token = current_digest.set(digest)
+
+    try:
+        yield digest
+    finally:
+        current_digest.reset(token)
+        await digest.flush()
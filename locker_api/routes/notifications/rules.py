@@ -0,0 +1,88 @@
+import time
+from typing import Dict, List, Optional, Tuple
+from uuid import UUID
+
+from config import get_settings
+from fastapi_async_sqlalchemy import db
+from sqlalchemy import select
+from util.invalidation import invalidation_bus
+
+from ..event.model import EventType
+from .model import Notification, NotificationType
+
+# Rules without locations apply to every location of the org
+ANY_LOCATION = None
+
+RuleIndex = Dict[
+    Tuple[NotificationType, EventType], Dict[Optional[UUID], List[Notification.Read]]
+]
+
+
+class NotificationRuleIndex:
+    """Notification rules of each org, indexed by type, mode and location
+
+    An org's index is built from a single query the first time one of its
+    events changes status and kept until one of its notifications changes,
+    or notification_rules_ttl elapses.
+    """
+
+    def __init__(self):
+        # id_org -> (built_at, index)
+        self.indexes: Dict[str, Tuple[float, RuleIndex]] = {}
+
+    async def _build(self, id_org: UUID) -> RuleIndex:
+        query = select(Notification).where(Notification.id_org == id_org)
+        response = await db.session.execute(query)
+
+        index: RuleIndex = {}
+
+        for notification in response.unique().scalars().all():
+            rules = index.setdefault(
+                (notification.notification_type, notification.mode), {}
+            )
+            rule = Notification.Read.parse_obj(notification)
+
+            if not notification.locations:
+                rules.setdefault(ANY_LOCATION, []).append(rule)
+
+            for location in notification.locations:
+                rules.setdefault(location.id, []).append(rule)
+
+        self.indexes[str(id_org)] = (time.monotonic(), index)
+
+        return index
+
+    async def get_rules(
+        self,
+        id_org: UUID,
+        notify_type: NotificationType,
+        mode: EventType,
+        id_location: Optional[UUID],
+    ) -> List[Notification.Read]:
+        """Notifications of the org to send for an event at a location"""
+        cached = self.indexes.get(str(id_org))
+        ttl = get_settings().notification_rules_ttl
+
+        if cached and time.monotonic() - cached[0] < ttl:
+            index = cached[1]
+        else:
+            index = await self._build(id_org)
+
+        rules = index.get((notify_type, mode), {})
+
+        # Devices without a location only get the org-wide rules, once
+        if id_location is ANY_LOCATION:
+            return list(rules.get(ANY_LOCATION, []))
+
+        return rules.get(ANY_LOCATION, []) + rules.get(id_location, [])
+
+    def drop(self, id_org: str):
+        self.indexes.pop(id_org, None)
+
+    async def invalidate(self, id_org: UUID):
+        await invalidation_bus.invalidate("notification-rules", id_org)
+
+
+notification_rules = NotificationRuleIndex()
+
+invalidation_bus.register("notification-rules", notification_rules.drop)
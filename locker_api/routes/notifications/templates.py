@@ -0,0 +1,205 @@
+import re
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+from uuid import UUID
+
+from config import get_settings
+from fastapi import HTTPException
+
+from ..event.model import Event
+from ..organization.controller import (
+    get_org_messaging_service_sid,
+    get_org_sendgrid_auth_sender,
+    is_ups_org,
+)
+from ..settings.controller import get_settings_org
+from ..white_label.controller import partner_get_white_label
+from .context import OrgContext, org_contexts
+from .model import Notification
+
+# ((tag)) in notification messages, {{tag}} in the email shell
+MESSAGE_TAG = re.compile(r"\(\(([A-Za-z_]+)\)\)")
+SHELL_TAG = re.compile(r"\{\{([A-Za-z_]+)\}\}")
+
+WEB_APP_SUBDOMAINS = {
+    "local": "web",
+    "dev": "web-dev",
+    "qa": "web-qa",
+    "staging": "web-staging",
+    "production": "web",
+}
+
+
+class CompiledTemplate:
+    """A template split once into literal text and tag names
+
+    Rendering joins the parts in a single pass; tags without a value are
+    left as written, like the str.replace chain this replaces did.
+    """
+
+    def __init__(self, text: str, pattern: re.Pattern, delimiters: Tuple[str, str]):
+        # Even indexes are literal text, odd indexes are tag names
+        self.parts: List[str] = pattern.split(text)
+        self.delimiters = delimiters
+
+    def render(self, values: Dict[str, str]) -> str:
+        opening, closing = self.delimiters
+        output = []
+
+        for i, part in enumerate(self.parts):
+            if i % 2 == 0:
+                output.append(part)
+            elif part in values:
+                output.append(values[part])
+            else:
+                output.append(f"{opening}{part}{closing}")
+
+        return "".join(output)
+
+
+@lru_cache(maxsize=1024)
+def compile_message(message: str) -> CompiledTemplate:
+    # Keyed by text, so an edited notification compiles to a new template
+    return CompiledTemplate(message, MESSAGE_TAG, ("((", "))"))
+
+
+@lru_cache(maxsize=1)
+def email_shell() -> CompiledTemplate:
+    with open(Path(__file__).parent / "notification_template.html") as f:
+        return CompiledTemplate(f.read(), SHELL_TAG, ("{{", "}}"))
+
+
+async def load_org_context(id_org: UUID) -> OrgContext:
+    wl = await partner_get_white_label(id_org)
+
+    try:
+        org_settings = await get_settings_org(id_org)
+    except HTTPException:
+        org_settings = None
+
+    return OrgContext(
+        org_name=wl.app_name if wl else "",
+        app_logo=wl.app_logo if wl else None,
+        selected_duration=(
+            f"{org_settings.parcel_expiration} {org_settings.parcel_expiration_unit}"
+            if org_settings
+            else ""
+        ),
+        default_support_phone=(
+            org_settings.default_support_phone if org_settings else None
+        ),
+        default_support_email=(
+            org_settings.default_support_email if org_settings else None
+        ),
+        messaging_service_sid=await get_org_messaging_service_sid(id_org),
+        email_sender=await get_org_sendgrid_auth_sender(id_org),
+        is_ups_org=await is_ups_org(id_org),
+    )
+
+
+org_contexts.loader = load_org_context
+
+
+def message_values(event: Union[Event, Event.Read], context: OrgContext) -> dict:
+    """Values of the ((tags)) a notification message can use"""
+    subdomain = WEB_APP_SUBDOMAINS[get_settings().environment]
+    status_url = f"http://{subdomain}.koloni.io/active-transactions"
+
+    device = event.device
+    price = device.price if device else None
+    location = device.location if device else None
+
+    return {
+        "order_id": event.invoice_id if event.invoice_id else "",
+        "unit": price.unit.value if price else "",
+        "pickup_url": f"http://{subdomain}.koloni.io/ready-pickup/?id={event.id}",
+        "status_url": status_url,
+        "URL": status_url,
+        "currency": price.currency.value.upper() if price else "USD",
+        "weight": str(event.weight) if event.weight else "0",
+        "user_name": event.user.name if event.user else "",
+        "location_name": location.name if location else "",
+        "location_address": location.address if location else "",
+        "locker_number": str(device.locker_number if device else ""),
+        "charged_amount": str(event.total),
+        "amount": str(event.total),
+        "org_name": context.org_name,
+        "selected_duration": context.selected_duration,
+    }
+
+
+def render_message(
+    event: Union[Event, Event.Read],
+    notification: Notification.Read,
+    context: OrgContext,
+) -> str:
+    return compile_message(notification.message).render(message_values(event, context))
+
+
+def email_values(
+    events: List[Union[Event, Event.Read]],
+    messages: List[str],
+    context: OrgContext,
+) -> Dict[str, str]:
+    """Values of the {{tags}} of the email shell, for one event or a digest"""
+    location = events[0].device.location if events[0].device else None
+    addresses = []
+
+    for event in events:
+        if event.device and event.device.location:
+            if event.device.location.address not in addresses:
+                addresses.append(event.device.location.address)
+
+    return {
+        "org_name": context.org_name,
+        "org_logo": (
+            location.image if location and location.image else context.app_logo
+        )
+        or "",
+        "order_id": ", ".join(event.invoice_id for event in events if event.invoice_id),
+        "location_address": ", ".join(addresses),
+        "message": "<br><br>".join(messages),
+    }
+
+
+def render_email(
+    event: Union[Event, Event.Read],
+    message: str,
+    context: OrgContext,
+) -> str:
+    return email_shell().render(email_values([event], [message], context))
+
+
+@lru_cache(maxsize=1)
+def bulk_email_shell() -> str:
+    """The email shell with its tags turned into SendGrid substitution keys"""
+    shell = email_shell()
+
+    return shell.render({tag: f"-{tag}-" for tag in shell.parts[1::2]})
+
+
+async def render_notifications(
+    events: List[Union[Event, Event.Read]],
+    notification: Notification.Read,
+) -> List[Tuple[str, str]]:
+    """Renders the SMS text and email HTML of a notification for many events
+
+    Org contexts are loaded once per org of the batch.
+
+    Returns:
+        List[Tuple[str, str]]: (sms, email) of each event, in order
+    """
+    contexts = {}
+    rendered = []
+
+    for event in events:
+        if event.id_org not in contexts:
+            contexts[event.id_org] = await org_contexts.get(event.id_org)
+
+        context = contexts[event.id_org]
+        message = render_message(event, notification, context)
+
+        rendered.append((message, render_email(event, message, context)))
+
+    return rendered
@@ -28,7 +28,9 @@ from ..settings.model import OrgSettings
 from ..size.model import Size
 from ..locker_wall.model import LockerWall
 from ..memberships.model import Membership
+from ..notifications.context import org_contexts
 from ..notifications.model import Notification
+from ..notifications.rules import notification_rules
 from ..reservations.model import Reservation
 
 # from ..white_label.controller import partner_get_white_label
@@ -44,6 +46,7 @@ from ..conditions.model import Condition
 from ..feedback.model import Feedback
 from ..reports.model import Report
 from ..filters.model import OrgFilters
+from .hierarchy import org_hierarchy
 from .model import Org, PaginatedOrgs, OrgFeatures
 
 
@@ -64,35 +67,12 @@ async def is_sub_org(target_org: UUID, parent_org: UUID) -> bool:
     Returns:
         bool: True if the org is a sub-org, False otherwise
     """
-    query = select(Org).where(Org.id == target_org)
-    response = await db.session.execute(query)
-    org: Optional[Org.Read] = response.scalar_one_or_none()
-    if not org:
-        return False
-
-    if org.id_tenant is None:
-        return False
-
-    if str(org.id_tenant) == str(parent_org):
-        return True
-
-    # Recursively check if the org is a sub-org of the parent org
-    return await is_sub_org(org.id_tenant, parent_org)
+    return await org_hierarchy.is_sub_org(target_org, parent_org)
 
 
 async def get_org_tree(id_org: UUID) -> list[UUID]:
     """Returns a list of orgs from the current org to the top most org"""
-    orgs = []
-    current_org = id_org
-    while current_org:
-        query = select(Org).where(Org.id == current_org)
-        response = await db.session.execute(query)
-        org: Optional[Org.Read] = response.scalar_one_or_none()
-        if not org:
-            break
-        orgs.append(org.id)
-        current_org = org.id_tenant
-    return orgs
+    return await org_hierarchy.get_ancestors(id_org)
 
 
 async def is_ojmar_org(id_org: UUID) -> bool:
@@ -155,35 +135,32 @@ async def get_org_sendgrid_auth_sender(id_org: UUID):
     return get_settings().twilio_sendgrid_auth_sender
 
 
-async def get_org_tree_bfs(id_org: UUID) -> list[UUID]:
-    """Returns a list of orgs from the root org to all the sub orgs"""
-    orgs = []
-    queue = [id_org]
+async def invalidate_org_tree(id_org: UUID):
+    """Drops the org tree and the notification contexts that depend on it
+
+    Contexts of the sub orgs go too, their sender depends on their ancestors.
+    """
+    for id_sub_org in await org_hierarchy.get_descendants(id_org):
+        await org_contexts.invalidate(id_sub_org)
 
-    while queue:
-        current_org = queue.pop(0)
-        orgs.append(current_org)
+    await org_hierarchy.invalidate(id_org)
 
-        query = select(Org.id).where(Org.id_tenant == current_org)
-        response = await db.session.execute(query)
-        sub_orgs = response.scalars().all()
-        queue.extend(sub_orgs)
 
-    return orgs
+async def get_org_tree_bfs(id_org: UUID) -> list[UUID]:
+    """Returns a list of orgs from the root org to all the sub orgs"""
+    return await org_hierarchy.get_descendants(id_org)
 
 
 async def get_root_org(id_org: UUID) -> Optional[Org.Read]:
-    query = select(Org).where(Org.id == id_org)
-    response = await db.session.execute(query)
+    id_root = await org_hierarchy.get_root(id_org)
 
-    org: Optional[Org.Read] = response.scalar_one_or_none()
+    if not id_root:
+        return None
 
-    while org and org.id_tenant:
-        query = select(Org).where(Org.id == org.id_tenant)
-        response = await db.session.execute(query)
-        org: Optional[Org.Read] = response.scalar_one_or_none()
+    query = select(Org).where(Org.id == id_root)
+    response = await db.session.execute(query)
 
-    return org
+    return response.scalar_one_or_none()
 
 
 async def public_get_org(name: str):
@@ -363,15 +340,31 @@ async def get_orgs(
 
 
 async def include_tree(orgs: List[Org.Read]):
+    # Load every sub org of the page at once, then nest them by tenant
+    ids = set()
     for org in orgs:
-        query = select(Org).where(Org.id_tenant == org.id)
-        data = await db.session.execute(query)
-        rows = data.scalars().all()
-        sub_orgs = [Org.Read.parse_obj(row) for row in rows]
+        ids.update((await org_hierarchy.get_descendants(org.id))[1:])
+
+    if not ids:
+        return
+
+    query = select(Org).where(Org.id.in_(ids))
+    data = await db.session.execute(query)
+
+    children = {}
+    for row in data.scalars().all():
+        children.setdefault(row.id_tenant, []).append(row)
+
+    def nest(org: Org.Read):
+        sub_orgs = [Org.Read.parse_obj(row) for row in children.get(org.id, [])]
 
         if len(sub_orgs) > 0:
             org.sub_orgs = sub_orgs
-            await include_tree(sub_orgs)
+            for sub_org in sub_orgs:
+                nest(sub_org)
+
+    for org in orgs:
+        nest(org)
 
 
 async def create_org(
@@ -440,6 +433,8 @@ async def create_org(
     new_org = response.all().pop()
     new_id_org = new_org[0]
 
+    await invalidate_org_tree(new_id_org)
+
     """Creates a new white label for the org"""
     white_label.organization_owner = email
     try:
@@ -450,6 +445,7 @@ async def create_org(
         query = delete(Org).where(Org.id == new_id_org)
         await db.session.execute(query)
         await db.session.commit()
+        await invalidate_org_tree(new_id_org)
 
         raise HTTPException(
             status_code=400,
@@ -470,6 +466,7 @@ async def create_org(
         await db.session.execute(query_wl)
         await db.session.execute(query)
         await db.session.commit()
+        await invalidate_org_tree(new_id_org)
 
         raise HTTPException(
             status_code=400,
@@ -647,6 +644,7 @@ async def restore_org(id_org: UUID, current_org: UUID):
     )
     await db.session.execute(query)
     await db.session.commit()
+    await invalidate_org_tree(id_org)
 
     return {"detail": "Organization restored successfully"}
 
@@ -675,6 +673,7 @@ async def archive_org(id_org: UUID, current_org: UUID):
 
     await db.session.execute(query)
     await db.session.commit()
+    await invalidate_org_tree(id_org)
 
     return {"detail": "Organization archived successfully"}
 
@@ -923,6 +922,7 @@ async def delete_org_resources(id_org: UUID):
     query = delete(Notification).where(Notification.id_org == id_org)
     await db.session.execute(query)
     await db.session.commit()
+    await notification_rules.invalidate(id_org)
 
     query = delete(ProductTracking).where(ProductTracking.id_org == id_org)
     await db.session.execute(query)
@@ -1000,6 +1000,8 @@ async def delete_org_resources(id_org: UUID):
     await db.session.execute(query)
     await db.session.commit()
 
+    await invalidate_org_tree(id_org)
+
 
 async def delete_user_pool(user_pool_id: str):
     client = aioboto3.Session()
@@ -0,0 +1,137 @@
+import asyncio
+import time
+from typing import Dict, List, Optional, Set, Tuple
+from uuid import UUID
+
+from config import get_settings
+from fastapi_async_sqlalchemy import db
+from sqlalchemy import literal, select
+from util.invalidation import invalidation_bus
+
+from .model import Org
+
+# Guards against cycles in id_tenant, deeper trees are cut at this depth
+MAX_DEPTH = 32
+
+# A miss rebuilds the closure at most this often, so unknown orgs can't
+# trigger a query on every lookup
+MISS_REBUILD_INTERVAL = 1.0
+
+
+class OrgHierarchy:
+    """Closure table of the org tree, kept in memory
+
+    Every (ancestor, descendant) pair is loaded with one recursive CTE and
+    kept until an org is created, archived, restored or deleted, or
+    org_hierarchy_ttl elapses. Lookups don't query the database.
+    """
+
+    def __init__(self):
+        self.built_at: Optional[float] = None
+        # id_org -> [id_org, parent, ..., root]
+        self.ancestors: Dict[UUID, List[UUID]] = {}
+        # id_org -> [id_org, children, grandchildren, ...] in breadth-first order
+        self.descendants: Dict[UUID, List[UUID]] = {}
+        # (ancestor, descendant) pairs, excluding each org with itself
+        self.pairs: Set[Tuple[UUID, UUID]] = set()
+        self._lock = asyncio.Lock()
+
+    async def _build(self):
+        closure = select(
+            Org.id.label("id_ancestor"),
+            Org.id.label("id_descendant"),
+            literal(0).label("depth"),
+        ).cte("closure", recursive=True)
+        parent = (
+            select(
+                Org.id_tenant,
+                closure.c.id_descendant,
+                closure.c.depth + 1,
+            )
+            .join(closure, Org.id == closure.c.id_ancestor)
+            .where(Org.id_tenant.is_not(None), closure.c.depth < MAX_DEPTH)
+        )
+        closure = closure.union_all(parent)
+
+        response = await db.session.execute(select(closure).order_by(closure.c.depth))
+
+        ancestors: Dict[UUID, List[UUID]] = {}
+        descendants: Dict[UUID, List[UUID]] = {}
+        pairs: Set[Tuple[UUID, UUID]] = set()
+
+        # Ordered by depth: ancestors come nearest first, descendants level
+        # by level
+        for id_ancestor, id_descendant, depth in response.all():
+            ancestors.setdefault(id_descendant, []).append(id_ancestor)
+            descendants.setdefault(id_ancestor, []).append(id_descendant)
+
+            if depth > 0:
+                pairs.add((id_ancestor, id_descendant))
+
+        self.ancestors = ancestors
+        self.descendants = descendants
+        self.pairs = pairs
+        self.built_at = time.monotonic()
+
+    async def _ensure(self, id_org: Optional[UUID] = None):
+        ttl = get_settings().org_hierarchy_ttl
+
+        def fresh():
+            if self.built_at is None:
+                return False
+
+            age = time.monotonic() - self.built_at
+
+            if age >= ttl:
+                return False
+
+            # An org created on another worker may not be known yet
+            return (
+                id_org is None
+                or id_org in self.ancestors
+                or age < MISS_REBUILD_INTERVAL
+            )
+
+        if fresh():
+            return
+
+        async with self._lock:
+            if not fresh():
+                await self._build()
+
+    async def get_ancestors(self, id_org: UUID) -> List[UUID]:
+        """The org followed by its parents up to the root, empty if it doesn't exist"""
+        id_org = UUID(str(id_org))
+        await self._ensure(id_org)
+
+        return list(self.ancestors.get(id_org, []))
+
+    async def get_descendants(self, id_org: UUID) -> List[UUID]:
+        """The org followed by all its sub orgs, breadth-first"""
+        id_org = UUID(str(id_org))
+        await self._ensure(id_org)
+
+        return list(self.descendants.get(id_org, [id_org]))
+
+    async def get_root(self, id_org: UUID) -> Optional[UUID]:
+        ancestors = await self.get_ancestors(id_org)
+
+        return ancestors[-1] if ancestors else None
+
+    async def is_sub_org(self, target_org: UUID, parent_org: UUID) -> bool:
+        target_org = UUID(str(target_org))
+        await self._ensure(target_org)
+
+        return (UUID(str(parent_org)), target_org) in self.pairs
+
+    def drop(self, id_org: str):
+        # Any change can move a whole subtree, so the closure is rebuilt
+        self.built_at = None
+
+    async def invalidate(self, id_org: UUID):
+        await invalidation_bus.invalidate("org-hierarchy", id_org)
+
+
+org_hierarchy = OrgHierarchy()
+
+invalidation_bus.register("org-hierarchy", org_hierarchy.drop)
@@ -1,14 +1,16 @@
+import asyncio
 import csv
+import time
 from apscheduler.jobstores.base import JobLookupError
 from datetime import datetime, timedelta, timezone
+from enum import Enum
 from io import StringIO
 from math import ceil
-from typing import List, Optional
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
 from uuid import UUID
 from uuid import uuid4
 
 from async_stripe import stripe
-from fastapi.responses import StreamingResponse
 from config import get_settings
 from fastapi import HTTPException
 from fastapi_async_sqlalchemy import db
@@ -24,18 +26,18 @@ from sqlalchemy import (
     delete,
     update,
 )
-from sqlalchemy.sql import extract
 
 
 from ..device.model import Device, LockStatus, Status
-from ..event.model import Event, EventStatus
+from ..event.model import Event
 from ..issue.model import Issue
 from ..location.model import Location
 from ..organization.controller import get_org, get_org_tree_bfs
-from ..organization.model import LinkOrgUser, Org
+from ..organization.model import Org
 from ..user.model import User
-from ..member.controller import get_user
+from ..member.controller import get_members
 from .model import Location as LocationReport
+from . import rollups
 
 from .model import (
     Report,
@@ -45,12 +47,22 @@ from .model import (
     TimeFrame,
     TopLocations,
 )
+from payments.stripe import stripe_accounts
 from util.scheduler import scheduler
 from util.email import send_csv_file
 from ..organization.controller import get_org_sendgrid_auth_sender
 
 stripe.api_key = get_settings().stripe_api_key
 
+# (id_org, report, period) -> (computed_at, task computing the report)
+_report_cache: Dict[Tuple[str, str, str], Tuple[float, asyncio.Task]] = {}
+
+# (id_org, include_sub_orgs, contents, period) -> (rendered_at, csv)
+_csv_cache: Dict[tuple, Tuple[float, str]] = {}
+
+# Bounds the report queries running at the same time
+report_semaphore = asyncio.Semaphore(get_settings().report_concurrency)
+
 
 async def get_partner_reports(
     id_org: UUID,
@@ -292,57 +304,66 @@ async def delete_reports(id_reports: List[UUID], id_org: UUID):
 
 
 async def send_report(id_report: UUID):
-    query = select(Report).where(Report.id == id_report)
-    result = await db.session.execute(query)
-    report = result.scalar_one_or_none()
-
-    if not report:
-        return
+    # Scheduler jobs run outside of a request
+    async with db():
+        query = select(Report).where(Report.id == id_report)
+        result = await db.session.execute(query)
+        report = result.scalar_one_or_none()
 
-    if not report.assign_to:
-        return
+        if not report:
+            return
 
-    org = await get_org(report.id_org)
-    report_data = await generate_all_reports(
-        report.id_org, report.include_sub_orgs, report.contents
-    )
+        if not report.assign_to:
+            return
 
-    for user_id in report.assign_to:
-        user = await get_user(org.user_pool, str(user_id))
+        org = await get_org(report.id_org)
+        report_data = await generate_all_reports(
+            report.id_org, report.include_sub_orgs, report.contents
+        )
 
-        file = generate_csv(report_data)
+        # The CSV and email body are the same for every assignee
+        file = get_report_csv(
+            report.id_org, report.include_sub_orgs, report.contents, report_data
+        )
 
         report_contents = ""
 
         for c in report.contents:
             report_contents += f"<li>{c.replace('_', ' ')}</li>"
 
-        content = EMAIL_BODY.format(
-            user_name=user.name,
-            report_version=report.version,
-            report_contents=report_contents,
-        )
-
         email_sender = await get_org_sendgrid_auth_sender(org.id)
 
-        send_csv_file(
-            email_sender,
-            user.email,
-            f"Organization Report: {report.name}",
-            content,
-            file,
-            report.version,
-        )
+        assignees = await get_members(org.user_pool, report.assign_to)
 
-    query = (
-        update(Report)
-        .where(Report.id == id_report)
-        .values(
-            last_sent=datetime.utcnow(),
+        missing = {str(user_id) for user_id in report.assign_to} - assignees.keys()
+        if missing:
+            print(f"Failed to get report assignees: {missing}")
+
+        for user in assignees.values():
+            content = EMAIL_BODY.format(
+                user_name=user.name,
+                report_version=report.version,
+                report_contents=report_contents,
+            )
+
+            send_csv_file(
+                email_sender,
+                user.email,
+                f"Organization Report: {report.name}",
+                content,
+                file,
+                report.version,
+            )
+
+        query = (
+            update(Report)
+            .where(Report.id == id_report)
+            .values(
+                last_sent=datetime.utcnow(),
+            )
         )
-    )
-    await db.session.execute(query)
-    await db.session.commit()
+        await db.session.execute(query)
+        await db.session.commit()
 
 
 async def get_reports(id_org: UUID, target_org: Optional[UUID] = None):
@@ -384,44 +405,17 @@ async def get_events(
                 detail="Organization is not a sub-organization of the tenant or does not exist.",
             )
 
-    if target_org:
-        query_total = select(func.count(Event.id)).where(Event.id_org == target_org)
-    else:
-        query_total = select(func.count(Event.id)).where(Event.id_org == id_org)
-
-    response_total = await db.session.execute(query_total)
-    total = response_total.scalars().first()
+    org = target_org if target_org else id_org
 
     from_date = (
         from_date if from_date else datetime.now(timezone.utc) - timedelta(weeks=52)
     )
     to_date = to_date if to_date else datetime.now(timezone.utc)
 
-    query = (
-        select(
-            func.count(Event.id),
-            extract("month", Event.created_at).label("month"),
-        )
-        .where(
-            between(
-                Event.created_at,
-                from_date,
-                to_date,
-            ),
-        )
-        .group_by(
-            extract("month", Event.created_at),
-        )
-    )
-
-    if target_org:
-        query = query.where(Event.id_org == target_org)
-    else:
-        query = query.where(Event.id_org == id_org)
-
-    response = await db.session.execute(query)
-
-    return {"total": total, "data": response.all()}
+    return {
+        "total": await rollups.count_transactions(org),
+        "data": await rollups.monthly_transactions(org, from_date, to_date),
+    }
 
 
 async def get_earnings(id_org: UUID, target_org: Optional[UUID] = None):
@@ -435,30 +429,17 @@ async def get_earnings(id_org: UUID, target_org: Optional[UUID] = None):
                 detail="Organization is not a sub-organization of the tenant or does not exist.",
             )
 
-    query = select(func.sum(Event.total)).where(
-        Event.event_status == EventStatus.finished,
-        between(
-            Event.created_at,
-            datetime.now(timezone.utc) - timedelta(weeks=4),
-            datetime.now(timezone.utc),
-        ),
+    earnings = await rollups.sum_revenue(
+        target_org if target_org else id_org,
+        datetime.now(timezone.utc) - timedelta(weeks=4),
+        datetime.now(timezone.utc),
     )
 
-    if target_org:
-        query = query.where(Event.id_org == target_org)
-    else:
-        query = query.where(Event.id_org == id_org)
-
-    response = await db.session.execute(query)
-
-    org = await get_org(target_org if target_org else id_org)
-
-    account = await stripe.Account.retrieve(org.stripe_account_id)
-    earnings = response.scalars().first() or 0
+    account = await stripe_accounts.get_account(target_org if target_org else id_org)
 
     return {
         "earnings": earnings,
-        "currency": account["default_currency"],
+        "currency": account.default_currency,
     }
 
 
@@ -478,47 +459,17 @@ async def get_users(
                 detail="Organization is not a sub-organization of the tenant or does not exist.",
             )
 
-    if target_org:
-        query_total = select(func.count(LinkOrgUser.id_user)).where(
-            LinkOrgUser.id_org == target_org
-        )
-    else:
-        query_total = select(func.count(LinkOrgUser.id_user)).where(
-            LinkOrgUser.id_org == id_org
-        )
-
-    response_total = await db.session.execute(query_total)
-    total = response_total.scalars().first()
+    org = target_org if target_org else id_org
 
-    query = (
-        select(
-            func.count(LinkOrgUser.id_user),
-            extract("month", LinkOrgUser.created_at).label("month"),
-        )
-        .where(
-            between(
-                LinkOrgUser.created_at,
-                (
-                    from_date
-                    if from_date
-                    else datetime.now(timezone.utc) - timedelta(weeks=26)
-                ),
-                to_date if to_date else datetime.now(timezone.utc),
-            ),
-        )
-        .group_by(
-            extract("month", LinkOrgUser.created_at),
-        )
+    from_date = (
+        from_date if from_date else datetime.now(timezone.utc) - timedelta(weeks=26)
     )
+    to_date = to_date if to_date else datetime.now(timezone.utc)
 
-    if target_org:
-        query = query.where(LinkOrgUser.id_org == target_org)
-    else:
-        query = query.where(LinkOrgUser.id_org == id_org)
-
-    response = await db.session.execute(query)
-
-    return {"total": total, "data": response.all()}
+    return {
+        "total": await rollups.count_new_users(org),
+        "data": await rollups.monthly_new_users(org, from_date, to_date),
+    }
 
 
 async def get_top_users(id_org: UUID, target_org: Optional[UUID] = None):
@@ -569,28 +520,7 @@ async def get_top_locations(id_org: UUID, target_org: Optional[UUID] = None):
                 detail="Organization is not a sub-organization of the tenant or does not exist.",
             )
 
-    query = (
-        select(
-            func.count(Event.id).label("count"),
-            Location.id,
-            Location.name,
-            Location.address,
-        )
-        .join_from(Event, Device, Device.id == Event.id_device)
-        .join_from(Device, Location, Location.id == Device.id_location)
-        .group_by(Location.id)
-        .order_by(desc("count"))
-        .limit(5)
-    )
-
-    if target_org:
-        query = query.where(Event.id_org == target_org)
-    else:
-        query = query.where(Event.id_org == id_org)
-
-    response = await db.session.execute(query)
-
-    data = response.unique().all()
+    data = await rollups.top_locations(target_org if target_org else id_org)
 
     # The order of the fields in the query is count, id, name, address
     # This is guaranteed by the query, so we can safely unpack the data
@@ -617,30 +547,14 @@ async def get_user_growth(id_org: UUID, interval: Optional[str] = "month"):
                 status_code=400,
                 detail="Interval must be one of: day, week, month, year.",
             )
+    # Rollups are daily, so an interval covers its last days up to today
+    now = datetime.now(timezone.utc)
+    start = now - interval + timedelta(days=1)
+
     # This will return the number of users that have been created in this interval (e.g. this month)
-    current = select(func.count(LinkOrgUser.id_user)).where(
-        LinkOrgUser.id_org == id_org,
-        between(
-            LinkOrgUser.created_at,
-            datetime.now(timezone.utc) - interval,
-            datetime.now(timezone.utc),
-        ),
-    )
+    current_data = await rollups.count_new_users(id_org, start, now)
     # This will return the number of users that have been created in the last interval (e.g. last month)
-    last = select(func.count(LinkOrgUser.id_user)).where(
-        LinkOrgUser.id_org == id_org,
-        between(
-            LinkOrgUser.created_at,
-            datetime.now(timezone.utc) - interval * 2,
-            datetime.now(timezone.utc) - interval,
-        ),
-    )
-
-    current_response = await db.session.execute(current)
-    last_response = await db.session.execute(last)
-
-    current_data = current_response.scalars().first()
-    last_data = last_response.scalars().first()
+    last_data = await rollups.count_new_users(id_org, start - interval, now - interval)
 
     # If the last interval equates to 0, we return 100% growth
     if last_data == 0:
@@ -726,19 +640,13 @@ async def get_new_transaction_percentage(
 
     # Query to count total transactions in the date range
 
-    query_total = select(func.count(Event.id)).where(
-        Event.id_org == id_org, Event.created_at.between(from_date, to_date)
-    )
-    response_total = await db.session.execute(query_total)
-    total_transactions = response_total.scalar()
+    total_transactions = await rollups.count_transactions(id_org, from_date, to_date)
 
     # Query to count total transactions before the date range
 
-    query_previous_total = select(func.count(Event.id)).where(
-        Event.id_org == id_org, Event.created_at < from_date
+    previous_total_transactions = await rollups.count_transactions(
+        id_org, to_date=from_date - timedelta(days=1)
     )
-    response_previous_total = await db.session.execute(query_previous_total)
-    previous_total_transactions = response_previous_total.scalar()
 
     # Calculate the new transaction percentage
 
@@ -963,40 +871,90 @@ async def get_transactions_per_locker_per_range(
     }
 
 
+def report_period() -> str:
+    """Reports cover windows relative to today, so results are reusable for the day"""
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+
+def _cached(cache: dict, key: tuple):
+    cached = cache.get(key)
+
+    if cached and time.monotonic() - cached[0] < get_settings().report_cache_ttl:
+        return cached[1]
+
+    return None
+
+
+def _store(cache: dict, key: tuple, value):
+    """Caches value under key, dropping the entries that have expired"""
+    now = time.monotonic()
+    ttl = get_settings().report_cache_ttl
+
+    for expired in [k for k, (at, _) in cache.items() if now - at >= ttl]:
+        del cache[expired]
+
+    cache[key] = (now, value)
+
+
+async def run_report(name: str, id_org: UUID):
+    """Computes one report of one org, once per (org, report, period)
+
+    Reports run in their own session so that several can run concurrently,
+    at most report_concurrency at a time. Concurrent requests for the same
+    report share the same computation.
+    """
+    key = (str(id_org), name, report_period())
+    task = _cached(_report_cache, key)
+
+    if not task:
+
+        async def compute():
+            async with report_semaphore:
+                async with db():
+                    return await REPORT_FUNCTIONS[name](id_org)
+
+        task = asyncio.create_task(compute())
+        _store(_report_cache, key, task)
+
+    try:
+        return await asyncio.shield(task)
+    except Exception:
+        # Do not cache failures
+        if _report_cache.get(key, (None, None))[1] is task:
+            del _report_cache[key]
+        raise
+
+
 async def generate_all_reports(
     id_org: UUID,
     include_sub_orgs: bool,
     contents: Optional[List[str]] = None,
 ) -> dict | list:
-    report_map = {
-        "earnings": get_earnings,
-        "user_growth": get_user_growth,
-        "system_health": get_system_health,
-        "issue_rate": get_issue_rate,
-        "occupancy_rate": get_occupancy_rate,
-        "transaction_rate": get_new_transaction_percentage,
-        "top_users": get_top_users,
-        "top_locations": get_top_locations,
-        "active_locks": get_active_locks_report,
-    }
+    contents = [report for report in contents or [] if report in REPORT_FUNCTIONS]
 
-    if not include_sub_orgs:
-        reports = {}
-        for report in contents:
-            if report in report_map:
-                reports[report] = await report_map[report](id_org)
+    async def org_reports(target_org: UUID) -> dict:
+        results = await asyncio.gather(
+            *[run_report(report, target_org) for report in contents]
+        )
+
+        return dict(zip(contents, results))
 
-        return reports
+    if not include_sub_orgs:
+        return await org_reports(id_org)
 
     orgs = await get_org_tree_bfs(id_org)
-    total_reports = []
-    for target_org in orgs:
-        org = await get_org(target_org)
 
-        reports = {}
-        for report in contents:
-            if report in report_map:
-                reports[report] = await report_map[report](id_org)
+    query = select(Org).where(Org.id.in_(orgs))
+    response = await db.session.execute(query)
+    org_by_id = {org.id: org for org in response.unique().scalars().all()}
+
+    org_results = await asyncio.gather(
+        *[org_reports(target_org) for target_org in orgs]
+    )
+
+    total_reports = []
+    for target_org, reports in zip(orgs, org_results):
+        org = org_by_id[target_org]
 
         total_reports.append(
             {
@@ -1076,20 +1034,8 @@ async def get_avg_transaction_time_controller(id_org: UUID) -> float:
     start_date = end_date - timedelta(days=1)
     start_date = start_date.replace(day=1)
 
-    transaction_query = select(func.avg(Event.ended_at - Event.started_at)).where(
-        and_(
-            Event.id_org == id_org,
-            Event.started_at >= start_date,
-            Event.ended_at <= end_date,
-        )
-    )
-
-    avg_transaction_time = await db.session.scalar(transaction_query)
-
-    # Convert the result (a timedelta) to your preferred format. For simplicity, let's return the average in seconds.
-    avg_seconds = avg_transaction_time.total_seconds() if avg_transaction_time else 0
-
-    return avg_seconds
+    # Average in seconds of the transactions of last month
+    return await rollups.avg_duration(id_org, start_date, end_date - timedelta(days=1))
 
 
 async def get_total_users_for_org(id_org: UUID) -> int:
@@ -1213,6 +1159,23 @@ async def get_door_counts(
     }
 
 
+def get_report_csv(
+    id_org: UUID,
+    include_sub_orgs: bool,
+    contents: List[str],
+    reports: dict | list,
+) -> str:
+    """CSV of generated reports, rendered once per org, contents and period"""
+    key = (str(id_org), include_sub_orgs, tuple(contents), report_period())
+    data = _cached(_csv_cache, key)
+
+    if data is None:
+        data = generate_csv(reports)
+        _store(_csv_cache, key, data)
+
+    return data
+
+
 def generate_csv(reports: dict | list) -> str:
     """
     Generate a CSV file from a dictionary of reports.
@@ -1226,113 +1189,162 @@ def generate_csv(reports: dict | list) -> str:
     return data
 
 
-def stream_csv(reports: dict | list) -> StreamingResponse:
-    """
-    Stream a CSV file from a dictionary of reports.
+def report_section_rows(report_name: str, report_data) -> Iterator[list]:
+    """CSV rows of one report, followed by an empty separator row"""
+    yield [report_name.upper()]  # Write the report name
 
-    :param reports: Dictionary containing multiple reports.
-    """
-    output = gen_csv(reports)
+    # If data is a dictionary
+    if isinstance(report_data, dict):
+        if "data" in report_data and isinstance(report_data["data"], list):
+            # Write other keys first
+            for key, value in report_data.items():
+                if key != "data":
+                    yield [key, value]
 
-    return StreamingResponse(
-        iter([output.getvalue()]),
-        media_type="text/csv",
-    )
+            # Write the data tuples
+            yield ["Count", "Month"]
+            for count, month in report_data["data"]:
+                yield [count, month]
+        else:
+            yield list(report_data.keys())
+            yield list(report_data.values())
+
+    # If data is a list
+    elif isinstance(report_data, list) and report_data:
+        first_item = report_data[0]
+
+        if isinstance(first_item, dict):
+            yield list(first_item.keys())
+            for row in report_data:
+                yield list(row.values())
+        elif isinstance(first_item, (list, tuple)):
+            for row in report_data:
+                yield row
+        else:
+            yield report_data
 
+    yield []  # Add an empty line between reports
 
-def gen_csv(reports: dict | list) -> StringIO:
-    output = StringIO()
-    writer = csv.writer(output)
+
+def org_header_rows(id_org: UUID, name: str, id_parent: UUID) -> Iterator[list]:
+    yield [f"{name.upper()} ORGANIZATION REPORT"]
+    yield ["id_org", "org_name", "id_parent"]
+    yield [id_org, name, id_parent]  # Write the org id
+    yield []  # add space
+
+
+def report_rows(reports: dict | list) -> Iterator[list]:
+    """CSV rows of the output of generate_all_reports"""
     if isinstance(reports, dict):
         for report_name, report_data in reports.items():
-            writer.writerow([report_name.upper()])  # Write the report name
-
-            # If data is a dictionary
-            if isinstance(report_data, dict):
-                if "data" in report_data and isinstance(report_data["data"], list):
-                    # Write other keys first
-                    for key, value in report_data.items():
-                        if key != "data":
-                            writer.writerow([key, value])
-
-                    # Write the data tuples
-                    writer.writerow(["Count", "Month"])
-                    for count, month in report_data["data"]:
-                        writer.writerow([count, month])
-                else:
-                    headers = report_data.keys()
-                    writer.writerow(headers)
-                    writer.writerow(report_data.values())
-
-            # If data is a list
-            elif isinstance(report_data, list) and report_data:
-                first_item = report_data[0]
-
-                if isinstance(first_item, dict):
-                    headers = first_item.keys()
-                    writer.writerow(headers)
-                    for row in report_data:
-                        writer.writerow(row.values())
-                elif isinstance(first_item, (list, tuple)):
-                    for row in report_data:
-                        writer.writerow(row)
-                else:
-                    writer.writerow(report_data)
-
-            writer.writerow([])  # Add an empty line between reports
+            yield from report_section_rows(report_name, report_data)
 
     elif isinstance(reports, list):
         for entry in reports:
-            writer.writerow(
-                [f"{entry['name'].upper()} ORGANIZATION REPORT"]
-            )  # add space
-            writer.writerow(["id_org", "org_name", "id_parent"])  # add space
-            writer.writerow(
-                [entry["id"], entry["name"], entry["parent"]]
-            )  # Write the org id
-            writer.writerow([])  # add space
+            yield from org_header_rows(entry["id"], entry["name"], entry["parent"])
 
             for report_name, report_data in entry["reports"].items():
-                writer.writerow([report_name.upper()])  # Write the report name
-
-                # If data is a dictionary
-                if isinstance(report_data, dict):
-                    if "data" in report_data and isinstance(report_data["data"], list):
-                        # Write other keys first
-                        for key, value in report_data.items():
-                            if key != "data":
-                                writer.writerow([key, value])
-
-                        # Write the data tuples
-                        writer.writerow(["Count", "Month"])
-                        for count, month in report_data["data"]:
-                            writer.writerow([count, month])
-                    else:
-                        headers = report_data.keys()
-                        writer.writerow(headers)
-                        writer.writerow(report_data.values())
-
-                # If data is a list
-                elif isinstance(report_data, list) and report_data:
-                    first_item = report_data[0]
-
-                    if isinstance(first_item, dict):
-                        headers = first_item.keys()
-                        writer.writerow(headers)
-                        for row in report_data:
-                            writer.writerow(row.values())
-                    elif isinstance(first_item, (list, tuple)):
-                        for row in report_data:
-                            writer.writerow(row)
-                    else:
-                        writer.writerow(report_data)
-
-                writer.writerow([])  # Add an empty line between reports
-            writer.writerow([])  # Add an empty line between reports
+                yield from report_section_rows(report_name, report_data)
+
+            yield []  # Add an empty line between reports
+
+
+def gen_csv(reports: dict | list) -> StringIO:
+    output = StringIO()
+    writer = csv.writer(output)
+    writer.writerows(report_rows(reports))
 
     return output
 
 
+async def stream_report_rows(
+    id_org: UUID,
+    include_sub_orgs: bool,
+    contents: List[str],
+) -> AsyncIterator[list]:
+    """Yields the rows of a report as its sections are computed
+
+    The reports of an org are computed concurrently and written in order;
+    with include_sub_orgs only one org's results are held at a time.
+    """
+    contents = [report for report in contents or [] if report in REPORT_FUNCTIONS]
+
+    async with db():
+        if include_sub_orgs:
+            orgs = await get_org_tree_bfs(id_org)
+
+            response = await db.session.execute(select(Org).where(Org.id.in_(orgs)))
+            org_by_id = {org.id: org for org in response.unique().scalars().all()}
+        else:
+            orgs = [id_org]
+
+    for target_org in orgs:
+        tasks = [
+            asyncio.create_task(run_report(report, target_org)) for report in contents
+        ]
+
+        if include_sub_orgs:
+            org = org_by_id[target_org]
+
+            for row in org_header_rows(org.id, org.name, org.id_tenant):
+                yield row
+
+        for report, task in zip(contents, tasks):
+            for row in report_section_rows(report, await task):
+                yield row
+
+        if include_sub_orgs:
+            yield []  # Add an empty line between reports
+
+
+async def stream_transaction_rows(
+    id_org: UUID,
+    from_date: Optional[datetime] = None,
+    to_date: Optional[datetime] = None,
+) -> AsyncIterator[list]:
+    """Yields every transaction of the org, read through a server-side cursor"""
+    columns = [
+        Event.invoice_id,
+        Event.order_id,
+        Event.created_at,
+        Event.started_at,
+        Event.ended_at,
+        Event.event_type,
+        Event.event_status,
+        Event.total,
+        Event.refunded_amount,
+        Location.name.label("location"),
+        Device.locker_number,
+        User.phone_number,
+        User.email,
+    ]
+
+    query = (
+        select(*columns)
+        .select_from(Event)
+        .outerjoin(Device, Device.id == Event.id_device)
+        .outerjoin(Location, Location.id == Device.id_location)
+        .outerjoin(User, User.id == Event.id_user)
+        .where(Event.id_org == id_org)
+        .order_by(Event.created_at)
+        .execution_options(yield_per=get_settings().csv_stream_rows)
+    )
+
+    if from_date:
+        query = query.where(Event.created_at >= from_date)
+    if to_date:
+        query = query.where(Event.created_at <= to_date)
+
+    yield [column.key for column in columns]
+
+    # StreamingResponse bodies are sent after the request session is closed
+    async with db():
+        result = await db.session.stream(query)
+
+        async for row in result:
+            yield [value.value if isinstance(value, Enum) else value for value in row]
+
+
 async def get_active_locks_report(id_org: UUID):
     """
     Fetches and calculates the active locks report for the previous month.
@@ -1391,17 +1403,26 @@ async def get_active_locks_report(id_org: UUID):
 
 
 async def get_report_assignees(report: Report.Read, user_pool: str):
-    # Cache existing user IDs to avoid duplicate queries
-    assignees = {}
-    response = []
-    for id_assignee in report.assign_to:
-        if id_assignee not in assignees:
-            try:
-                user = await get_user(user_pool, str(id_assignee))
-                assignees[id_assignee] = user
-            except Exception:
-                assignees[id_assignee] = None
-        if assignees[id_assignee]:
-            response.append(assignees[id_assignee])
+    try:
+        assignees = await get_members(user_pool, report.assign_to)
+    except Exception:
+        return []
 
-    return response
+    return [
+        assignees[str(id_assignee)]
+        for id_assignee in report.assign_to
+        if str(id_assignee) in assignees
+    ]
+
+
+REPORT_FUNCTIONS = {
+    "earnings": get_earnings,
+    "user_growth": get_user_growth,
+    "system_health": get_system_health,
+    "issue_rate": get_issue_rate,
+    "occupancy_rate": get_occupancy_rate,
+    "transaction_rate": get_new_transaction_percentage,
+    "top_users": get_top_users,
+    "top_locations": get_top_locations,
+    "active_locks": get_active_locks_report,
+}
@@ -6,9 +6,10 @@ from pydantic import conint
 
 from auth.cognito import get_current_org, get_current_user_pool
 from config import get_settings
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
 from fastapi_cache.decorator import cache
 from ..organization.controller import is_sub_org
+from util.csv import stream_csv_response
 from util.response import BasicResponse
 
 
@@ -101,14 +102,31 @@ async def update_report(
 async def download_report(
     id_report: UUID,
     id_org: UUID = Depends(get_current_org),
+    accept_encoding: Optional[str] = Header(default=None),
 ):
+    """Download a report as CSV, written as each section is computed"""
     report = await controller.get_report(id_report, id_org)
-    data = await controller.generate_all_reports(
-        id_org, report.include_sub_orgs, report.contents
+
+    return stream_csv_response(
+        controller.stream_report_rows(id_org, report.include_sub_orgs, report.contents),
+        report.version or report.name,
+        compress="gzip" in (accept_encoding or ""),
     )
-    csv = controller.stream_csv(data)
 
-    return csv
+
+@router.get("/partner/reports/transactions/download", response_class=StreamingResponse)
+async def download_transactions(
+    from_date: Optional[datetime] = None,
+    to_date: Optional[datetime] = None,
+    id_org: UUID = Depends(get_current_org),
+    accept_encoding: Optional[str] = Header(default=None),
+):
+    """Download every transaction of the organization as CSV"""
+    return stream_csv_response(
+        controller.stream_transaction_rows(id_org, from_date, to_date),
+        "transactions",
+        compress="gzip" in (accept_encoding or ""),
+    )
 
 
 @router.get("/partner/reports", response_model=Summary)
@@ -128,6 +128,37 @@ class Report(SQLModel, table=True):
         target_org: Optional[UUID]
 
 
+class EventRollup(SQLModel, table=True):
+    """Daily event aggregates per org and location
+
+    Rows are maintained by the event_rollup trigger as events are created
+    and change status, and rebuilt by routes.reports.rollups.
+    """
+
+    __tablename__ = "event_daily_rollup"
+
+    id_org: UUID = Field(primary_key=True)
+    id_location: Optional[UUID] = Field(primary_key=True, nullable=True)
+    day: datetime.date = Field(primary_key=True)
+
+    transactions: int = 0
+    finished: int = 0
+    revenue: float = 0
+    duration_seconds: float = 0
+    timed_transactions: int = 0
+
+
+class UserRollup(SQLModel, table=True):
+    """Users linked to an org per day, maintained by the user_rollup trigger"""
+
+    __tablename__ = "user_daily_rollup"
+
+    id_org: UUID = Field(primary_key=True)
+    day: datetime.date = Field(primary_key=True)
+
+    new_users: int = 0
+
+
 class PaginatedReports(BaseModel):
     items: List[Report.Read]
 
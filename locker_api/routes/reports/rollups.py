@@ -0,0 +1,358 @@
+"""Daily rollups of events and users for the dashboard reports
+
+event_daily_rollup and user_daily_rollup are kept up to date by database
+triggers as events are created, change status or are refunded, and as users
+are linked to orgs. Reports read them instead of scanning event and
+link_org_user, so their cost depends on the number of days asked for, not
+on the history of the org.
+
+Rollups are rebuilt from the source tables with:
+
+    python -m routes.reports.rollups [--org <id_org>]
+"""
+
+import argparse
+import asyncio
+from datetime import date, datetime, time, timedelta, timezone
+from typing import List, Optional
+from uuid import UUID
+
+from config import get_settings
+from fastapi_async_sqlalchemy import SQLAlchemyMiddleware, db
+from pydantic import PostgresDsn
+from sqlalchemy import (
+    Date,
+    cast,
+    delete,
+    desc,
+    extract,
+    func,
+    insert,
+    select,
+    union,
+    update,
+)
+from sqlalchemy.pool import NullPool
+
+from ..device.model import Device
+from ..event.model import Event, EventStatus
+from ..location.model import Location
+from ..organization.model import LinkOrgUser
+from .model import EventRollup, UserRollup
+
+
+def utc_day(column):
+    # Must match the (created_at AT TIME ZONE 'UTC')::date of the triggers
+    return cast(func.timezone("UTC", column), Date)
+
+
+def as_day(value: datetime) -> date:
+    if value.tzinfo:
+        value = value.astimezone(timezone.utc)
+
+    return value.date()
+
+
+async def count_transactions(
+    id_org: UUID,
+    from_date: Optional[datetime] = None,
+    to_date: Optional[datetime] = None,
+) -> int:
+    query = select(func.coalesce(func.sum(EventRollup.transactions), 0)).where(
+        EventRollup.id_org == id_org
+    )
+
+    if from_date:
+        query = query.where(EventRollup.day >= as_day(from_date))
+    if to_date:
+        query = query.where(EventRollup.day <= as_day(to_date))
+
+    return int(await db.session.scalar(query))
+
+
+async def count_new_users(
+    id_org: UUID,
+    from_date: Optional[datetime] = None,
+    to_date: Optional[datetime] = None,
+) -> int:
+    query = select(func.coalesce(func.sum(UserRollup.new_users), 0)).where(
+        UserRollup.id_org == id_org
+    )
+
+    if from_date:
+        query = query.where(UserRollup.day >= as_day(from_date))
+    if to_date:
+        query = query.where(UserRollup.day <= as_day(to_date))
+
+    return int(await db.session.scalar(query))
+
+
+async def monthly_transactions(id_org: UUID, from_date: datetime, to_date: datetime):
+    """Transactions per month of year, as (count, month) rows"""
+    month = extract("month", EventRollup.day)
+
+    query = (
+        select(
+            func.sum(EventRollup.transactions).label("count"),
+            month.label("month"),
+        )
+        .where(
+            EventRollup.id_org == id_org,
+            EventRollup.day.between(as_day(from_date), as_day(to_date)),
+        )
+        .group_by(month)
+    )
+
+    response = await db.session.execute(query)
+
+    return response.all()
+
+
+async def monthly_new_users(id_org: UUID, from_date: datetime, to_date: datetime):
+    """Users linked per month of year, as (count, month) rows"""
+    month = extract("month", UserRollup.day)
+
+    query = (
+        select(
+            func.sum(UserRollup.new_users).label("count"),
+            month.label("month"),
+        )
+        .where(
+            UserRollup.id_org == id_org,
+            UserRollup.day.between(as_day(from_date), as_day(to_date)),
+        )
+        .group_by(month)
+    )
+
+    response = await db.session.execute(query)
+
+    return response.all()
+
+
+async def sum_revenue(id_org: UUID, from_date: datetime, to_date: datetime) -> float:
+    query = select(func.coalesce(func.sum(EventRollup.revenue), 0)).where(
+        EventRollup.id_org == id_org,
+        EventRollup.day.between(as_day(from_date), as_day(to_date)),
+    )
+
+    return await db.session.scalar(query)
+
+
+async def avg_duration(id_org: UUID, from_date: datetime, to_date: datetime) -> float:
+    """Average seconds between start and end of the events created in the range"""
+    query = select(
+        func.sum(EventRollup.duration_seconds),
+        func.sum(EventRollup.timed_transactions),
+    ).where(
+        EventRollup.id_org == id_org,
+        EventRollup.day.between(as_day(from_date), as_day(to_date)),
+    )
+
+    response = await db.session.execute(query)
+    duration, timed = response.one()
+
+    return duration / timed if timed else 0
+
+
+async def top_locations(id_org: UUID, limit: int = 5):
+    """Locations with the most transactions, as (count, id, name, address) rows"""
+    count = func.sum(EventRollup.transactions).label("count")
+
+    query = (
+        select(count, Location.id, Location.name, Location.address)
+        .select_from(EventRollup)
+        .join(Location, Location.id == EventRollup.id_location)
+        .where(EventRollup.id_org == id_org)
+        .group_by(Location.id)
+        .order_by(desc(count))
+        .limit(limit)
+    )
+
+    response = await db.session.execute(query)
+
+    return response.all()
+
+
+def month_key(month: date) -> int:
+    # Must match the lock key of rollup_lock in the database
+    return month.year * 12 + month.month
+
+
+def next_month(month: date) -> date:
+    return (month.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+
+async def lock_month(id_org: UUID, month: date):
+    """Holds the triggers writing the rollups of the org and month until commit"""
+    await db.session.execute(
+        select(func.pg_advisory_xact_lock(func.hashtext(str(id_org)), month_key(month)))
+    )
+
+
+async def fill_locations():
+    """Sets the rollup location of events created before it was recorded"""
+    batch = (
+        select(Event.id)
+        .join(Device, Device.id == Event.id_device)
+        .where(Event.rollup_location.is_(None), Device.id_location.is_not(None))
+        .limit(get_settings().rollup_backfill_rows)
+        .correlate(None)
+    )
+
+    while True:
+        response = await db.session.execute(
+            update(Event)
+            .where(Event.id.in_(batch.scalar_subquery()), Device.id == Event.id_device)
+            .values(rollup_location=Device.id_location)
+            .execution_options(synchronize_session=False)
+        )
+        await db.session.commit()
+
+        if not response.rowcount:
+            break
+
+
+async def rebuild_month(id_org: UUID, month: date):
+    """Recomputes the rollups of one org and month, in its own transaction"""
+    await lock_month(id_org, month)
+
+    until = next_month(month)
+    since_at = datetime.combine(month, time.min, timezone.utc)
+    until_at = datetime.combine(until, time.min, timezone.utc)
+
+    await db.session.execute(
+        delete(EventRollup).where(
+            EventRollup.id_org == id_org,
+            EventRollup.day >= month,
+            EventRollup.day < until,
+        )
+    )
+    await db.session.execute(
+        delete(UserRollup).where(
+            UserRollup.id_org == id_org,
+            UserRollup.day >= month,
+            UserRollup.day < until,
+        )
+    )
+
+    finished = Event.event_status == EventStatus.finished
+    duration = extract("epoch", Event.ended_at - Event.started_at)
+
+    day = utc_day(Event.created_at)
+    events = (
+        select(
+            Event.id_org,
+            Event.rollup_location,
+            day,
+            func.count(),
+            func.count().filter(finished),
+            func.coalesce(func.sum(Event.total).filter(finished), 0),
+            func.coalesce(func.sum(duration), 0),
+            func.count(duration),
+        )
+        .where(
+            Event.id_org == id_org,
+            Event.created_at >= since_at,
+            Event.created_at < until_at,
+        )
+        .group_by(Event.id_org, Event.rollup_location, day)
+    )
+
+    user_day = utc_day(LinkOrgUser.created_at)
+    users = (
+        select(LinkOrgUser.id_org, user_day, func.count())
+        .where(
+            LinkOrgUser.id_org == id_org,
+            LinkOrgUser.created_at >= since_at,
+            LinkOrgUser.created_at < until_at,
+        )
+        .group_by(LinkOrgUser.id_org, user_day)
+    )
+
+    await db.session.execute(
+        insert(EventRollup).from_select(
+            [
+                "id_org",
+                "id_location",
+                "day",
+                "transactions",
+                "finished",
+                "revenue",
+                "duration_seconds",
+                "timed_transactions",
+            ],
+            events,
+        )
+    )
+    await db.session.execute(
+        insert(UserRollup).from_select(["id_org", "day", "new_users"], users)
+    )
+
+    await db.session.commit()
+
+
+async def backfill_rollups(id_org: Optional[UUID] = None):
+    """Rebuilds the rollups of an org, or of every org, from event and link_org_user
+
+    The rollups are rebuilt one org and month at a time, each in a short
+    transaction. Only the triggers writing that org and month wait for it,
+    so events written meanwhile are counted once and the rest of the
+    traffic is not blocked.
+    """
+    await fill_locations()
+
+    def month_of(column):
+        return cast(func.date_trunc("month", column), Date)
+
+    months = [
+        select(Event.id_org, month_of(utc_day(Event.created_at))),
+        select(LinkOrgUser.id_org, month_of(utc_day(LinkOrgUser.created_at))),
+        # Clears the months left without events
+        select(EventRollup.id_org, month_of(EventRollup.day)),
+        select(UserRollup.id_org, month_of(UserRollup.day)),
+    ]
+
+    if id_org:
+        months = [query.where(query.selected_columns[0] == id_org) for query in months]
+
+    response = await db.session.execute(union(*months))
+    batches = response.all()
+    await db.session.commit()
+
+    for org, month in batches:
+        await rebuild_month(org, month)
+
+
+async def main(orgs: List[UUID]):
+    # Outside of the app, the middleware only provides the session factory
+    SQLAlchemyMiddleware(
+        None,
+        db_url=PostgresDsn.build(
+            scheme="postgresql+asyncpg",
+            user=get_settings().database_user,
+            password=get_settings().database_password,
+            host=get_settings().database_host,
+            port=str(get_settings().database_port),
+            path=f"/{get_settings().database_name}",
+        ),
+        engine_args={"poolclass": NullPool},
+    )
+
+    for id_org in orgs or [None]:
+        async with db():
+            await backfill_rollups(id_org)
+
+        print(f"[*] Rebuilt rollups of {id_org or 'every org'}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the daily report rollups")
+    parser.add_argument(
+        "--org",
+        type=UUID,
+        action="append",
+        default=[],
+        help="only rebuild this org, can be repeated",
+    )
+
+    asyncio.run(main(parser.parse_args().org))
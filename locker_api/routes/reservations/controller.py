@@ -9,7 +9,7 @@ from pydantic import conint
 from sqlalchemy import VARCHAR, cast, delete, insert, or_, select, update
 from ..notifications.controller import create_notify_job_on_event
 from ..notifications.model import NotificationType
-from util.scheduler import scheduler
+from util.scheduler import migrate_jobs, scheduler
 
 from ..device.controller import (
     reserve_device,
@@ -537,6 +537,30 @@ async def insert_reservation_transaction(reservation: Reservation):
     return event
 
 
+async def insert_scheduled_reservation_transaction(id_reservation: str):
+    """Scheduler entry point, starts the reservation with its current data"""
+    async with db():
+        query = select(Reservation).where(Reservation.id == UUID(id_reservation))
+        response = await db.session.execute(query)
+
+        reservation = response.unique().scalar_one_or_none()
+
+        # The reservation was deleted since the job was scheduled
+        if not reservation:
+            return
+
+        await insert_reservation_transaction(reservation)
+
+
+def migrate_reservation_jobs():
+    """Rewrites reservation jobs stored with pickled reservations to the id format"""
+    migrate_jobs(
+        insert_reservation_transaction,
+        insert_scheduled_reservation_transaction,
+        lambda reservation: [str(reservation.id)],
+    )
+
+
 async def schedule_start(reservation: Reservation, renew: bool = False):
     days = get_days_from_reservation(reservation)
 
@@ -548,14 +572,14 @@ async def schedule_start(reservation: Reservation, renew: bool = False):
 
     for day in days:
         scheduler.add_job(
-            insert_reservation_transaction,
+            insert_scheduled_reservation_transaction,
             "cron",
             day_of_week=day,
             hour=reservation.from_time.split(":")[0],
             minute=reservation.from_time.split(":")[1],
             second=0,
             end_date=reservation.end_date,
-            args=[reservation],
+            args=[str(reservation.id)],
             id=str(reservation.id) + "_" + str(day),
             replace_existing=True,
         )
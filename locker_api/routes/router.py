@@ -1,5 +1,6 @@
 from fastapi import APIRouter
 
+from .commands.endpoint import router as commands_router
 from .conditions.endpoint import router as conditions_router
 from .developer.endpoint import router as developer_router
 from .device.endpoint import router as device_router
@@ -38,6 +39,7 @@ central_router = APIRouter()
 
 central_router.include_router(router=location_router)
 central_router.include_router(router=device_router)
+central_router.include_router(router=commands_router)
 central_router.include_router(router=locker_wall_router)
 central_router.include_router(router=size_router)
 central_router.include_router(router=conditions_router)
@@ -6,6 +6,7 @@ from sqlalchemy import insert, select, update
 from sqlalchemy.exc import NoResultFound
 from util.validator import lookup_phone
 
+from ..notifications.context import org_contexts
 from .helpers import parse_country
 from .model import (
     OrgSettings,
@@ -101,6 +102,9 @@ async def update_settings(id_org: UUID, settings: OrgSettings.Write):
         response = await db.session.execute(query)
         await db.session.commit()  # raise IntegrityError
 
+    # Notifications render with the org's settings
+    await org_contexts.invalidate(id_org)
+
     try:
         return response.all().pop()
     except IndexError:
@@ -165,6 +169,8 @@ async def create_settings(id_org: UUID, settings: OrgSettings.Write):
     response = await db.session.execute(query)
     await db.session.commit()
 
+    await org_contexts.invalidate(id_org)
+
     return response.all().pop()
 
 
@@ -25,6 +25,7 @@ from util.images import ImagesService
 from util.validator import lookup_phone
 
 
+from ..groups.access import access_index
 from ..groups.controller import assign_user_to_group, get_group, get_groups_from_user
 from ..groups.model import LinkGroupsUser
 from ..login.model import Channel
@@ -1384,9 +1385,10 @@ async def delete_users(users: List[UUID], id_org: UUID):
     if len(users) == 0:
         raise HTTPException(400, detail="Insert a valid list of user UUIDs to delete")
 
-    # Unlink from groups first
+    # Unlink from groups first, of any org
     response = await db.session.execute(unlink_group_query)
     await db.session.commit()
+    await access_index.invalidate()
     # Unlink from organization
     response = await db.session.execute(query)
     await db.session.commit()
@@ -6,6 +6,7 @@ from fastapi_async_sqlalchemy import db
 from sqlalchemy import insert, select, update
 from sqlalchemy.exc import IntegrityError, NoResultFound
 from util.images import ImagesService
+from ..notifications.context import org_contexts
 from ..organization.controller import add_user
 
 from .model import WhiteLabel
@@ -44,6 +45,9 @@ async def partner_update_white_label_logo(
     response = await db.session.execute(query)
     await db.session.commit()
 
+    # Notifications render with the org's white label
+    await org_contexts.invalidate(id_org)
+
     return response.all().pop()
 
 
@@ -63,6 +67,9 @@ async def partner_patch_white_label(white_label: WhiteLabel.Patch, id_org: UUID)
     response = await db.session.execute(query)
     await db.session.commit()
 
+    # Notifications render with the org's white label
+    await org_contexts.invalidate(id_org)
+
     return response.all().pop()
 
 
@@ -105,6 +112,8 @@ async def partner_update_white_label(
     response = await db.session.execute(update_query)
     await db.session.commit()
 
+    await org_contexts.invalidate(id_org)
+
     data = response.all().pop()
 
     if white_label.organization_owner and white_label.organization_owner != prev_owner:
@@ -166,6 +175,8 @@ async def partner_create_white_label(
             status_code=409, detail=f"Failed to create White Label: {e}"
         )
 
+    await org_contexts.invalidate(id_org)
+
     return response.all().pop()
 
 
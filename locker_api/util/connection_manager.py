@@ -1,16 +1,69 @@
+import asyncio
+import itertools
 import json
+import time
+from typing import Dict
 
-from fastapi import WebSocket
+from config import get_settings
+from fastapi import WebSocket, status
+
+
+class ControllerConnection:
+    """A Gantner controller websocket with its own outgoing queue
+
+    Messages are written by a dedicated sender task, so a slow controller
+    only delays its own queue and never the other controllers.
+    """
+
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.queue: asyncio.Queue = asyncio.Queue(
+            maxsize=get_settings().gantner_send_queue_size
+        )
+        self.lock_ids: set[str] = set()
+        self.task: asyncio.Task | None = None
+
+        # Send latency, in milliseconds
+        self.sent = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.last_latency = 0.0
+
+    def record_latency(self, latency: float):
+        self.sent += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        self.last_latency = latency
+
+    def stats(self) -> dict:
+        return {
+            "client": str(self.websocket.client),
+            "locks": len(self.lock_ids),
+            "queued": self.queue.qsize(),
+            "sent": self.sent,
+            "avg_latency_ms": self.total_latency / self.sent if self.sent else 0,
+            "max_latency_ms": self.max_latency,
+            "last_latency_ms": self.last_latency,
+        }
 
 
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: list[WebSocket] = []
+        self.active_connections: Dict[WebSocket, ControllerConnection] = {}
+        # Gantner lock id -> controller that reported it in App.Locks.Get
+        self.lock_owners: Dict[str, ControllerConnection] = {}
+        # Transaction ids, unique for the lifetime of the process
+        self._tids = itertools.count(1)
+        # Close handshakes of dropped controllers still in flight
+        self._closing: set[asyncio.Task] = set()
+
+    def next_tid(self) -> int:
+        return next(self._tids)
 
     async def connect(self, websocket: WebSocket):
         """Upgrades websocket connection
         Sends initial messages (login and register to events)
-        Adds websocket to active connections list
+        Adds websocket to active connections and starts its sender task
 
         Args:
             websocket (WebSocket): the websocket connection
@@ -21,7 +74,7 @@ class ConnectionManager:
                 {
                     "Cmd": "Login",
                     "MT": "Req",
-                    "TID": 1000,
+                    "TID": self.next_tid(),
                     "Data": {
                         "User": "system",
                         "Password": "R0FU",
@@ -36,28 +89,106 @@ class ConnectionManager:
                 {
                     "Cmd": "RegisterEvent",
                     "MT": "Req",
-                    "TID": 2000,
+                    "TID": self.next_tid(),
                     "Data": {"Event": "App.*"},
                 }
             )
         )
-        self.active_connections.append(websocket)
+
+        connection = ControllerConnection(websocket)
+        connection.task = asyncio.create_task(self._sender(connection))
+        self.active_connections[websocket] = connection
 
     def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
+        connection = self.active_connections.pop(websocket, None)
 
-    async def send_personal_message(self, message: str, websocket: WebSocket):
-        await websocket.send_text(message)
+        if not connection:
+            return
 
-    async def broadcast(self, message: str):
-        for connection in self.active_connections:
+        for lock_id in connection.lock_ids:
+            if self.lock_owners.get(lock_id) is connection:
+                del self.lock_owners[lock_id]
+
+        if connection.task and connection.task is not asyncio.current_task():
+            connection.task.cancel()
+
+    async def _close(self, websocket: WebSocket, code: int):
+        try:
+            await asyncio.wait_for(
+                websocket.close(code=code), get_settings().gantner_send_timeout
+            )
+        except Exception as e:
+            print(f"Error closing Gantner controller {websocket.client}: {e}")
+
+    def drop(self, websocket: WebSocket, code: int):
+        """Disconnects a controller that can't keep up and closes its socket
+
+        The controller sees the close code and reconnects with a fresh
+        connection instead of staying attached to a socket nobody reads.
+        """
+        self.disconnect(websocket)
+
+        task = asyncio.create_task(self._close(websocket, code))
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    async def _sender(self, connection: ControllerConnection):
+        timeout = get_settings().gantner_send_timeout
+
+        while True:
+            message = await connection.queue.get()
+
+            start = time.perf_counter()
             try:
-                await connection.send_text(message)
+                await asyncio.wait_for(connection.websocket.send_text(message), timeout)
             except Exception as e:
-                print(f"Error broadcasting to websocket clients: {e}")
+                print(f"Error sending to Gantner controller: {e}")
                 print("Message: ", message)
-                self.active_connections.remove(connection)
+                self.drop(connection.websocket, status.WS_1011_INTERNAL_ERROR)
+                return
+
+            connection.record_latency((time.perf_counter() - start) * 1000)
+
+    def _enqueue(self, connection: ControllerConnection, message: str):
+        try:
+            connection.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            print(f"Gantner controller {connection.websocket.client} is not keeping up")
+            self.drop(connection.websocket, status.WS_1013_TRY_AGAIN_LATER)
+
+    async def send_personal_message(self, message: str, websocket: WebSocket):
+        await websocket.send_text(message)
+
+    async def broadcast(self, message: str):
+        # Iterate over a copy, failing connections are removed while sending
+        for connection in list(self.active_connections.values()):
+            self._enqueue(connection, message)
+
+    async def send_to_lock(self, lock_id: str, message: str):
+        """Sends a message only to the controller owning the lock
+
+        Falls back to a broadcast while the owner is not known yet
+        """
+        connection = self.lock_owners.get(lock_id)
+
+        if connection and connection.websocket in self.active_connections:
+            self._enqueue(connection, message)
+        else:
+            await self.broadcast(message)
+
+    def register_locks(self, websocket: WebSocket, data: dict):
+        """Learns which locks a controller owns from its App.Locks.Get response"""
+        connection = self.active_connections.get(websocket)
+
+        if not connection:
+            return
+
+        for lock in data.get("Locks", []):
+            connection.lock_ids.add(lock["Id"])
+            self.lock_owners[lock["Id"]] = connection
+
+    def stats(self) -> list[dict]:
+        return [connection.stats() for connection in self.active_connections.values()]
 
 
 connection_manager = ConnectionManager()
@@ -1,9 +1,13 @@
 import asyncio
 import csv
+import zlib
+from io import StringIO
+from typing import AsyncIterator
 from uuid import UUID
 
 from config import get_settings
 from fastapi import HTTPException, UploadFile
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
 
@@ -109,3 +113,63 @@ def to_bool(value: str) -> bool | str:
             return False
 
     return value
+
+
+async def encode_csv_rows(
+    rows: AsyncIterator[list],
+    compress: bool = False,
+) -> AsyncIterator[bytes]:
+    """Encodes rows as CSV, yielding a chunk every csv_stream_rows rows
+
+    Args:
+        rows (AsyncIterator[list]): rows to write
+        compress (bool): gzip the output as it is produced
+    """
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    # wbits=31 writes a gzip header and trailer
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    pending = 0
+
+    def flush() -> bytes:
+        data = buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+
+        return compressor.compress(data) if compressor else data
+
+    async for row in rows:
+        writer.writerow(row)
+        pending += 1
+
+        if pending >= get_settings().csv_stream_rows:
+            pending = 0
+            chunk = flush()
+
+            if chunk:
+                yield chunk
+
+    chunk = flush()
+    if compressor:
+        chunk += compressor.flush()
+
+    if chunk:
+        yield chunk
+
+
+def stream_csv_response(
+    rows: AsyncIterator[list],
+    filename: str,
+    compress: bool = False,
+) -> StreamingResponse:
+    """Streams rows as a CSV download, gzip compressed when compress is set"""
+    headers = {"Content-Disposition": f'attachment; filename="{filename}.csv"'}
+
+    if compress:
+        headers["Content-Encoding"] = "gzip"
+
+    return StreamingResponse(
+        encode_csv_rows(rows, compress),
+        media_type="text/csv",
+        headers=headers,
+    )
@@ -4,7 +4,13 @@ from email.utils import formataddr
 from config import get_settings
 from fastapi import HTTPException
 from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail, Attachment
+from sendgrid.helpers.mail import (
+    Attachment,
+    Mail,
+    Personalization,
+    Substitution,
+    To,
+)
 
 
 def send(sender, recipient, subject, html_content, is_ups_org=False):
@@ -33,6 +39,35 @@ def send(sender, recipient, subject, html_content, is_ups_org=False):
         )
 
 
+def send_bulk(sender, subject, html_content, personalizations, is_ups_org=False):
+    """Sends one email per recipient in a single SendGrid request
+
+    Args:
+        sender (str): sender email address
+        subject (str): subject of every email
+        html_content (str): body with substitution keys, e.g. -message-
+        personalizations (list): (recipient, {key: value}) pairs, at most 1000
+        is_ups_org (bool): send as UPS Lockers instead of Koloni
+    """
+    sender = formataddr(("Koloni" if not is_ups_org else "UPS Lockers", sender))
+
+    message = Mail(from_email=sender, subject=subject, html_content=html_content)
+
+    for recipient, substitutions in personalizations:
+        personalization = Personalization()
+        personalization.add_to(To(recipient))
+
+        for key, value in substitutions.items():
+            personalization.add_substitution(Substitution(key, value))
+
+        message.add_personalization(personalization)
+
+    sg = SendGridAPIClient(api_key=get_settings().twilio_sendgrid_api_key)
+
+    # Raises on failure, the caller reports the outcome of every recipient
+    sg.send(message)
+
+
 def send_csv_file(sender, recipient, subject, html_content, file_content, name):
     # Format the sender's name and email address
     sender = formataddr(("Koloni", sender))
@@ -0,0 +1,69 @@
+import asyncio
+from typing import Callable, Dict, List, Optional
+
+from redis import asyncio as aioredis
+
+CHANNEL_PREFIX = "invalidate"
+
+
+class InvalidationBus:
+    """Propagates in-memory cache invalidations to every uvicorn worker
+
+    Caches register a handler under a name; invalidate() runs the local
+    handlers right away and publishes the key on Redis so the other
+    workers drop their copy too.
+    """
+
+    def __init__(self):
+        self.handlers: Dict[str, List[Callable[[str], None]]] = {}
+        self.redis: Optional[aioredis.Redis] = None
+        self._listener: Optional[asyncio.Task] = None
+
+    def register(self, cache: str, handler: Callable[[str], None]):
+        self.handlers.setdefault(cache, []).append(handler)
+
+    async def start(self, redis_url: str):
+        self.redis = aioredis.from_url(redis_url)
+
+        pubsub = self.redis.pubsub()
+        await pubsub.psubscribe(f"{CHANNEL_PREFIX}:*")
+
+        self._listener = asyncio.create_task(self._listen(pubsub))
+
+    async def _listen(self, pubsub):
+        while True:
+            try:
+                async for message in pubsub.listen():
+                    if message["type"] != "pmessage":
+                        continue
+
+                    _, cache = message["channel"].decode().split(":", 1)
+                    self._run_handlers(cache, message["data"].decode())
+            except Exception as e:
+                print(f"[!] Invalidation listener error: {e}")
+                await asyncio.sleep(1)
+
+    def _run_handlers(self, cache: str, key: str):
+        for handler in self.handlers.get(cache, []):
+            try:
+                handler(key)
+            except Exception as e:
+                print(f"[!] Failed to invalidate {cache} {key}: {e}")
+
+    async def invalidate(self, cache: str, key):
+        """Drops a key from a cache on every worker
+
+        Args:
+            cache (str): name the cache registered its handler with
+            key: cache key, sent as a string
+        """
+        self._run_handlers(cache, str(key))
+
+        if self.redis:
+            try:
+                await self.redis.publish(f"{CHANNEL_PREFIX}:{cache}", str(key))
+            except Exception as e:
+                print(f"[!] Failed to publish invalidation of {cache} {key}: {e}")
+
+
+invalidation_bus = InvalidationBus()
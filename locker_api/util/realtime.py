@@ -0,0 +1,382 @@
+import asyncio
+import json
+from collections import deque
+from typing import AsyncIterator, Deque, Dict, Optional, Set, Tuple
+from uuid import UUID
+
+from config import get_settings
+from fastapi import Request, WebSocket, WebSocketDisconnect
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from redis import asyncio as aioredis
+
+CHANNEL_PREFIX = "realtime"
+STATE_PREFIX = "realtime-state"
+SEQUENCE_PREFIX = "realtime-seq"
+VERSION_FIELD = "__version"
+
+
+def resource_fields(resource, table) -> dict:
+    """Column values of a model instance, result row or dict, without relationships"""
+    if isinstance(resource, dict):
+        source = resource
+    elif hasattr(resource, "_mapping"):
+        source = dict(resource._mapping)
+    else:
+        source = {
+            column.name: getattr(resource, column.name)
+            for column in table.columns
+            if hasattr(resource, column.name)
+        }
+
+    return {
+        column.name: source[column.name]
+        for column in table.columns
+        if column.name in source
+    }
+
+
+class Subscriber:
+    """A dashboard websocket with a bounded outgoing queue
+
+    When the queue is full the oldest message is dropped; a subscriber that
+    keeps dropping messages is considered a slow consumer and disconnected.
+    """
+
+    def __init__(self, websocket: Optional[WebSocket] = None):
+        # None for Server-Sent Events subscribers, which read the queue directly
+        self.websocket = websocket
+        self.queue: asyncio.Queue = asyncio.Queue(
+            maxsize=get_settings().realtime_queue_size
+        )
+        self.dropped = 0
+        self.task: Optional[asyncio.Task] = None
+
+    def offer(self, message: str, seq: Optional[int] = None) -> bool:
+        """Queues a message, returns False once the subscriber is too slow"""
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+
+            if self.dropped > get_settings().realtime_max_dropped:
+                return False
+
+        self.queue.put_nowait((seq, message))
+        return True
+
+
+class RealtimeHub:
+    """Fans out realtime payloads to every websocket or SSE stream of an org
+
+    Payloads are published on Redis so that subscribers connected to any
+    uvicorn worker receive them. Without Redis the hub delivers locally.
+    """
+
+    def __init__(self):
+        self.subscribers: Dict[Tuple[str, str], Set[Subscriber]] = {}
+        self.redis: Optional[aioredis.Redis] = None
+        self._listener: Optional[asyncio.Task] = None
+        self._heartbeat: Optional[asyncio.Task] = None
+        # Last published fields per resource, used when Redis is unavailable
+        self._state: Dict[str, Dict[str, str]] = {}
+        self._sequences: Dict[Tuple[str, str], int] = {}
+        # Recent messages per feed, replayed to reconnecting SSE clients
+        self.replay: Dict[Tuple[str, str], Deque[Tuple[int, str]]] = {}
+
+    async def start(self, redis_url: str):
+        self.redis = aioredis.from_url(redis_url)
+
+        pubsub = self.redis.pubsub()
+        await pubsub.psubscribe(f"{CHANNEL_PREFIX}:*")
+
+        self._listener = asyncio.create_task(self._listen(pubsub))
+        self._heartbeat = asyncio.create_task(self._send_heartbeats())
+
+    async def _listen(self, pubsub):
+        while True:
+            try:
+                async for message in pubsub.listen():
+                    if message["type"] != "pmessage":
+                        continue
+
+                    _, channel, id_org = message["channel"].decode().split(":", 2)
+                    seq, data = message["data"].decode().split(":", 1)
+                    self._deliver(channel, id_org, data, int(seq))
+            except Exception as e:
+                print(f"[!] Realtime listener error: {e}")
+                await asyncio.sleep(1)
+
+    async def _send_heartbeats(self):
+        message = json.dumps({"type": "ping"})
+
+        while True:
+            await asyncio.sleep(get_settings().realtime_heartbeat_seconds)
+
+            for (channel, id_org), subscribers in list(self.subscribers.items()):
+                self._deliver(channel, id_org, message, subscribers=subscribers)
+
+    def _deliver(
+        self,
+        channel: str,
+        id_org: str,
+        message: str,
+        seq: Optional[int] = None,
+        subscribers: Optional[Set[Subscriber]] = None,
+    ):
+        if seq is not None:
+            self.replay.setdefault(
+                (channel, id_org),
+                deque(maxlen=get_settings().realtime_replay_size),
+            ).append((seq, message))
+
+        if subscribers is None:
+            subscribers = self.subscribers.get((channel, id_org), set())
+
+        for subscriber in list(subscribers):
+            if not subscriber.offer(message, seq):
+                print(f"[!] Dropping slow realtime subscriber for org {id_org}")
+                self._unsubscribe(channel, id_org, subscriber)
+
+    async def publish(self, channel: str, id_org: UUID, payload: dict):
+        """Sends a payload to every subscriber of the org, on every worker
+
+        Args:
+            channel (str): feed name, e.g. "events" or "devices"
+            id_org (UUID): id of the organization
+            payload (dict): JSON serializable payload
+        """
+        message = json.dumps(payload, default=str)
+
+        if self.redis:
+            try:
+                # The sequence is shared by every worker, so Last-Event-ID
+                # means the same thing whichever worker a client reconnects to
+                seq = await self.redis.incr(f"{SEQUENCE_PREFIX}:{channel}:{id_org}")
+                await self.redis.publish(
+                    f"{CHANNEL_PREFIX}:{channel}:{id_org}", f"{seq}:{message}"
+                )
+                return
+            except Exception as e:
+                print(f"[!] Failed to publish realtime payload: {e}")
+
+        key = (channel, str(id_org))
+        self._sequences[key] = self._sequences.get(key, 0) + 1
+        self._deliver(*key, message, self._sequences[key])
+
+    async def _merge_state(self, key: str, fields: Dict[str, str]):
+        """Stores the latest fields of a resource and returns (changes, version)"""
+        if self.redis:
+            previous = {
+                k.decode(): v.decode()
+                for k, v in (await self.redis.hgetall(key)).items()
+            }
+        else:
+            previous = self._state.setdefault(key, {})
+
+        changes = {k: v for k, v in fields.items() if previous.get(k) != v}
+
+        if not changes:
+            return changes, int(previous.get(VERSION_FIELD, 0))
+
+        if self.redis:
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.hset(key, mapping=changes)
+                pipe.hincrby(key, VERSION_FIELD, 1)
+                pipe.expire(key, get_settings().realtime_state_ttl)
+                _, version, _ = await pipe.execute()
+        else:
+            previous.update(changes)
+            version = int(previous.get(VERSION_FIELD, 0)) + 1
+            previous[VERSION_FIELD] = str(version)
+
+        return changes, version
+
+    async def publish_delta(
+        self,
+        channel: str,
+        id_org: UUID,
+        id_resource: UUID,
+        action_type: str,
+        fields: dict,
+    ):
+        """Publishes only the fields that changed since the last message
+
+        Args:
+            channel (str): feed name, e.g. "events" or "devices"
+            id_org (UUID): id of the organization
+            id_resource (UUID): id of the event or device
+            action_type (str): "create" or "update"
+            fields (dict): current column values of the resource
+        """
+        encoded = {k: json.dumps(v) for k, v in jsonable_encoder(fields).items()}
+
+        changes, version = await self._merge_state(
+            f"{STATE_PREFIX}:{channel}:{id_resource}", encoded
+        )
+
+        if not changes:
+            return
+
+        await self.publish(
+            channel,
+            id_org,
+            {
+                "type": action_type,
+                "id": str(id_resource),
+                "version": version,
+                "changes": {k: json.loads(v) for k, v in changes.items()},
+            },
+        )
+
+    async def get_version(self, channel: str, id_resource: UUID) -> int:
+        key = f"{STATE_PREFIX}:{channel}:{id_resource}"
+
+        if self.redis:
+            version = await self.redis.hget(key, VERSION_FIELD)
+        else:
+            version = self._state.get(key, {}).get(VERSION_FIELD)
+
+        return int(version) if version else 0
+
+    async def _sender(self, subscriber: Subscriber, channel: str, id_org: str):
+        timeout = get_settings().realtime_send_timeout
+
+        try:
+            while True:
+                _, message = await subscriber.queue.get()
+                await asyncio.wait_for(subscriber.websocket.send_text(message), timeout)
+        except Exception:
+            self._unsubscribe(channel, id_org, subscriber)
+
+    def _unsubscribe(self, channel: str, id_org: str, subscriber: Subscriber):
+        subscribers = self.subscribers.get((channel, id_org))
+
+        if subscribers is not None:
+            subscribers.discard(subscriber)
+
+            if not subscribers:
+                del self.subscribers[(channel, id_org)]
+
+        if subscriber.task and subscriber.task is not asyncio.current_task():
+            subscriber.task.cancel()
+
+    async def serve(self, websocket: WebSocket, channel: str, id_org: UUID):
+        """Accepts a websocket and streams the org's feed until it disconnects"""
+        await websocket.accept()
+
+        key = (channel, str(id_org))
+        subscriber = Subscriber(websocket)
+        subscriber.task = asyncio.create_task(self._sender(subscriber, *key))
+        self.subscribers.setdefault(key, set()).add(subscriber)
+
+        try:
+            while True:
+                data = await websocket.receive_text()
+
+                if data == "ping":
+                    subscriber.offer(json.dumps({"type": "pong"}))
+        except WebSocketDisconnect:
+            pass
+        finally:
+            self._unsubscribe(*key, subscriber)
+
+    async def stream(
+        self,
+        request: Request,
+        channel: str,
+        id_org: UUID,
+        last_event_id: Optional[int] = None,
+    ) -> AsyncIterator[str]:
+        """Yields the org's feed as Server-Sent Events until the client leaves
+
+        Messages after last_event_id still in the replay buffer are sent
+        first. When the buffer no longer reaches back that far a "resync"
+        event tells the client to reload its state.
+
+        Sequences restart when Redis is flushed on startup, so an id lower
+        than last_event_id also means a new sequence: the client gets a
+        "resync" and ids are followed from there.
+        """
+        key = (channel, str(id_org))
+        subscriber = Subscriber()
+        self.subscribers.setdefault(key, set()).add(subscriber)
+
+        heartbeat = get_settings().realtime_heartbeat_seconds
+        last_sent = last_event_id or 0
+
+        try:
+            yield f"retry: {get_settings().realtime_sse_retry_ms}\n\n"
+
+            if last_event_id is not None:
+                buffered = list(self.replay.get(key, []))
+
+                if buffered and buffered[-1][0] < last_event_id:
+                    # The sequence restarted, the buffer is covered by the resync
+                    yield "event: resync\ndata: {}\n\n"
+                    last_sent = buffered[-1][0]
+                    last_event_id = None
+                elif not buffered or buffered[0][0] > last_event_id + 1:
+                    yield "event: resync\ndata: {}\n\n"
+
+                for seq, message in buffered:
+                    if seq > last_sent:
+                        last_sent = seq
+                        yield f"id: {seq}\ndata: {message}\n\n"
+
+            # Slow subscribers are dropped from the hub by _deliver
+            while key in self.subscribers and subscriber in self.subscribers[key]:
+                if await request.is_disconnected():
+                    break
+
+                try:
+                    seq, message = await asyncio.wait_for(
+                        subscriber.queue.get(), heartbeat
+                    )
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+
+                if seq is None:
+                    # Websocket heartbeats, SSE clients get comments instead
+                    continue
+
+                # Anything queued since subscribing was published after the
+                # client's last event, a lower id comes from a new sequence
+                if last_event_id is not None and seq <= last_event_id:
+                    yield "event: resync\ndata: {}\n\n"
+                    last_sent = seq - 1
+                    last_event_id = None
+
+                if seq <= last_sent:
+                    continue
+
+                last_sent = seq
+                yield f"id: {seq}\ndata: {message}\n\n"
+        finally:
+            self._unsubscribe(*key, subscriber)
+
+    def sse_response(
+        self,
+        request: Request,
+        channel: str,
+        id_org: UUID,
+        last_event_id: Optional[str] = None,
+    ) -> StreamingResponse:
+        """Wraps stream() in a text/event-stream response"""
+        try:
+            last_seq = int(last_event_id) if last_event_id else None
+        except ValueError:
+            last_seq = None
+
+        return StreamingResponse(
+            self.stream(request, channel, id_org, last_seq),
+            media_type="text/event-stream",
+            headers={
+                "Cache-Control": "no-cache",
+                # Keep nginx from buffering the stream
+                "X-Accel-Buffering": "no",
+            },
+        )
+
+
+realtime_hub = RealtimeHub()
@@ -1,8 +1,22 @@
+import asyncio
+import time
+from typing import Dict, Optional, Set, Tuple
+
+import asyncpg
+from apscheduler.events import (
+    EVENT_JOB_ADDED,
+    EVENT_JOB_ERROR,
+    EVENT_JOB_EXECUTED,
+    EVENT_JOB_MISSED,
+    EVENT_JOB_MODIFIED,
+    EVENT_JOB_SUBMITTED,
+)
 from apscheduler.executors.asyncio import AsyncIOExecutor
 from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from config import get_settings
 from pydantic import PostgresDsn
+from util.invalidation import invalidation_bus
 
 jobstores = {
     "default": SQLAlchemyJobStore(
@@ -28,6 +42,260 @@ scheduler = AsyncIOScheduler(
 )
 
 
+class JobMetrics:
+    """Lag and execution time of the jobs of one function, in milliseconds"""
+
+    def __init__(self):
+        self.submitted = 0
+        self.executed = 0
+        self.failed = 0
+        self.missed = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+        self.total_duration = 0.0
+        self.max_duration = 0.0
+
+    def record_lag(self, lag: float):
+        self.submitted += 1
+        self.total_lag += lag
+        self.max_lag = max(self.max_lag, lag)
+
+    def record_duration(self, duration: float, failed: bool):
+        self.executed += 1
+        self.failed += failed
+        self.total_duration += duration
+        self.max_duration = max(self.max_duration, duration)
+
+    def stats(self) -> dict:
+        return {
+            "submitted": self.submitted,
+            "executed": self.executed,
+            "failed": self.failed,
+            "missed": self.missed,
+            "avg_lag_ms": self.total_lag / self.submitted if self.submitted else 0,
+            "max_lag_ms": self.max_lag,
+            "avg_duration_ms": (
+                self.total_duration / self.executed if self.executed else 0
+            ),
+            "max_duration_ms": self.max_duration,
+        }
+
+
+job_metrics: Dict[str, JobMetrics] = {}
+
+# (job id, scheduled run time) -> (function, monotonic time it was submitted)
+_running_jobs: Dict[Tuple[str, object], Tuple[str, float]] = {}
+
+
+def _job_name(job_id: str) -> str:
+    job = scheduler.get_job(job_id)
+
+    return job.func_ref if job else "unknown"
+
+
+def _on_job_submitted(event):
+    name = _job_name(event.job_id)
+    metrics = job_metrics.setdefault(name, JobMetrics())
+
+    for run_time in event.scheduled_run_times:
+        lag = (time.time() - run_time.timestamp()) * 1000
+        metrics.record_lag(lag)
+
+        # Date jobs are gone from the job store once they finish, so the
+        # function is remembered here
+        _running_jobs[(event.job_id, run_time)] = (name, time.monotonic())
+
+        if lag > get_settings().scheduler_lag_warning * 1000:
+            print(f"[!] Job {event.job_id} ({name}) started {lag:.0f} ms late")
+
+
+def _on_job_finished(event):
+    if event.code == EVENT_JOB_MISSED:
+        name = _job_name(event.job_id)
+        job_metrics.setdefault(name, JobMetrics()).missed += 1
+        return
+
+    running = _running_jobs.pop((event.job_id, event.scheduled_run_time), None)
+
+    if not running:
+        return
+
+    name, started = running
+    job_metrics.setdefault(name, JobMetrics()).record_duration(
+        (time.monotonic() - started) * 1000, event.code == EVENT_JOB_ERROR
+    )
+
+
+scheduler.add_listener(_on_job_submitted, EVENT_JOB_SUBMITTED)
+scheduler.add_listener(
+    _on_job_finished, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR | EVENT_JOB_MISSED
+)
+
+
+# Signals of added jobs sent to the leader, referenced until published
+_signal_tasks: Set[asyncio.Task] = set()
+
+
+def _on_job_added(event):
+    # The leader's own scheduler wakes up for the jobs it adds itself
+    if scheduler_leader.is_leader:
+        return
+
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return
+
+    task = loop.create_task(invalidation_bus.invalidate("scheduler-jobs", event.job_id))
+    _signal_tasks.add(task)
+    task.add_done_callback(_signal_tasks.discard)
+
+
+scheduler.add_listener(_on_job_added, EVENT_JOB_ADDED | EVENT_JOB_MODIFIED)
+
+
+def scheduler_stats() -> dict:
+    return {
+        "mode": get_settings().scheduler_mode,
+        "leader": scheduler_leader.is_leader,
+        "jobs": {name: metrics.stats() for name, metrics in job_metrics.items()},
+    }
+
+
+class SchedulerLeader:
+    """Elects the single process that runs due jobs
+
+    Every worker starts the scheduler paused, so jobs can still be added to
+    and removed from the shared job store. Workers campaign for a Postgres
+    session advisory lock; the holder resumes its scheduler and the others
+    stay on standby. The lock is released when the leader's connection
+    closes, e.g. when the process exits, and a standby takes over on its
+    next attempt.
+
+    Jobs added by standby workers land in the shared job store without
+    waking the leader, which would otherwise sleep until the next run time
+    it already knows. Standbys signal added jobs on the invalidation bus,
+    and the leader also checks the job store once per campaign in case a
+    signal was lost.
+    """
+
+    def __init__(self):
+        self.connection: Optional[asyncpg.Connection] = None
+        self.is_leader = False
+        self.task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.TimerHandle] = None
+
+    async def _connect(self) -> asyncpg.Connection:
+        return await asyncpg.connect(
+            user=get_settings().database_user,
+            password=get_settings().database_password,
+            host=get_settings().database_host,
+            port=str(get_settings().database_port),
+            database=get_settings().database_name,
+        )
+
+    def _step_down(self):
+        if self.is_leader:
+            print("[!] Lost the scheduler leadership, pausing the scheduler")
+            scheduler.pause()
+
+        self.is_leader = False
+
+    async def _campaign(self):
+        while True:
+            try:
+                if not self.connection or self.connection.is_closed():
+                    self._step_down()
+                    self.connection = await self._connect()
+
+                if self.is_leader:
+                    # The lock is held for as long as the session is alive
+                    await self.connection.fetchval("SELECT 1")
+                elif await self.connection.fetchval(
+                    "SELECT pg_try_advisory_lock($1)",
+                    get_settings().scheduler_lock_key,
+                ):
+                    print("Elected scheduler leader, running scheduled jobs")
+                    self.is_leader = True
+                    scheduler.resume()
+            except Exception as e:
+                print(f"[!] Scheduler leader election error: {e}")
+                self._step_down()
+
+                if self.connection and not self.connection.is_closed():
+                    await self.connection.close()
+                self.connection = None
+
+            if self.is_leader:
+                scheduler.wakeup()
+
+            await asyncio.sleep(get_settings().scheduler_leader_interval)
+
+    def _wake(self):
+        self._wakeup = None
+
+        if self.is_leader:
+            scheduler.wakeup()
+
+    def job_added(self, job_id: str):
+        """Wakes the scheduler of the leader, once per burst of added jobs"""
+        if not self.is_leader or self._wakeup:
+            return
+
+        self._wakeup = asyncio.get_running_loop().call_later(
+            get_settings().scheduler_wakeup_delay, self._wake
+        )
+
+    def start(self):
+        self.task = asyncio.create_task(self._campaign())
+
+
+scheduler_leader = SchedulerLeader()
+
+invalidation_bus.register("scheduler-jobs", scheduler_leader.job_added)
+
+
 def start_scheduler():
-    scheduler.start()
+    """Starts the scheduler according to scheduler_mode
+
+    - "leader": one elected process runs the jobs, see SchedulerLeader
+    - "all": every process runs the jobs, only safe with a single worker
+    - "standby": the process only adds and removes jobs
+    """
+    match get_settings().scheduler_mode:
+        case "all":
+            scheduler.start()
+        case "standby":
+            scheduler.start(paused=True)
+        case _:
+            scheduler.start(paused=True)
+            scheduler_leader.start()
+
     return scheduler
+
+
+def migrate_jobs(old_func, new_func, convert_args):
+    """Rewrites stored jobs of old_func to call new_func instead
+
+    Used to move jobs that were stored with pickled ORM objects to jobs that
+    only store ids. Must be called once the scheduler is started.
+
+    Args:
+        old_func (callable): function the stored jobs call
+        new_func (callable): function the jobs will call
+        convert_args (callable): maps the old job args to the new ones
+    """
+    migrated = 0
+
+    for job in scheduler.get_jobs():
+        if job.func is not old_func:
+            continue
+
+        try:
+            job.modify(func=new_func, args=convert_args(*job.args))
+            migrated += 1
+        except Exception as e:
+            print(f"[!] Failed to migrate job {job.id}: {e}")
+
+    if migrated:
+        print(f"Migrated {migrated} {old_func.__name__} jobs")